@@ -0,0 +1,246 @@
+## Reconciliation benchmark against the in-process fake BigQuery backend (fake_bigquery.py).
+## For every manifest size it runs test_code.main on a generated manifest and reports the wall time,
+## API calls per table and peak Python memory (tracemalloc) of:
+##   cold create       every dataset and table is missing
+##   no-op (state)     second run, every entry is skipped through the state file
+##   no-op (no state)  second run with --no-state, every table is checked against the backend
+##   drop column       a column is removed from every native table's schema file (ALTER TABLE DDL jobs)
+##   import            reverse import of every dataset into manifest shards and schema files (importer.py)
+## and checks that a lossy type change is refused, stays unrecorded in the state file, and is migrated once confirmed
+## with --allow-lossy, and that the rewrites of a table requiring a partition filter work and keep its options.
+##
+## python BigQuery/benchmarks/bench_reconcile.py --sizes 10 1000 10000 --latency 0.005 --job-duration 1
+
+# [START imports]
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from google.cloud import bigquery
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import importer
+import test_code
+from bq_client import ClientManager
+from fake_bigquery import FakeBigQueryClient
+from reconcile import DEFAULT_WORKERS
+
+
+DEFAULT_SIZES = [10, 1000, 10000]
+TABLES_PER_DATASET = 100
+# Every 10th table of the manifest is an external table
+EXTERNAL_EVERY = 10
+
+LABELS = {"program": "test", "env": "dev", "location": "us", "market": "all", "usage-type": "all"}
+SCHEMA = [
+    {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "details", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "amount", "type": "NUMERIC", "mode": "NULLABLE"},
+    {"name": "dtloaded", "type": "DATE", "mode": "NULLABLE"},
+]
+
+
+## Writing a manifest of `size` tables with one schema file each, returns the manifest path
+def generate_manifest(directory, size):
+
+    details = {"na_tables_list": [], "ex_tables_list": []}
+    for index in range(size):
+        dataset_name = f"bench_dataset_{index // TABLES_PER_DATASET}"
+        table_name = f"bench_table_{index}"
+        schema_json = os.path.join(directory, "schema_files", dataset_name, f"{table_name}.json")
+        os.makedirs(os.path.dirname(schema_json), exist_ok=True)
+        with open(schema_json, "w") as file:
+            json.dump(SCHEMA, file)
+
+        entry = {"dataset_name": dataset_name, "table_name": table_name, "schema_json": schema_json, "labels": dict(LABELS)}
+        if index % EXTERNAL_EVERY == EXTERNAL_EVERY - 1:
+            entry.update(source_format="CSV", source_uris=[f"gs://bench-bucket/{dataset_name}/{table_name}/*.csv"])
+            details["ex_tables_list"].append(entry)
+        else:
+            details["na_tables_list"].append(entry)
+
+    manifest = os.path.join(directory, "objects_details.json")
+    with open(manifest, "w") as file:
+        json.dump(details, file)
+    return manifest
+
+
+# Changing the "amount" column of the first native table to INTEGER, a migration which can lose data
+def make_lossy(directory):
+    with open(os.path.join(directory, "objects_details.json")) as file:
+        entry = json.load(file)["na_tables_list"][0]
+    with open(entry["schema_json"]) as file:
+        schema = json.load(file)
+    with open(entry["schema_json"], "w") as file:
+        json.dump([dict(col, type="INTEGER") if col["name"] == "amount" else col for col in schema], file)
+    return entry
+
+
+# Removing the "details" column from the schema files of the native tables
+def drop_column(directory):
+    with open(os.path.join(directory, "objects_details.json")) as file:
+        details = json.load(file)
+    for entry in details["na_tables_list"]:
+        with open(entry["schema_json"], "w") as file:
+            json.dump([col for col in SCHEMA if col["name"] != "details"], file)
+
+
+## Refuse -> confirm flow of a lossy migration: the refused table is checked again by the next run (it is not
+## recorded in the state file) and --allow-lossy migrates it. Returns the problems found.
+def check_lossy_confirmation(fake, directory, common):
+
+    entry = make_lossy(directory)
+    table_id = f"{test_code.project_id}.{entry['dataset_name']}.{entry['table_name']}"
+
+    def amount_type():
+        return next(field.field_type for field in fake.get_table(table_id).schema if field.name == "amount")
+
+    problems = []
+    measure(fake, ["apply"] + common)
+    if amount_type() == "INTEGER":
+        problems.append("the lossy migration was applied without --allow-lossy")
+    measure(fake, ["apply"] + common + ["--allow-lossy", f"{entry['dataset_name']}.{entry['table_name']}"])
+    if amount_type() != "INTEGER":
+        problems.append("the lossy migration was not applied with --allow-lossy")
+    return problems
+
+
+## Rewrites of a DAY-partitioned table which requires a partition filter, expires and has column descriptions: BigQuery
+## refuses any query of it without a partition filter (the dry run of the plan included), and the rewritten table has
+## to keep the filter requirement, the expiration and the descriptions. The table is rewritten by a lossy migration,
+## then by the drop of its clustering column, and a rewrite which would remove policy tags is refused.
+## Returns the problems found.
+def check_rewrites(fake, directory, workers):
+
+    dataset_name, table_name = "bench_partitioned", "bench_filtered"
+    table_id = f"{test_code.project_id}.{dataset_name}.{table_name}"
+    schema_json = os.path.join(directory, "schema_files", dataset_name, f"{table_name}.json")
+    os.makedirs(os.path.dirname(schema_json), exist_ok=True)
+    manifest = os.path.join(directory, "partitioned.json")
+    common = ["--manifest", manifest, "--state", os.path.join(directory, "partitioned_state.json"), "--workers", str(workers)]
+
+    def apply(schema, *extra, **layout):
+        with open(schema_json, "w") as file:
+            json.dump(schema, file)
+        entry = {"dataset_name": dataset_name, "table_name": table_name, "schema_json": schema_json, "labels": dict(LABELS),
+                 "time_partitioning": {"type": "DAY", "field": "dtloaded", "require_partition_filter": True},
+                 "expiration_days": 30, **layout}
+        with open(manifest, "w") as file:
+            json.dump({"na_tables_list": [entry], "ex_tables_list": []}, file)
+        measure(fake, ["apply"] + common + list(extra))
+        return fake.get_table(table_id)
+
+    def check_kept(table, step):
+        if not table.require_partition_filter:
+            problems.append(f"the table does not require a partition filter anymore after the {step}")
+        if table.expires is None:
+            problems.append(f"the table does not expire anymore after the {step}")
+        if {field.name: field.description for field in table.schema}.get("dtloaded") != "load date":
+            problems.append(f"the column descriptions were lost by the {step}")
+
+    def column_types(table):
+        return {field.name: field.field_type for field in table.schema}
+
+    problems = []
+    table = apply(SCHEMA, clustering_fields=["details"])
+    table.schema = [bigquery.SchemaField.from_api_repr(dict(field.to_api_repr(), description="load date"))
+                    if field.name == "dtloaded" else field for field in table.schema]
+    fake.update_table(table, ["schema"])
+
+    lossy = [dict(col, type="INTEGER") if col["name"] == "amount" else col for col in SCHEMA]
+    table = apply(lossy, "--allow-lossy", f"{dataset_name}.{table_name}", clustering_fields=["details"])
+    if column_types(table)["amount"] != "INTEGER":
+        problems.append("the lossy migration of a table requiring a partition filter was not applied")
+    check_kept(table, "lossy migration")
+
+    table = apply([col for col in lossy if col["name"] != "details"])
+    if "details" in column_types(table):
+        problems.append("the clustering column of a table requiring a partition filter was not dropped")
+    check_kept(table, "drop of the clustering column")
+
+    table.schema = [bigquery.SchemaField.from_api_repr(dict(field.to_api_repr(), policyTags={"names": ["bench/tag"]}))
+                    if field.name == "amount" else field for field in table.schema]
+    fake.update_table(table, ["schema"])
+    table = apply([dict(col, type="STRING") if col["name"] == "id" else col for col in lossy if col["name"] != "details"])
+    if column_types(table)["id"] != "INTEGER":
+        problems.append("a rewrite removing the policy tags of a column was not refused")
+    return problems
+
+
+## One run of test_code.main (or importer.main) against the fake, returns (seconds, api calls, peak bytes)
+def measure(fake, argv, run=test_code.main):
+
+    manager = ClientManager(test_code.project_id, client_factory=lambda project: fake)
+    calls_before = fake.total_calls
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run(argv, manager=manager)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, fake.total_calls - calls_before, peak
+
+
+def run_size(size, args):
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = generate_manifest(directory, size)
+        state = os.path.join(directory, "bq_state.json")
+        common = ["--manifest", manifest, "--state", state, "--workers", str(args.workers)]
+
+        fake = FakeBigQueryClient(project=test_code.project_id, latency=args.latency, max_qps=args.max_qps,
+                                  job_duration=args.job_duration)
+        scenarios = [
+            ("cold create", ["apply"] + common, None),
+            ("no-op (state)", ["apply"] + common, None),
+            ("no-op (no state)", ["apply", "--no-state"] + common, None),
+            ("drop column", ["apply"] + common + args.extra, drop_column),
+        ]
+        for name, argv, prepare in scenarios:
+            if prepare is not None:
+                prepare(directory)
+            seconds, calls, peak = measure(fake, argv)
+            results.append((size, name, seconds, calls, peak))
+
+        imported = os.path.join(directory, "imported")
+        seconds, calls, peak = measure(fake, ["--manifest-dir", imported, "--schema-dir", imported,
+                                              "--workers", str(args.workers)], run=importer.main)
+        results.append((size, "import", seconds, calls, peak))
+
+        if len(fake.tables) != size:
+            print(f"WARNING: {len(fake.tables)} of {size} tables exist after the cold create.")
+        for problem in check_lossy_confirmation(fake, directory, common) + check_rewrites(fake, directory, args.workers):
+            print(f"WARNING: {problem}.")
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the reconciliation against the in-process fake BigQuery backend, "
+                                                 "other options (e.g. --no-ddl-scripts) are passed to the drop column run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help=f"number of tables of each generated manifest (default {' '.join(map(str, DEFAULT_SIZES))})")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every fake API call takes (default 0)")
+    parser.add_argument("--max-qps", type=int, help="API calls per second the fake allows before answering 429")
+    parser.add_argument("--job-duration", type=float, default=0.0, help="seconds every fake query job runs for (default 0)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"reconciliation workers (default {DEFAULT_WORKERS})")
+    args, args.extra = parser.parse_known_args(argv)
+
+    print(f"{'tables':>8}  {'scenario':<18}{'wall (s)':>10}{'api calls':>11}{'calls/table':>13}{'peak MiB':>10}")
+    for size in args.sizes:
+        for size, name, seconds, calls, peak in run_size(size, args):
+            print(f"{size:>8}  {name:<18}{seconds:>10.2f}{calls:>11}{calls / size:>13.2f}{peak / 2 ** 20:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
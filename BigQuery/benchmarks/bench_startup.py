@@ -0,0 +1,68 @@
+## Startup benchmark of the command line: wall time of fresh interpreter runs (median of --runs) of
+##   validate          python BigQuery/cli.py validate on the manifest, offline and without the cloud SDK
+##   import apply      importing test_code, i.e. the cloud SDK and every module of the reconciliation
+## and a check that validate does not import google.cloud.bigquery.
+##
+## python BigQuery/benchmarks/bench_startup.py --runs 10 --manifest BigQuery/objects_details.json
+
+# [START imports]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+BIGQUERY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_RUNS = 10
+DEFAULT_MANIFEST = os.path.join(BIGQUERY_DIR, "objects_details.json")
+
+# Run by a fresh interpreter, exits with 1 when validate imported the cloud SDK
+SDK_CHECK = """
+import sys
+sys.path.insert(0, {directory!r})
+import cli
+cli.main(["validate", "--manifest", {manifest!r}])
+sys.exit(1 if "google.cloud.bigquery" in sys.modules else 0)
+"""
+
+
+# Median seconds of `runs` fresh runs of the command, its output is discarded
+def time_command(command, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the validate and apply paths of the command line")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help=f"runs of each command (default {DEFAULT_RUNS})")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help="manifest validated by the validate runs")
+    args = parser.parse_args(argv)
+
+    scenarios = [
+        ("interpreter", [sys.executable, "-c", "pass"]),
+        ("validate", [sys.executable, os.path.join(BIGQUERY_DIR, "cli.py"), "validate", "--manifest", args.manifest]),
+        ("import apply", [sys.executable, "-c", f"import sys; sys.path.insert(0, {BIGQUERY_DIR!r}); import test_code"]),
+    ]
+
+    print(f"{'scenario':<16}{'median (s)':>12}")
+    for name, command in scenarios:
+        print(f"{name:<16}{time_command(command, args.runs):>12.3f}")
+
+    check = subprocess.run([sys.executable, "-c", SDK_CHECK.format(directory=BIGQUERY_DIR, manifest=args.manifest)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if check.returncode != 0:
+        print("WARNING: validate imported the cloud SDK.")
+        return 1
+    print("\nvalidate runs without importing the cloud SDK.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# [START imports]
+import threading
+import time
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from telemetry import INSTRUMENTED_METHODS
+
+
+# Upper bound of open connections kept per host and project, it should be >= the number of worker threads
+DEFAULT_POOL_SIZE = 16
+BIGQUERY_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+
+## Connection pool classes which report every new socket back to the ClientManager
+def _counting_pool_classes(on_new_conn):
+
+    class CountingHTTPConnectionPool(HTTPConnectionPool):
+        def _new_conn(self):
+            on_new_conn()
+            return super()._new_conn()
+
+    class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            on_new_conn()
+            return super()._new_conn()
+
+    return {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+
+## HTTPAdapter with a bounded pool, blocking when all the connections are in use instead of opening new ones
+class _CountingAdapter(HTTPAdapter):
+
+    def __init__(self, on_new_conn, pool_size):
+        # init_poolmanager() is called from HTTPAdapter.__init__ so the callback has to be set first
+        self._on_new_conn = on_new_conn
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _counting_pool_classes(self._on_new_conn)
+
+
+## AuthorizedSession which counts how many times an access token had to be fetched
+class _CountingSession(AuthorizedSession):
+
+    def __init__(self, credentials, on_token_refresh, **kwargs):
+        super().__init__(credentials, **kwargs)
+        self._on_token_refresh = on_token_refresh
+        self._last_token = None
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+
+        # The credentials are only refreshed when the cached token is missing or expired
+        token = getattr(self.credentials, "token", None)
+        if token is not None and token != self._last_token:
+            self._last_token = token
+            self._on_token_refresh()
+        return response
+
+
+## Token bucket of one project: up to `rate` API requests per second, with bursts of up to `rate` requests.
+## Every thread using a client of the project takes a token before each request and sleeps when none is left,
+## so a project is kept under its own quota however many projects and locations run at the same time.
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.waits = 0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # The token is taken right away, a negative balance is the time the caller has to wait for it
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waits += wait > 0
+        if wait:
+            time.sleep(wait)
+
+
+## BigQuery client whose API requests wait for the rate limiter of its project
+class _RateLimitedClient:
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in INSTRUMENTED_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            self._limiter.acquire()
+            return attribute(*args, **kwargs)
+        return call
+
+
+## Shared BigQuery client/session manager.
+## Credentials are discovered once and shared by every client, and clients are cached per project so a whole run
+## reuses the same pools and access token. Each project gets a pooled HTTP session of its own: the projects are
+## reconciled at the same time (fan_out), every one with its own workers, and all of them talk to the same host,
+## so a single bounded pool would queue them all behind pool_size sockets.
+## client_factory(project_id), when given, builds the clients instead (e.g. fake_bigquery for benchmarks).
+## With max_qps each project gets its own RateLimiter of that many API requests per second.
+class ClientManager:
+
+    def __init__(self, project_id, pool_size=DEFAULT_POOL_SIZE, credentials=None, client_factory=None, max_qps=None):
+        self.project_id = project_id
+        self.pool_size = pool_size
+        self.max_qps = max_qps
+        self._credentials = credentials
+        self._client_factory = client_factory
+        self._sessions = {}
+        self._clients = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self.stats = {"clients": 0, "sessions": 0, "connections": 0, "token_refreshes": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    # Creating the session of a project, called with self._lock held
+    def _new_session(self):
+        if self._credentials is None:
+            self._credentials, _ = google.auth.default(scopes=BIGQUERY_SCOPES)
+
+        session = _CountingSession(self._credentials, lambda: self._count("token_refreshes"))
+        adapter = _CountingAdapter(lambda: self._count("connections"), self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        self.stats["sessions"] += 1
+        return session
+
+    # Returning the BigQuery client of the project, constructing it only on the first call
+    def get_client(self, project_id=None):
+        project_id = project_id or self.project_id
+        with self._lock:
+            client = self._clients.get(project_id)
+            if client is not None:
+                return client
+
+            if self._client_factory is not None:
+                client = self._client_factory(project_id)
+            else:
+                session = self._sessions[project_id] = self._new_session()
+                client = bigquery.Client(project=project_id, credentials=self._credentials, _http=session)
+            if self.max_qps:
+                self._limiters[project_id] = RateLimiter(self.max_qps)
+                client = _RateLimitedClient(client, self._limiters[project_id])
+
+            self._clients[project_id] = client
+            self.stats["clients"] += 1
+            return client
+
+    @property
+    def client(self):
+        return self.get_client()
+
+    def summary(self):
+        stats = dict(self.stats)
+        if self._limiters:
+            stats["rate_limited_waits"] = sum(limiter.waits for limiter in self._limiters.values())
+        return ", ".join(f"{key}={value}" for key, value in stats.items())
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+            self._clients = {}
@@ -0,0 +1,27 @@
+## Command line of the BigQuery objects tool:
+##   python BigQuery/cli.py validate [--manifest PATH] [--base REF]   offline checks, no cloud SDK import nor credentials
+##   python BigQuery/cli.py plan|apply|watch [options]                 the reconciliation, options of test_code.py
+##   python BigQuery/cli.py import --project ID [--datasets ...]       manifest shards and schema files of existing tables
+## Only the reconciliation imports the cloud SDK (test_code.py and the modules it uses), so validate starts fast.
+
+# [START imports]
+import sys
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    if argv[:1] == ["validate"]:
+        import validate
+        return validate.main(argv[1:])
+
+    if argv[:1] == ["import"]:
+        import importer
+        return importer.main(argv[1:])
+
+    import test_code
+    return test_code.main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# [START imports]
+import re
+from collections.abc import Mapping
+
+
+## External data options of an ex_tables_list entry, all of them optional:
+##   "hive_partitioning": {"mode": "AUTO", "source_uri_prefix": "gs://bucket/inbound/log/delta/",
+##                         "require_partition_filter": true, "partition_keys": ["dtloaded"]},
+##   "format_options": {"skip_leading_rows": 1, "field_delimiter": ","}
+## With hive partitioning the source_uris are usually one wildcard below the prefix ("gs://bucket/.../delta/*"),
+## so one table covers every partition and the partition keys (e.g. dtloaded=2021-10-01) are read from the paths.
+## BigQuery adds the partition key columns to the table itself, they are not part of the schema file.
+HIVE_PARTITIONING_KEYS = ["mode", "source_uri_prefix", "require_partition_filter", "partition_keys"]
+HIVE_PARTITIONING_MODES = ["AUTO", "STRINGS", "CUSTOM"]
+
+# Options of format_options per source_format, and the ones every format accepts
+FORMAT_OPTIONS = {
+    "CSV": ["skip_leading_rows", "field_delimiter", "quote_character", "encoding", "allow_jagged_rows", "allow_quoted_newlines"],
+    "PARQUET": ["enum_as_string", "enable_list_inference"],
+    "AVRO": ["use_avro_logical_types"],
+}
+COMMON_FORMAT_OPTIONS = ["ignore_unknown_values", "max_bad_records", "compression"]
+
+# CREATE EXTERNAL TABLE option names which differ from the format_options names
+DDL_OPTION_NAMES = {"quote_character": "quote", "use_avro_logical_types": "enable_logical_types"}
+
+# Partition keys of a CUSTOM source_uri_prefix, "gs://bucket/delta/{dtloaded:DATE}" has the key dtloaded
+_CUSTOM_KEY = re.compile(r"\{(\w+)(?::(\w+))?\}")
+
+
+# Prefix every source uri has to start with, the CUSTOM key schema is not part of the paths
+def uri_prefix(hive):
+    return hive.get("source_uri_prefix", "").split("{", 1)[0]
+
+
+# Names (lower case) of the hive partition key columns, which BigQuery adds to the table from the paths
+def partition_keys(entry):
+    hive = entry.get("hive_partitioning") or {}
+    keys = list(hive.get("partition_keys", []))
+    if str(hive.get("mode", "AUTO")).upper() == "CUSTOM":
+        keys.extend(name for name, _ in _CUSTOM_KEY.findall(hive.get("source_uri_prefix", "")))
+    return {key.lower() for key in keys}
+
+
+# Columns of a schema without the hive partition key columns, works on schema files and SchemaField lists
+def without_partition_keys(columns, entry):
+    keys = partition_keys(entry)
+    if not keys:
+        return list(columns)
+    return [col for col in columns if (col["name"] if isinstance(col, Mapping) else col.name).lower() not in keys]
+
+
+# Problems of the source uris and external data options of an entry, an empty list means they are valid
+def external_problems(entry):
+
+    problems = []
+    for uri in entry.get("source_uris") or []:
+        if not isinstance(uri, str) or not uri:
+            problems.append("'source_uris' must hold non-empty strings")
+        elif uri.startswith("gs://") and uri.count("*") > 1:
+            problems.append(f"source uri {uri} has more than one '*' wildcard")
+
+    hive = entry.get("hive_partitioning")
+    if hive is not None:
+        if not isinstance(hive, dict):
+            return problems + ["'hive_partitioning' must be an object"]
+        problems.extend(f"unknown hive_partitioning option '{key}'" for key in hive if key not in HIVE_PARTITIONING_KEYS)
+        if str(hive.get("mode", "AUTO")).upper() not in HIVE_PARTITIONING_MODES:
+            problems.append(f"hive_partitioning mode must be one of {', '.join(HIVE_PARTITIONING_MODES)}")
+        if not (isinstance(hive.get("source_uri_prefix"), str) and hive["source_uri_prefix"]):
+            problems.append("hive_partitioning needs a 'source_uri_prefix'")
+        else:
+            prefix = uri_prefix(hive)
+            problems.extend(f"source uri {uri} is not below the source_uri_prefix {prefix}"
+                            for uri in entry.get("source_uris") or [] if isinstance(uri, str) and not uri.startswith(prefix))
+        if not isinstance(hive.get("require_partition_filter", False), bool):
+            problems.append("hive_partitioning 'require_partition_filter' must be true or false")
+        if not isinstance(hive.get("partition_keys", []), list):
+            problems.append("hive_partitioning 'partition_keys' must be a list of column names")
+
+    options = entry.get("format_options")
+    if options is not None:
+        if not isinstance(options, dict):
+            return problems + ["'format_options' must be an object"]
+        allowed = FORMAT_OPTIONS.get(str(entry.get("source_format", "")).upper(), []) + COMMON_FORMAT_OPTIONS
+        problems.extend(f"format option '{key}' is not supported for {entry.get('source_format')} data"
+                        for key in options if key not in allowed)
+    return problems
+
+
+## Setting the hive partitioning and format options of the entry on an ExternalConfig.
+## The cloud SDK is only imported here, the validation of the options runs without it.
+def apply_external_options(external_config, entry):
+    from google.cloud import bigquery
+
+    hive = entry.get("hive_partitioning")
+    if hive:
+        hive_partitioning = bigquery.external_config.HivePartitioningOptions()
+        hive_partitioning.mode = hive.get("mode", "AUTO").upper()
+        hive_partitioning.source_uri_prefix = hive["source_uri_prefix"]
+        if "require_partition_filter" in hive:
+            hive_partitioning.require_partition_filter = hive["require_partition_filter"]
+        external_config.hive_partitioning = hive_partitioning
+
+    for key, value in (entry.get("format_options") or {}).items():
+        # ignore_unknown_values, max_bad_records and compression belong to the config itself
+        setattr(external_config if key in COMMON_FORMAT_OPTIONS else external_config.options, key, value)
+    return external_config
+
+
+# Parts of the external data configuration set by the options (e.g. csvOptions, hivePartitioningOptions)
+def _option_reprs(external_config):
+    resource = external_config.to_api_repr() if external_config is not None else {}
+    return {key: value for key, value in resource.items() if key not in ("sourceFormat", "sourceUris", "schema", "autodetect")}
+
+
+## Options of the current external data configuration which differ from the updated one, as "name: current -> new".
+## Only the option values set in the manifest are compared, BigQuery returns the defaults of the others.
+def external_option_changes(current_config, updated_config):
+
+    current, updated = _option_reprs(current_config), _option_reprs(updated_config)
+    changes = []
+    if "hivePartitioningOptions" in current and "hivePartitioningOptions" not in updated:
+        changes.append("hivePartitioningOptions: removed")
+    for key, value in updated.items():
+        current_value = current.get(key)
+        if isinstance(value, dict):
+            current_value = current_value or {}
+            changes.extend(f"{key}.{name}: {current_value.get(name)} -> {sub_value}"
+                           for name, sub_value in value.items() if current_value.get(name) != sub_value)
+        elif current_value != value:
+            changes.append(f"{key}: {current_value} -> {value}")
+    return changes
+
+
+# OPTIONS of a CREATE EXTERNAL TABLE statement for the hive partitioning and format options of the entry
+def ddl_options(entry):
+
+    options = {}
+    hive = entry.get("hive_partitioning")
+    if hive:
+        options["hive_partition_uri_prefix"] = uri_prefix(hive)
+        if "require_partition_filter" in hive:
+            options["require_hive_partition_filter"] = hive["require_partition_filter"]
+    for key, value in (entry.get("format_options") or {}).items():
+        options[DDL_OPTION_NAMES.get(key, key)] = value
+    return options
+
+
+# WITH PARTITION COLUMNS clause of a CREATE EXTERNAL TABLE statement, empty without hive partitioning.
+# The keys are detected from the paths, except in CUSTOM mode where they are typed in the prefix.
+def ddl_partition_columns(entry):
+    hive = entry.get("hive_partitioning")
+    if not hive:
+        return ""
+    if str(hive.get("mode", "AUTO")).upper() != "CUSTOM":
+        return "WITH PARTITION COLUMNS"
+    columns = [f"`{name}` {data_type or 'STRING'}" for name, data_type in _CUSTOM_KEY.findall(hive["source_uri_prefix"])]
+    return f"WITH PARTITION COLUMNS ({', '.join(columns)})"
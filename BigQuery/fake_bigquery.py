@@ -0,0 +1,487 @@
+# [START imports]
+import collections
+import copy
+import datetime
+import json
+import re
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, NotFound, TooManyRequests
+from google.cloud import bigquery
+
+
+# Legacy type names the tables API returns for the standard SQL names used in DDL
+_LEGACY_TYPES = {"INT64": "INTEGER", "FLOAT64": "FLOAT", "BOOL": "BOOLEAN", "STRUCT": "RECORD"}
+
+
+# (index, char, bracket depth) of the characters of text outside of string literals and quoted names
+def _unquoted(text):
+    depth, quote, escaped = 0, None, False
+    for index, char in enumerate(text):
+        if escaped:
+            escaped = False
+        elif quote and char == "\\":
+            escaped = True
+        elif quote:
+            quote = None if char == quote else quote
+        elif char in "'\"`":
+            quote = char
+        else:
+            if char in "<([":
+                depth += 1
+            elif char in ">)]":
+                depth -= 1
+            yield index, char, depth
+
+
+def _split_top_level(text):
+    parts, start = [], 0
+    for index, char, depth in _unquoted(text):
+        if char == "," and depth == 0:
+            parts.append(text[start:index].strip())
+            start = index + 1
+    if text[start:].strip():
+        parts.append(text[start:].strip())
+    return parts
+
+
+# Closing bracket matching the opening one at text[start]
+def _matching(text, start):
+    for index, char, depth in _unquoted(text[start:]):
+        if char in ">)]" and depth == 0:
+            return start + index
+    raise BadRequest(f"Unbalanced brackets in: {text}")
+
+
+def _parse_type(text):
+    text = text.strip()
+    upper = text.upper()
+    if upper.startswith("ARRAY<"):
+        field_type, _, fields = _parse_type(text[6:-1])
+        return field_type, "REPEATED", fields
+    if upper.startswith("STRUCT<"):
+        return "RECORD", "NULLABLE", [_parse_column(part) for part in _split_top_level(text[7:-1])]
+    return _LEGACY_TYPES.get(upper, upper), "NULLABLE", None
+
+
+# "`name` TYPE [NOT NULL] [OPTIONS(description=...)]" -> {"name", "type", "mode", "fields", "description"}
+def _parse_column(text):
+    match = re.match(r"`([^`]+)`\s+(.*)$", text.strip(), re.S)
+    if not match:
+        raise BadRequest(f"Invalid column definition: {text}")
+    type_text = match.group(2).strip()
+    options = {}
+    if type_text.endswith(")"):
+        start = max(index for index, char, depth in _unquoted(type_text) if char == "(" and depth == 1)
+        if type_text[:start].endswith("OPTIONS"):
+            options = _parse_options(type_text[start + 1:-1])
+            type_text = type_text[:start - len("OPTIONS")].strip()
+    not_null = type_text.upper().endswith("NOT NULL")
+    if not_null:
+        type_text = type_text[:-len("NOT NULL")]
+    field_type, mode, fields = _parse_type(type_text)
+    col = {"name": match.group(1), "type": field_type, "mode": "REQUIRED" if not_null else mode}
+    if fields:
+        col["fields"] = fields
+    if options.get("description"):
+        col["description"] = options["description"]
+    return col
+
+
+# Value of an option in DDL: a string, a bool, a number, a timestamp or a list of (key, value) labels
+def _option_value(text):
+    text = text.strip()
+    if text.upper().startswith("TIMESTAMP "):
+        return datetime.datetime.fromisoformat(json.loads(text[len("TIMESTAMP "):]))
+    if text in ("true", "false"):
+        return text == "true"
+    if text.startswith("["):
+        return {json.loads(key): json.loads(value)
+                for key, value in re.findall(r'\(("(?:[^"\\]|\\.)*"), ("(?:[^"\\]|\\.)*")\)', text)}
+    if text.startswith('"'):
+        return json.loads(text)
+    return float(text)
+
+
+# OPTIONS(...) of a CREATE TABLE statement after its column list, as {option name: value}
+def _table_options(text):
+    query = re.search(r"\bAS SELECT\b", text)
+    head = text[:query.start()] if query else text
+    match = re.search(r"\bOPTIONS\(", head)
+    if not match:
+        return {}
+    return _parse_options(head[match.end():_matching(head, match.end() - 1)])
+
+
+# "name=value, ..." of an OPTIONS(...) list
+def _parse_options(text):
+    options = {}
+    for option in _split_top_level(text):
+        name, _, value = option.partition("=")
+        options[name.strip()] = _option_value(value)
+    return options
+
+
+# Statements of a script with the line each one starts on, ';' inside quotes or backticks does not split
+def _split_statements(sql):
+    statements, current, quote, escaped, line, start_line = [], [], None, False, 1, 1
+    for char in sql:
+        if escaped:
+            escaped = False
+        elif quote and char == "\\":
+            escaped = True
+        elif quote:
+            quote = None if char == quote else quote
+        elif char in "'\"`":
+            quote = char
+        elif char == ";":
+            if "".join(current).strip():
+                statements.append((start_line, "".join(current).strip()))
+            current, start_line = [], line
+            continue
+        if char == "\n":
+            line += 1
+            if not "".join(current).strip():
+                start_line = line
+                current = []
+                continue
+        current.append(char)
+    if "".join(current).strip():
+        statements.append((start_line, "".join(current).strip()))
+    return statements
+
+
+## Minimal query job. The DDL runs when the job is created, the job itself is done `duration` seconds later
+## and every done() call on a running job is a jobs.get request, like a real job being polled.
+class FakeQueryJob:
+
+    def __init__(self, sql, total_bytes_processed=0, error=None, dry_run=False, client=None, duration=0.0):
+        self.job_id = f"fake_{uuid.uuid4().hex}"
+        self.query = sql
+        self.dry_run = dry_run
+        self.total_bytes_processed = total_bytes_processed
+        self.slot_millis = int(duration * 1000)
+        self.state = "RUNNING" if duration else "DONE"
+        self._client = client
+        self._done_at = time.monotonic() + duration
+        self._error = error
+        self.error_result = {"reason": "invalidQuery", "message": str(error)} if error else None
+        self.errors = [self.error_result] if error else None
+
+    def done(self, *args, **kwargs):
+        if self.state != "DONE":
+            if self._client is not None:
+                self._client._call("get_job")
+            if time.monotonic() >= self._done_at:
+                self.state = "DONE"
+        return self.state == "DONE"
+
+    def reload(self, *args, **kwargs):
+        self.done()
+        return self
+
+    def exception(self, *args, **kwargs):
+        return self._error
+
+    def result(self, *args, **kwargs):
+        while not self.done():
+            time.sleep(max(0.0, min(0.05, self._done_at - time.monotonic())))
+        if self._error:
+            raise self._error
+        return []
+
+
+## In-process stand-in for bigquery.Client, implementing the calls this tool makes:
+## datasets (get/create), tables (get/create/update/delete/list) and DDL through query().
+## `latency` is the seconds every call sleeps (a float, or a dict per method name), `max_qps` limits
+## the calls per second of the whole client and `table_update_limit` the (updates, seconds) per table,
+## both answered with the same errors as BigQuery. Query jobs run for `job_duration` seconds and a
+## multi-statement script stops at its first failing statement. `calls` counts the calls per method.
+class FakeBigQueryClient:
+
+    def __init__(self, project="fake-project", latency=0.0, max_qps=None, table_update_limit=(5, 10.0), location="US",
+                 job_duration=0.0):
+        self.project = project
+        self.job_duration = job_duration
+        self.location = location
+        self.latency = latency
+        self.max_qps = max_qps
+        self.table_update_limit = table_update_limit
+        self.datasets = {}
+        self.tables = {}
+        self.calls = collections.Counter()
+        self._recent_calls = collections.deque()
+        self._table_updates = collections.defaultdict(collections.deque)
+        self._lock = threading.RLock()
+
+    # Counting, rate limiting and delaying one API call
+    def _call(self, method):
+        now = time.monotonic()
+        with self._lock:
+            self.calls[method] += 1
+            if self.max_qps:
+                while self._recent_calls and now - self._recent_calls[0] > 1.0:
+                    self._recent_calls.popleft()
+                if len(self._recent_calls) >= self.max_qps:
+                    raise TooManyRequests(f"Exceeded rate limits: too many api requests per second ({method})")
+                self._recent_calls.append(now)
+
+        latency = self.latency.get(method, 0.0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            time.sleep(latency)
+
+    def _count_table_update(self, table_id):
+        if not self.table_update_limit:
+            return
+        limit, window = self.table_update_limit
+        now = time.monotonic()
+        updates = self._table_updates[table_id]
+        while updates and now - updates[0] > window:
+            updates.popleft()
+        if len(updates) >= limit:
+            raise Forbidden(f"Exceeded rate limits: too many table update operations for this table {table_id}",
+                            errors=[{"reason": "rateLimitExceeded"}])
+        updates.append(now)
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _table_id(self, table):
+        if isinstance(table, str):
+            return table if table.count(".") == 2 else f"{self.project}.{table}"
+        return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    def _dataset_id(self, dataset):
+        if isinstance(dataset, str):
+            return dataset if "." in dataset else f"{self.project}.{dataset}"
+        return f"{dataset.project}.{dataset.dataset_id}"
+
+    def _new_etag(self):
+        return uuid.uuid4().hex[:16]
+
+    def _stored(self, table_id):
+        resource = self.tables.get(table_id)
+        if resource is None:
+            raise NotFound(f"Not found: Table {table_id}")
+        return resource
+
+    def _touch(self, resource):
+        resource["etag"] = self._new_etag()
+        resource["lastModifiedTime"] = str(int(time.time() * 1000))
+
+    # ---- datasets ----------------------------------------------------------------------------
+
+    def get_dataset(self, dataset_ref, **kwargs):
+        self._call("get_dataset")
+        dataset_id = self._dataset_id(dataset_ref)
+        with self._lock:
+            resource = self.datasets.get(dataset_id)
+            if resource is None:
+                raise NotFound(f"Not found: Dataset {dataset_id}")
+            return bigquery.Dataset.from_api_repr(copy.deepcopy(resource))
+
+    def create_dataset(self, dataset, exists_ok=False, **kwargs):
+        self._call("create_dataset")
+        if isinstance(dataset, str):
+            dataset = bigquery.Dataset(self._dataset_id(dataset))
+        dataset_id = self._dataset_id(dataset)
+        with self._lock:
+            if dataset_id in self.datasets:
+                if exists_ok:
+                    return bigquery.Dataset.from_api_repr(copy.deepcopy(self.datasets[dataset_id]))
+                raise Conflict(f"Already Exists: Dataset {dataset_id}")
+            resource = copy.deepcopy(dataset.to_api_repr())
+            resource.setdefault("location", self.location)
+            self._touch(resource)
+            self.datasets[dataset_id] = resource
+            return bigquery.Dataset.from_api_repr(copy.deepcopy(resource))
+
+    def list_datasets(self, project=None, **kwargs):
+        self._call("list_datasets")
+        with self._lock:
+            return [bigquery.Dataset.from_api_repr(copy.deepcopy(resource)) for _, resource in sorted(self.datasets.items())]
+
+    # ---- tables ------------------------------------------------------------------------------
+
+    def list_tables(self, dataset, page_size=None, **kwargs):
+        self._call("list_tables")
+        dataset_id = self._dataset_id(dataset)
+        with self._lock:
+            if dataset_id not in self.datasets:
+                raise NotFound(f"Not found: Dataset {dataset_id}")
+            items = [bigquery.table.TableListItem(copy.deepcopy(resource))
+                     for table_id, resource in sorted(self.tables.items()) if table_id.rsplit(".", 1)[0] == dataset_id]
+        # One more call per extra page, like the real paginated listing
+        pages = (len(items) - 1) // (page_size or 50) if items else 0
+        for _ in range(pages):
+            self._call("list_tables")
+        return items
+
+    def get_table(self, table, **kwargs):
+        self._call("get_table")
+        with self._lock:
+            return bigquery.Table.from_api_repr(copy.deepcopy(self._stored(self._table_id(table))))
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        self._call("create_table")
+        table_id = self._table_id(table)
+        with self._lock:
+            if table_id.rsplit(".", 1)[0] not in self.datasets:
+                raise NotFound(f"Not found: Dataset {table_id.rsplit('.', 1)[0]}")
+            if table_id in self.tables:
+                if exists_ok:
+                    return bigquery.Table.from_api_repr(copy.deepcopy(self.tables[table_id]))
+                raise Conflict(f"Already Exists: Table {table_id}")
+            resource = copy.deepcopy(table.to_api_repr())
+            resource["type"] = "EXTERNAL" if "externalDataConfiguration" in resource else "TABLE"
+            resource["creationTime"] = str(int(time.time() * 1000))
+            resource.setdefault("numBytes", "0")
+            self._touch(resource)
+            self.tables[table_id] = resource
+            return bigquery.Table.from_api_repr(copy.deepcopy(resource))
+
+    # PATCH semantics: only the given fields change, label keys set to None are removed
+    def update_table(self, table, fields, retry=None, **kwargs):
+        self._call("update_table")
+        table_id = self._table_id(table)
+        patch = table._build_resource(fields)
+        with self._lock:
+            resource = self._stored(table_id)
+            if table.etag and table.etag != resource["etag"]:
+                raise BadRequest(f"Precondition check failed: etag mismatch for {table_id}")
+            self._count_table_update(table_id)
+            for key, value in patch.items():
+                if key == "labels":
+                    labels = resource.setdefault("labels", {})
+                    for label, label_value in (value or {}).items():
+                        if label_value is None:
+                            labels.pop(label, None)
+                        else:
+                            labels[label] = label_value
+                elif value is None:
+                    resource.pop(key, None)
+                else:
+                    resource[key] = copy.deepcopy(value)
+            self._touch(resource)
+            return bigquery.Table.from_api_repr(copy.deepcopy(resource))
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        self._call("delete_table")
+        table_id = self._table_id(table)
+        with self._lock:
+            if table_id not in self.tables:
+                if not_found_ok:
+                    return
+                raise NotFound(f"Not found: Table {table_id}")
+            del self.tables[table_id]
+
+    # ---- queries -----------------------------------------------------------------------------
+
+    # BigQuery refuses any query (dry runs included) of a table which requires a partition filter,
+    # unless it filters on the partitioning column
+    def _check_partition_filter(self, sql):
+        for table_id, where in re.findall(r"FROM `([^`]+)`(?:\s+WHERE\s+(.*))?", sql, re.S):
+            resource = self.tables.get(table_id, {})
+            time_partitioning = resource.get("timePartitioning") or {}
+            if not (resource.get("requirePartitionFilter") or time_partitioning.get("requirePartitionFilter")):
+                continue
+            field = (resource.get("rangePartitioning") or {}).get("field") or time_partitioning.get("field") or "_PARTITIONTIME"
+            if not re.search(rf"\b{re.escape(field)}\b", where or "", re.I):
+                raise BadRequest(f"Cannot query over table '{table_id}' without a filter over column(s) '{field}' "
+                                 f"that can be used for partition elimination")
+
+    def query(self, sql, job_config=None, **kwargs):
+        self._call("query")
+        dry_run = bool(job_config is not None and job_config.dry_run)
+        with self._lock:
+            scanned = sum(int(self.tables.get(table_id, {}).get("numBytes", 0))
+                          for table_id in re.findall(r"FROM `([^`]+)`", sql))
+            if dry_run:
+                self._check_partition_filter(sql)
+                return FakeQueryJob(sql, scanned, dry_run=True)
+
+            statements = _split_statements(sql)
+            for line, statement in statements:
+                try:
+                    self._check_partition_filter(statement)
+                    self._run_ddl(statement)
+                except (BadRequest, NotFound) as e:
+                    if len(statements) > 1:
+                        e = BadRequest(f"{e.message} at [{line}:1]")
+                    return FakeQueryJob(sql, error=e, client=self, duration=self.job_duration)
+            return FakeQueryJob(sql, scanned, client=self, duration=self.job_duration)
+
+    def _run_ddl(self, sql):
+        match = re.match(r"ALTER TABLE `([^`]+)` (.*)$", sql, re.S)
+        if match:
+            return self._alter_table(match.group(1), match.group(2))
+
+        match = re.match(r"CREATE OR REPLACE (EXTERNAL )?TABLE `([^`]+)`\s*(.*)$", sql, re.S)
+        if not match:
+            raise BadRequest(f"Unsupported statement in the fake backend: {sql[:80]}")
+        external, table_id, rest = match.groups()
+
+        columns = None
+        if rest.startswith("("):
+            end = _matching(rest, 0)
+            columns = [_parse_column(part) for part in _split_top_level(rest[1:end])]
+            rest = rest[end + 1:]
+
+        resource = self.tables.get(table_id)
+        if resource is None:
+            dataset_id = table_id.rsplit(".", 1)[0]
+            if dataset_id not in self.datasets:
+                raise NotFound(f"Not found: Dataset {dataset_id}")
+            project, dataset, table = table_id.split(".")
+            resource = {"tableReference": {"projectId": project, "datasetId": dataset, "tableId": table},
+                        "type": "EXTERNAL" if external else "TABLE", "numBytes": "0"}
+            self.tables[table_id] = resource
+
+        if columns is None:
+            # CREATE OR REPLACE TABLE ... AS SELECT * EXCEPT (cols)
+            excepted = re.search(r"EXCEPT \(([^)]*)\)", rest)
+            dropped = {name.strip(" `").lower() for name in excepted.group(1).split(",")} if excepted else set()
+            columns = [col for col in resource.get("schema", {}).get("fields", []) if col["name"].lower() not in dropped]
+
+        resource["schema"] = {"fields": columns}
+        if not external:
+            # The replaced table only has the options given again
+            options = _table_options(rest)
+            if "expiration_timestamp" in options:
+                options["expiration_timestamp"] = str(int(options["expiration_timestamp"].timestamp() * 1000))
+            for key, option in [("description", "description"), ("labels", "labels"),
+                                ("requirePartitionFilter", "require_partition_filter"), ("expirationTime", "expiration_timestamp")]:
+                resource.pop(key, None)
+                if option in options:
+                    resource[key] = options[option]
+        if external:
+            source_format = re.search(r'format = "([^"]+)"', rest)
+            uris = re.search(r"uris = \[([^\]]*)\]", rest)
+            config = resource.setdefault("externalDataConfiguration", {})
+            if source_format:
+                config["sourceFormat"] = source_format.group(1)
+            if uris:
+                config["sourceUris"] = re.findall(r'"([^"]+)"', uris.group(1))
+        self._touch(resource)
+
+    def _alter_table(self, table_id, clauses):
+        resource = self._stored(table_id)
+        fields = resource.setdefault("schema", {}).setdefault("fields", [])
+        for clause in _split_top_level(clauses):
+            match = re.match(r"DROP COLUMN (IF EXISTS )?`([^`]+)`$", clause)
+            if match:
+                fields[:] = [col for col in fields if col["name"].lower() != match.group(2).lower()]
+                continue
+            match = re.match(r"ALTER COLUMN `([^`]+)` (SET DATA TYPE (.+)|DROP NOT NULL)$", clause)
+            if not match:
+                raise BadRequest(f"Unsupported ALTER TABLE clause in the fake backend: {clause}")
+            for col in fields:
+                if col["name"].lower() == match.group(1).lower():
+                    if match.group(3):
+                        col["type"] = _parse_type(match.group(3))[0]
+                    else:
+                        col["mode"] = "NULLABLE"
+        self._touch(resource)
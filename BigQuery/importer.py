@@ -0,0 +1,266 @@
+## Reverse import of an existing project: one manifest shard per dataset and one schema file per table.
+##   python BigQuery/cli.py import --project gcp-project-314410 [--datasets demo_dataset_0 ...] [--workers 16]
+## Layout, stable from one run to the next:
+##   BigQuery/manifests/<project>/<dataset>.json                 entries sorted by table name (objects_details format)
+##   BigQuery/schema_files/<project>/<dataset>/<table>.json      nested RECORD fields included
+## The datasets are listed concurrently and their tables fetched concurrently on one shared pool, every finished
+## table is appended to <dataset>.json.partial, so an interrupted import resumes where it stopped: imported datasets
+## are skipped and the tables of the journal are not fetched again.
+
+# [START imports]
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from bq_client import DEFAULT_POOL_SIZE, ClientManager
+from external import COMMON_FORMAT_OPTIONS, FORMAT_OPTIONS
+from inventory import LIST_TABLES_PAGE_SIZE
+from layout import DAY_MS
+from reconcile import DEFAULT_WORKERS
+from test_code import connect, project_id, schema_field_to_dict
+
+
+DEFAULT_MANIFEST_DIR = "BigQuery/manifests"
+DEFAULT_SCHEMA_DIR = "BigQuery/schema_files"
+# Table types the manifest can describe, views and materialized views are left out
+IMPORTED_TABLE_TYPES = ["TABLE", "EXTERNAL"]
+JOURNAL_SUFFIX = ".partial"
+
+
+# Writing a JSON file atomically, an interrupted import never leaves a truncated file behind
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2)
+        file.write("\n")
+    os.replace(tmp_path, path)
+
+
+# Entries of an interrupted import of a dataset, a line cut off by the interruption is dropped
+def read_journal(path):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path) as file:
+        for line in file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+    return entries
+
+
+# Days of a duration in ms, as an int when it is a whole number of days
+def _days(ms):
+    days = int(ms) / DAY_MS
+    return int(days) if days == int(days) else days
+
+
+## Hive partitioning and format options of an external data configuration, in the manifest format (external.py)
+def external_options(external_config):
+
+    options = {"source_format": external_config.source_format, "source_uris": list(external_config.source_uris or [])}
+
+    hive = external_config.to_api_repr().get("hivePartitioningOptions")
+    if hive:
+        options["hive_partitioning"] = {"mode": hive.get("mode", "AUTO"), "source_uri_prefix": hive.get("sourceUriPrefix")}
+        if hive.get("requirePartitionFilter") is not None:
+            options["hive_partitioning"]["require_partition_filter"] = hive["requirePartitionFilter"]
+        if hive.get("fields"):
+            options["hive_partitioning"]["partition_keys"] = list(hive["fields"])
+
+    format_options = {}
+    format_config = external_config.options
+    for key in FORMAT_OPTIONS.get(external_config.source_format, []):
+        if format_config is not None and getattr(format_config, key, None) is not None:
+            format_options[key] = getattr(format_config, key)
+    for key in COMMON_FORMAT_OPTIONS:
+        if getattr(external_config, key, None) is not None:
+            format_options[key] = getattr(external_config, key)
+    if format_options:
+        options["format_options"] = format_options
+    return options
+
+
+## Manifest entry and schema file columns of one table, the layout options are the ones layout.py applies
+def table_entry(table, project, location, schema_path):
+
+    entry = {"project": project, "location": location, "dataset_name": table.dataset_id, "table_name": table.table_id,
+             "schema_json": schema_path, "labels": dict(sorted((table.labels or {}).items()))}
+    columns = [schema_field_to_dict(field) for field in table.schema]
+
+    if table.description:
+        entry["description"] = table.description
+
+    if table.table_type == "EXTERNAL":
+        entry.update(external_options(table.external_data_configuration))
+        # BigQuery adds the hive partition key columns, they stay out of the schema file
+        keys = {key.lower() for key in entry.get("hive_partitioning", {}).get("partition_keys", [])}
+        columns = [col for col in columns if col["name"].lower() not in keys]
+        return entry, columns
+
+    if table.time_partitioning is not None:
+        partitioning = {"type": table.time_partitioning.type_}
+        if table.time_partitioning.field:
+            partitioning["field"] = table.time_partitioning.field
+        if table.time_partitioning.expiration_ms:
+            partitioning["expiration_days"] = _days(table.time_partitioning.expiration_ms)
+        if table.require_partition_filter:
+            partitioning["require_partition_filter"] = True
+        entry["time_partitioning"] = partitioning
+    if table.range_partitioning is not None:
+        range_ = table.range_partitioning.range_
+        entry["range_partitioning"] = {"field": table.range_partitioning.field, "start": range_.start,
+                                       "end": range_.end, "interval": range_.interval}
+    if table.clustering_fields:
+        entry["clustering_fields"] = list(table.clustering_fields)
+    return entry, columns
+
+
+## Importing datasets into manifest shards and schema files, `workers` datasets are listed and `workers` tables
+## are fetched at the same time. A dataset thread only lists its tables, queues them on the shared table pool and
+## writes its journal and shard, so the table pool stays busy across dataset boundaries.
+class Importer:
+
+    def __init__(self, client, project, manifest_dir, schema_dir, workers=DEFAULT_WORKERS, force=False):
+        self.client = client
+        self.project = project
+        self.manifest_dir = manifest_dir
+        self.schema_dir = schema_dir
+        self.force = force
+        self.workers = max(1, workers)
+        self.stats = {"datasets": 0, "skipped_datasets": 0, "tables": 0, "resumed": 0, "views": 0, "failed": 0}
+        self._tables = ThreadPoolExecutor(max_workers=self.workers)
+        self._lock = threading.Lock()
+
+    def _count(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def shard_path(self, dataset_name):
+        return os.path.join(self.manifest_dir, f"{dataset_name}.json")
+
+    def schema_path(self, dataset_name, table_name):
+        return os.path.join(self.schema_dir, dataset_name, f"{table_name}.json")
+
+    # Fetching one table and writing its schema file, returns its manifest entry
+    def import_table(self, table_id, location):
+        table = self.client.get_table(table_id)  # Make an API request.
+        schema_path = self.schema_path(table.dataset_id, table.table_id)
+        entry, columns = table_entry(table, self.project, location, schema_path)
+        write_json(schema_path, columns)
+        return entry
+
+    ## Importing one dataset: its tables not in the journal yet are fetched concurrently, then the shard is written
+    ## with every entry sorted by table name and the journal is removed.
+    def import_dataset(self, dataset_name):
+
+        shard_path = self.shard_path(dataset_name)
+        journal_path = shard_path + JOURNAL_SUFFIX
+        if os.path.exists(shard_path) and not self.force:
+            if os.path.exists(journal_path):
+                os.remove(journal_path)
+            self._count(skipped_datasets=1)
+            return f"{dataset_name}: already imported, skipped"
+
+        dataset = self.client.get_dataset(f"{self.project}.{dataset_name}")  # Make an API request.
+        items = self.client.list_tables(dataset, page_size=LIST_TABLES_PAGE_SIZE)  # Make an API request.
+
+        entries = {entry["table_name"]: entry for entry in read_journal(journal_path)}
+        resumed = len(entries)
+        views = failed = 0
+        futures = {}
+        for item in items:
+            if item.table_type not in IMPORTED_TABLE_TYPES:
+                views += 1
+            elif item.table_id not in entries:
+                table_id = f"{self.project}.{dataset_name}.{item.table_id}"
+                futures[self._tables.submit(self.import_table, table_id, dataset.location)] = table_id
+
+        os.makedirs(os.path.dirname(journal_path) or ".", exist_ok=True)
+        with open(journal_path, "a") as journal:
+            for future in as_completed(futures):
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    print(f"WARNING: Unable to import {futures[future]}.\n", e)
+                    failed += 1
+                    continue
+                entries[entry["table_name"]] = entry
+                journal.write(json.dumps(entry) + "\n")
+                journal.flush()
+
+        self._count(resumed=resumed, views=views, failed=failed)
+        if failed:
+            # The journal keeps the imported tables, the next run fetches only the failed ones
+            return f"{dataset_name}: {failed} table/s failed, run the import again to resume"
+
+        shard = {"na_tables_list": [], "ex_tables_list": []}
+        for table_name in sorted(entries):
+            entry = entries[table_name]
+            shard["ex_tables_list" if "source_format" in entry else "na_tables_list"].append(entry)
+        write_json(shard_path, shard)
+        os.remove(journal_path)
+
+        self._count(datasets=1, tables=len(entries))
+        return (f"{dataset_name}: {len(entries)} table/s imported ({resumed} resumed), "
+                f"{views} view/s left out, location {dataset.location}")
+
+    # Importing one dataset on a dataset thread, a failure is reported and the other datasets go on
+    def _import_dataset(self, dataset_name):
+        try:
+            return self.import_dataset(dataset_name)
+        except Exception as e:
+            self._count(failed=1)
+            return f"WARNING: Unable to import the dataset {dataset_name}, run the import again to resume.\n {e}"
+
+    ## Importing the datasets concurrently, each one is reported as soon as its shard is written
+    def run(self, dataset_names=None):
+        if dataset_names is None:
+            dataset_names = sorted(dataset.dataset_id for dataset in self.client.list_datasets(self.project))  # Make an API request.
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as datasets:
+                for future in as_completed([datasets.submit(self._import_dataset, name) for name in dataset_names]):
+                    print(future.result())
+        finally:
+            self._tables.shutdown(wait=True)
+
+    def summary(self):
+        return ", ".join(f"{key}={value}" for key, value in self.stats.items())
+
+
+## manager, when given, is used instead of a ClientManager of the live project (see benchmarks/)
+def main(argv=None, manager=None):
+
+    parser = argparse.ArgumentParser(description="Import the tables of an existing project into manifest shards and schema files")
+    parser.add_argument("--project", default=project_id, help=f"project to import (default {project_id})")
+    parser.add_argument("--datasets", nargs="+", metavar="DATASET", help="datasets to import (default every dataset of the project)")
+    parser.add_argument("--manifest-dir", default=DEFAULT_MANIFEST_DIR,
+                        help=f"directory of the manifest shards, one subdirectory per project (default {DEFAULT_MANIFEST_DIR})")
+    parser.add_argument("--schema-dir", default=DEFAULT_SCHEMA_DIR,
+                        help=f"directory of the schema files, one subdirectory per project (default {DEFAULT_SCHEMA_DIR})")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"number of tables fetched concurrently (default {DEFAULT_WORKERS})")
+    parser.add_argument("--max-qps", type=float, help="API requests per second allowed for the project (default unlimited)")
+    parser.add_argument("--force", action="store_true", help="import the datasets again even if their shard already exists")
+    args = parser.parse_args(argv)
+
+    if manager is None:
+        manager = ClientManager(args.project, pool_size=max(args.workers, DEFAULT_POOL_SIZE), max_qps=args.max_qps)
+    client = connect(manager, args.project)
+    if client is None:
+        return 1
+
+    start = time.perf_counter()
+    importer = Importer(client, args.project, os.path.join(args.manifest_dir, args.project),
+                        os.path.join(args.schema_dir, args.project), workers=args.workers, force=args.force)
+    importer.run(args.datasets)
+    print(f"\nImport of {args.project}:- {importer.summary()}, in {time.perf_counter() - start:.2f}s\n"
+          f"BigQuery client usage:- {manager.summary()}\n")
+    manager.close()
+    return 1 if importer.stats["failed"] else 0
@@ -0,0 +1,156 @@
+# [START imports]
+import json
+import os
+import threading
+import time
+
+from google.api_core.exceptions import NotFound
+
+
+# Cached table lists older than this are listed again even if the dataset etag did not change.
+# Creating or deleting a table does not change the dataset etag, so a cached table list is only a hint:
+# a table BigQuery disagrees about (Conflict on create, NotFound on get) gets its dataset listed again (relist).
+DEFAULT_MAX_AGE = 3600
+# Largest page the tables.list API returns, fewer pages means fewer round trips on big datasets
+LIST_TABLES_PAGE_SIZE = 1000
+
+
+## Snapshot of the datasets and tables of a project which objects_details refers to.
+## Membership checks are set lookups, and the snapshot can be saved to a local file and
+## revalidated on the next run with one get_dataset call per dataset instead of a full listing.
+class Inventory:
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.datasets = set()
+        self.tables = {}
+        self._meta = {}
+        self._lock = threading.Lock()
+
+    def has_dataset(self, dataset_name):
+        return dataset_name in self.datasets
+
+    def has_table(self, dataset_name, table_name):
+        return table_name in self.tables.get(dataset_name, ())
+
+    def add_dataset(self, dataset_name):
+        with self._lock:
+            self.datasets.add(dataset_name)
+            self.tables.setdefault(dataset_name, set())
+
+    def add_table(self, dataset_name, table_name):
+        with self._lock:
+            self.tables.setdefault(dataset_name, set()).add(table_name)
+
+    def discard_dataset(self, dataset_name):
+        with self._lock:
+            self.datasets.discard(dataset_name)
+            self.tables.pop(dataset_name, None)
+            self._meta.pop(dataset_name, None)
+
+    # Recording a dataset fetched by _fetch_dataset
+    def record(self, dataset_name, etag, tables, fetched_at):
+        with self._lock:
+            self.datasets.add(dataset_name)
+            self.tables[dataset_name] = tables
+            self._meta[dataset_name] = {"etag": etag, "fetched_at": fetched_at}
+
+    # Writing the snapshot as JSON, datasets are written in sorted order to keep the file diff friendly
+    def save(self, path):
+        snapshot = {"project_id": self.project_id, "datasets": {}}
+        with self._lock:
+            for dataset_name in sorted(self.datasets):
+                meta = self._meta.get(dataset_name, {})
+                snapshot["datasets"][dataset_name] = {
+                    "etag": meta.get("etag"),
+                    "fetched_at": meta.get("fetched_at", time.time()),
+                    "tables": sorted(self.tables.get(dataset_name, ())),
+                }
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(tmp_path, path)
+
+
+# Reading a saved snapshot, a missing or unreadable file or another project's snapshot is ignored
+def _read_snapshot(path, project_id):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as file:
+            snapshot = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: Ignoring the inventory cache {path}.\n", e)
+        return {}
+    if snapshot.get("project_id") != project_id:
+        return {}
+    return snapshot.get("datasets", {})
+
+
+# Fetching one dataset, returns (dataset_name, etag, table names, reused) or None if it does not exist
+def _fetch_dataset(client, project_id, dataset_name, cached, max_age):
+    try:
+        dataset = client.get_dataset(f"{project_id}.{dataset_name}")  # Make an API request.
+    except NotFound:
+        return None
+
+    # Unchanged dataset with a fresh enough table list, no listing needed
+    if cached and cached.get("etag") == dataset.etag and time.time() - cached.get("fetched_at", 0) < max_age:
+        return dataset_name, dataset.etag, set(cached.get("tables", [])), cached["fetched_at"], True
+
+    fetched_at = time.time()
+    tables = client.list_tables(dataset, page_size=LIST_TABLES_PAGE_SIZE)  # Make an API request.
+    return dataset_name, dataset.etag, {str(table.table_id) for table in tables}, fetched_at, False
+
+
+## Inventory filled one dataset at a time, while a streamed manifest is reconciled.
+## load(dataset_name) is called once per dataset, from the worker threads, before its first table runs.
+class DatasetLoader:
+
+    def __init__(self, client, project_id, cache_path=None, max_age=DEFAULT_MAX_AGE):
+        self.client = client
+        self.inventory = Inventory(project_id)
+        self.max_age = max_age
+        self.found = self.loaded = self.reused = self.relisted = 0
+        self._cached = _read_snapshot(cache_path, project_id)
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+
+    # A dataset already loaded less than max_age seconds ago is kept as is (watch mode reuses the loader)
+    def load(self, dataset_name):
+        with self._lock:
+            if time.time() - self._loaded_at.get(dataset_name, 0) < self.max_age:
+                return
+        result = _fetch_dataset(self.client, self.inventory.project_id, dataset_name, self._cached.get(dataset_name), self.max_age)
+        with self._lock:
+            self.loaded += 1
+            self._loaded_at[dataset_name] = time.time()
+            if result is None:
+                return
+            self.found += 1
+            self.reused += result[4]
+        self.inventory.record(*result[:4])
+
+    # Listing a dataset again, ignoring the cache, when a table of it was created or deleted outside of this tool
+    def relist(self, dataset_name):
+        result = _fetch_dataset(self.client, self.inventory.project_id, dataset_name, None, self.max_age)
+        with self._lock:
+            self.relisted += 1
+            self._loaded_at[dataset_name] = time.time()
+        if result is None:
+            self.inventory.discard_dataset(dataset_name)
+        else:
+            self.inventory.record(*result[:4])
+
+    def summary(self):
+        return (f"Inventory:- {self.found}/{self.loaded} dataset/s found, {self.reused} reused from cache, "
+                f"{self.relisted} listed again\n")
+
+
+# Inventory cache file of a project, the projects other than the default one get a file of their own next to it
+def project_cache_path(path, project_id, default_project_id):
+    if not path or project_id == default_project_id:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{project_id}{ext}"
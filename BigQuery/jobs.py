@@ -0,0 +1,259 @@
+# [START imports]
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from google.api_core.exceptions import BadRequest
+
+from telemetry import get_telemetry
+
+
+# Seconds a statement waits for more statements of the same dataset before its job is submitted
+DEFAULT_LINGER = 0.2
+# Most statements merged into one script job
+MAX_SCRIPT_STATEMENTS = 50
+# Delay between two polls of the running jobs, doubled while nothing finishes
+POLL_INITIAL = 0.5
+POLL_MAXIMUM = 5.0
+
+# Location of a script error, "... at [3:27]" is line 3, column 27 of the script
+_ERROR_LOCATION = re.compile(r"at \[(\d+):(\d+)\]")
+
+
+## One DDL statement waiting for its job, `future` gets the finished job or the exception of the statement.
+## `span` is the telemetry span open in the submitting thread, the scheduler thread adds the job to it.
+class Statement:
+
+    def __init__(self, client, table_id, sql, mergeable):
+        self.client = client
+        self.table_id = table_id
+        self.sql = sql.strip().rstrip(";")
+        self.mergeable = mergeable
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.span = get_telemetry().current()
+
+
+# The job request and the finished job of the statements are added to their tables' spans
+def _attributed(statements):
+    return get_telemetry().attributed_to([statement.span for statement in statements])
+
+
+# Script of statements, one after the other, with the first line of each of them
+def build_script(statements):
+    lines, first_lines = 1, []
+    for statement in statements:
+        first_lines.append(lines)
+        lines += statement.sql.count("\n") + 1
+    return ";\n".join(statement.sql for statement in statements) + ";", first_lines
+
+
+# Index of the statement of a script which failed, from the location in the error, None if unknown
+def failed_statement(error, first_lines):
+    match = _ERROR_LOCATION.search(str(error))
+    if not match:
+        return None
+    line = int(match.group(1))
+    index = 0
+    for number, first_line in enumerate(first_lines):
+        if first_line <= line:
+            index = number
+    return index
+
+
+## DDL job scheduler shared by every worker thread.
+## Statements are submitted without waiting, mergeable statements of the same dataset queued within `linger`
+## seconds of each other go into one multi-statement script job, and a single background thread polls every
+## running job to completion. Each statement keeps its own future: when a script fails, the statements before
+## the failing one succeeded, the failing one gets the error and the ones after it are submitted again.
+class DdlScheduler:
+
+    def __init__(self, linger=DEFAULT_LINGER, merge=True):
+        self.linger = linger
+        self.merge = merge
+        self.stats = {"statements": 0, "jobs": 0, "scripts": 0, "polls": 0, "failed": 0}
+        self._queued = {}
+        self._running = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._tracked = []
+
+    # Queuing a statement, returns a future of its finished job. Full-table rewrites are not mergeable,
+    # a script runs its statements one by one and they are better off as concurrent jobs of their own.
+    def submit(self, client, table_id, sql, mergeable=True):
+        statement = Statement(client, table_id, sql, mergeable and self.merge)
+        key = (id(client), table_id.rsplit(".", 1)[0]) if statement.mergeable else (id(statement), None)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The DDL scheduler is closed")
+            self._queued.setdefault(key, []).append(statement)
+            self.stats["statements"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="ddl-scheduler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return statement.future
+
+    # Settings of a run, the counters start over
+    def configure(self, linger=DEFAULT_LINGER, merge=True):
+        with self._condition:
+            self.linger, self.merge = linger, merge
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    # Submitting a statement and waiting for its job, raises the error of the statement
+    def run(self, client, table_id, sql, mergeable=True):
+        return self.submit(client, table_id, sql, mergeable).result()
+
+    # Statements submitted without anyone waiting for them, they are finished together by finish()
+    def track(self, table_id, future, on_done=None):
+        with self._condition:
+            self._tracked.append((table_id, future, on_done))
+
+    def _finish_tracked(self, table_id, future, on_done):
+        try:
+            future.result()
+            status = "applied"
+        except Exception as e:
+            print(f"WARNING: [ddl] failed for {table_id}\n", e)
+            status = "failed"
+        if on_done is not None:
+            on_done(status)
+        return status
+
+    ## Waiting for every tracked statement, on_done(status) is called for each of them on `workers` threads.
+    ## Returns [(table_id, status)] in the order they were tracked.
+    def finish(self, workers):
+        with self._condition:
+            tracked, self._tracked = self._tracked, []
+        if not tracked:
+            return []
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(self._finish_tracked, *item) for item in tracked]
+            results = [(table_id, future.result()) for (table_id, _, _), future in zip(tracked, futures)]
+
+        failed = sum(1 for _, status in results if status == "failed")
+        print(f"DDL statements:- {len(results) - failed} table/s altered, {failed} failed, "
+              f"in {time.perf_counter() - start:.2f}s after the reconciliation\n")
+        return results
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        with self._condition:
+            self._thread = None
+            self._closed = False
+
+    def summary(self):
+        return ", ".join(f"{key}={value}" for key, value in self.stats.items())
+
+    # Taking the batches whose oldest statement waited long enough, or every batch when closing
+    def _ready_batches(self):
+        now = time.monotonic()
+        batches = []
+        for key, statements in list(self._queued.items()):
+            if self._closed or now - statements[0].queued_at >= self.linger:
+                del self._queued[key]
+                for start in range(0, len(statements), MAX_SCRIPT_STATEMENTS):
+                    batches.append(statements[start:start + MAX_SCRIPT_STATEMENTS])
+        return batches
+
+    def _submit_batch(self, statements):
+        client = statements[0].client
+        if len(statements) == 1:
+            sql, first_lines = statements[0].sql, [1]
+        else:
+            sql, first_lines = build_script(statements)
+        try:
+            with _attributed(statements):
+                job = client.query(sql)  # Make an API request, the job runs in the background.
+        except Exception as e:
+            self._fail(statements, e)
+            return
+        with self._condition:
+            self.stats["jobs"] += 1
+            self.stats["scripts"] += len(statements) > 1
+        self._running.append((job, statements, first_lines))
+
+    def _fail(self, statements, error):
+        for statement in statements:
+            statement.future.set_exception(error)
+        with self._condition:
+            self.stats["failed"] += len(statements)
+
+    def _finish(self, job, statements, first_lines):
+        error = job.exception() if job.error_result else None
+        if error is None:
+            for statement in statements:
+                statement.future.set_result(job)
+            return
+
+        index = failed_statement(error, first_lines) if len(statements) > 1 else 0
+        if index is None:
+            # The failing statement is unknown, none of them can be reported as applied
+            self._fail(statements, BadRequest(f"Script of {len(statements)} statements failed: {error}"))
+            return
+
+        for statement in statements[:index]:
+            statement.future.set_result(job)
+        statements[index].future.set_exception(error)
+        with self._condition:
+            self.stats["failed"] += 1
+            # The statements after the failing one did not run, they are submitted again ahead of newer ones
+            if index + 1 < len(statements):
+                key = (id(statements[0].client), statements[0].table_id.rsplit(".", 1)[0])
+                self._queued.setdefault(key, [])[0:0] = statements[index + 1:]
+
+    def _poll(self):
+        still_running = []
+        for job, statements, first_lines in self._running:
+            try:
+                with _attributed(statements):
+                    done = job.done()  # Make an API request.
+            except Exception as e:
+                self._fail(statements, e)
+                continue
+            if done:
+                self._finish(job, statements, first_lines)
+            else:
+                still_running.append((job, statements, first_lines))
+        with self._condition:
+            self.stats["polls"] += 1
+        finished = len(still_running) < len(self._running)
+        self._running = still_running
+        return finished
+
+    # Background thread: submitting the ready batches and polling every running job, until closed
+    def _loop(self):
+        delay, next_poll = POLL_INITIAL, 0.0
+        while True:
+            with self._condition:
+                if self._closed and not self._queued and not self._running:
+                    return
+                batches = self._ready_batches()
+
+            if batches and not self._running:
+                delay, next_poll = POLL_INITIAL, time.monotonic() + POLL_INITIAL
+            for statements in batches:
+                self._submit_batch(statements)
+
+            if self._running and time.monotonic() >= next_poll:
+                delay = POLL_INITIAL if self._poll() else min(delay * 2, POLL_MAXIMUM)
+                next_poll = time.monotonic() + delay
+
+            with self._condition:
+                now = time.monotonic()
+                timeouts = [statements[0].queued_at + self.linger - now for statements in self._queued.values()]
+                if self._running:
+                    timeouts.append(next_poll - now)
+                if timeouts:
+                    self._condition.wait(max(0.0, min(timeouts)))
+                elif not self._closed:
+                    self._condition.wait()
@@ -0,0 +1,92 @@
+# [START imports]
+import datetime
+
+
+## Physical layout options of a manifest entry, all of them optional:
+##   "description": "...",
+##   "time_partitioning": {"type": "DAY", "field": "dtloaded", "expiration_days": 30, "require_partition_filter": true},
+##   "range_partitioning": {"field": "id", "start": 0, "end": 1000000, "interval": 1000},
+##   "clustering_fields": ["market", "env"],
+##   "expiration_days": 90    (the table expires that many days after it is created)
+LAYOUT_KEYS = ["description", "time_partitioning", "range_partitioning", "clustering_fields", "expiration_days"]
+
+# Options which an external table accepts, its data layout is defined by the external data itself
+EXTERNAL_LAYOUT_KEYS = ["description", "expiration_days"]
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+# The cloud SDK is imported by the functions building the API objects only, the manifest validation
+# (validate.py) uses the option names above and runs without it.
+
+def time_partitioning(options):
+    from google.cloud import bigquery
+    expiration_days = options.get("expiration_days")
+    return bigquery.TimePartitioning(
+        type_=options.get("type", bigquery.TimePartitioningType.DAY).upper(),
+        field=options.get("field"),
+        expiration_ms=int(expiration_days * DAY_MS) if expiration_days else None,
+    )
+
+
+def range_partitioning(options):
+    from google.cloud import bigquery
+    return bigquery.RangePartitioning(
+        field=options["field"],
+        range_=bigquery.PartitionRange(start=options["start"], end=options["end"], interval=options["interval"]),
+    )
+
+
+## Setting the labels and layout of the entry on a table before it is created,
+## so create_table sends everything in a single request.
+def apply_layout(table, entry, labels, external=False):
+
+    for key in entry:
+        if key in LAYOUT_KEYS and external and key not in EXTERNAL_LAYOUT_KEYS:
+            raise ValueError(f"'{key}' is not supported for external table {entry['table_name']}")
+
+    table.labels = labels
+
+    if entry.get("description"):
+        table.description = entry["description"]
+    if entry.get("time_partitioning"):
+        table.time_partitioning = time_partitioning(entry["time_partitioning"])
+        table.require_partition_filter = entry["time_partitioning"].get("require_partition_filter")
+    if entry.get("range_partitioning"):
+        table.range_partitioning = range_partitioning(entry["range_partitioning"])
+    if entry.get("clustering_fields"):
+        table.clustering_fields = entry["clustering_fields"]
+    if entry.get("expiration_days"):
+        table.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=entry["expiration_days"])
+    return table
+
+
+## Layout differences between an existing table and its entry which can be patched in place,
+## returns (fields to update, warnings). Partitioning cannot be changed on an existing table.
+def layout_changes(table, entry):
+
+    fields, warnings = [], []
+
+    if "description" in entry and (table.description or "") != (entry["description"] or ""):
+        table.description = entry["description"]
+        fields.append("description")
+
+    if "clustering_fields" in entry and (table.clustering_fields or []) != (entry["clustering_fields"] or []):
+        table.clustering_fields = entry["clustering_fields"] or None
+        fields.append("clustering_fields")
+
+    if "time_partitioning" in entry:
+        wanted = entry["time_partitioning"]
+        current = table.time_partitioning
+        if wanted and (current is None or (current.field or None) != wanted.get("field")
+                       or current.type_ != wanted.get("type", "DAY").upper()):
+            warnings.append("time_partitioning differs from the manifest, partitioning cannot be changed on an existing table")
+        elif wanted and bool(table.require_partition_filter) != bool(wanted.get("require_partition_filter")):
+            table.require_partition_filter = bool(wanted.get("require_partition_filter"))
+            fields.append("require_partition_filter")
+
+    if "range_partitioning" in entry and entry["range_partitioning"]:
+        current = table.range_partitioning
+        if current is None or current.field != entry["range_partitioning"]["field"]:
+            warnings.append("range_partitioning differs from the manifest, partitioning cannot be changed on an existing table")
+
+    return fields, warnings
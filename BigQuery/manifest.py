@@ -0,0 +1,219 @@
+# [START imports]
+import glob
+import json
+import os
+
+from external import external_problems
+
+
+# Manifest reconciled when no --manifest is given
+DEFAULT_MANIFEST = "BigQuery/objects_details.json"
+
+# Lists a manifest (or manifest shard) can hold, and the keys every entry of them needs
+MANIFEST_LISTS = {
+    "na_tables_list": ["dataset_name", "table_name", "schema_json", "labels"],
+    "ex_tables_list": ["dataset_name", "table_name", "schema_json", "labels", "source_format", "source_uris"],
+}
+EMPTY_LIST_WARNINGS = {"na_tables_list": "No details for Native table/s is available.",
+                       "ex_tables_list": "No details for External table/s is available."}
+
+## Optional keys of every entry: "project" (the --project default when missing) and "location" of its dataset
+## (labels["location"] when missing), e.g. "project": "gcp-project-eu", "location": "EU"
+PLACEMENT_KEYS = ["project", "location"]
+
+# Characters read from a shard at a time, entries are decoded out of this window one by one
+READ_SIZE = 64 * 1024
+
+
+class ManifestError(ValueError):
+    pass
+
+
+## Manifest shard files of a source, in a stable (sorted) order:
+## a single objects_details.json file, a directory (every *.json below it, e.g. one file per dataset)
+## or a glob pattern such as "BigQuery/manifests/**/*.json". A list of sources gives the shards of each
+## of them in turn, every shard once.
+def shard_paths(source):
+    if not isinstance(source, str):
+        paths = []
+        for path in (path for one_source in source for path in shard_paths(one_source)):
+            if path not in paths:
+                paths.append(path)
+        return paths
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, "**", "*.json"), recursive=True))
+    if any(char in source for char in "*?["):
+        return sorted(glob.glob(source, recursive=True))
+    return [source]
+
+
+# Source (or list of sources) as it is printed
+def source_name(source):
+    return source if isinstance(source, str) else " ".join(source)
+
+
+## Incremental reader of one JSON document, only the value being decoded is held in memory
+class _JsonStream:
+
+    def __init__(self, path, file):
+        self.path = path
+        self._file = file
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._lines = 0
+
+    def _fill(self):
+        chunk = self._file.read(READ_SIZE)
+        if not chunk:
+            return False
+        # Dropping what was already consumed, keeping count of its lines for error locations
+        self._lines += self._buffer.count("\n", 0, self._pos)
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def location(self):
+        line = self._lines + self._buffer.count("\n", 0, self._pos) + 1
+        column = self._pos - self._buffer.rfind("\n", 0, self._pos)
+        return f"{self.path}:{line}:{column}"
+
+    def error(self, message):
+        return ManifestError(f"{self.location()}: {message}")
+
+    def peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in " \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error(f"expected '{char}'")
+        self._pos += 1
+
+    # Decoding the next value, reading more of the file while it is cut off by the end of the window
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                self._pos = e.pos
+                raise self.error(e.msg)
+            # A number at the very end of the window may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+# Yielding (list name, index, entry) from one shard, an unknown object is yielded as (key, None, None)
+# and an empty list as (key, None, [])
+def _iter_shard(path):
+    with open(path) as file:
+        stream = _JsonStream(path, file)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+
+        while True:
+            key = stream.value()
+            if not isinstance(key, str):
+                raise stream.error("expected an object key")
+            stream.expect(":")
+
+            if key not in MANIFEST_LISTS:
+                stream.value()
+                yield key, None, None
+            else:
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.expect("]")
+                    yield key, None, []
+                else:
+                    index = 0
+                    while True:
+                        yield key, index, stream.value()
+                        index += 1
+                        if stream.peek() != ",":
+                            stream.expect("]")
+                            break
+                        stream.expect(",")
+
+            if stream.peek() != ",":
+                stream.expect("}")
+                return
+            stream.expect(",")
+
+
+# Structural problems of one entry, an empty list means the entry is valid
+def entry_problems(list_name, entry):
+    if not isinstance(entry, dict):
+        return ["entry is not an object"]
+
+    problems = [f"missing '{key}'" for key in MANIFEST_LISTS[list_name] if key not in entry]
+    for key in ["dataset_name", "table_name", "schema_json", "source_format"] + PLACEMENT_KEYS:
+        if key in entry and not (isinstance(entry[key], str) and entry[key]):
+            problems.append(f"'{key}' must be a non-empty string")
+    if "labels" in entry and not isinstance(entry["labels"], dict):
+        problems.append("'labels' must be an object")
+    elif "labels" in entry and "location" not in entry["labels"] and "location" not in entry:
+        problems.append("a 'location' (or 'labels' location) is needed for the dataset")
+    if "source_uris" in entry and not (isinstance(entry["source_uris"], list) and entry["source_uris"]):
+        problems.append("'source_uris' must be a non-empty list")
+    elif list_name == "ex_tables_list":
+        problems.extend(external_problems(entry))
+    return problems
+
+
+# Location of the dataset of an entry
+def entry_location(entry):
+    return entry.get("location") or entry["labels"]["location"]
+
+
+def _print_warning(message):
+    print(f"WARNING: {message}")
+
+
+## Streaming the entries of every shard of the source, yields (list name, entry, location) where location
+## is "shard: list[index] (dataset.table)". Shards are parsed incrementally, so the first entries can be
+## reconciled before the rest is read. Invalid entries, duplicated tables and unreadable shards are reported
+## with their exact shard and entry to warn(message) (printed as warnings by default) and skipped.
+def iter_manifest(source, warn=_print_warning):
+
+    seen = {}
+    paths = shard_paths(source)
+    if not paths:
+        warn(f"No manifest shard matches {source_name(source)}")
+
+    for path in paths:
+        try:
+            for list_name, index, entry in _iter_shard(path):
+                if index is None:
+                    if entry is None:
+                        warn(f"{path}: Found an invalid object '{list_name}' in objects_details")
+                    else:
+                        # An empty list is valid, it is only pointed out
+                        print(f"WARNING: {path}: {EMPTY_LIST_WARNINGS[list_name]}")
+                    continue
+
+                location = f"{path}: {list_name}[{index}]"
+                problems = entry_problems(list_name, entry)
+                if problems:
+                    warn(f"{location}: {'; '.join(problems)}, skipping the entry.")
+                    continue
+
+                table = ".".join(entry[key] for key in ("project", "dataset_name", "table_name") if key in entry)
+                location = f"{location} ({table})"
+                if table in seen:
+                    warn(f"{location}: duplicates {seen[table]}, skipping the entry.")
+                    continue
+                seen[table] = location
+
+                yield list_name, entry, location
+        except (OSError, ManifestError) as e:
+            warn(f"Unable to read the manifest shard {path}, its remaining entries are skipped.\n{e}")
@@ -0,0 +1,100 @@
+# [START imports]
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import retry
+from google.api_core.exceptions import Forbidden, InternalServerError, ServiceUnavailable, TooManyRequests
+from google.cloud import bigquery
+
+from telemetry import record_retry, span
+
+
+# BigQuery allows 5 metadata updates per 10 seconds per table, the backoff starts above that window
+RETRY_INITIAL = 2.0
+RETRY_MAXIMUM = 64.0
+RETRY_TIMEOUT = 600.0
+
+
+## Label keys to send for the update: changed or added keys with their new value, removed keys as None.
+## An empty dict means the labels are the same.
+def label_delta(cur_labels, updated_labels):
+    cur_labels = cur_labels or {}
+    delta = {key: value for key, value in updated_labels.items() if cur_labels.get(key) != value}
+    delta.update({key: None for key in cur_labels if key not in updated_labels})
+    return delta
+
+
+# Rate limit and transient backend errors, retried with exponential backoff
+def is_retryable(exc):
+    if isinstance(exc, (TooManyRequests, ServiceUnavailable, InternalServerError)):
+        return True
+    if isinstance(exc, Forbidden):
+        return any(error.get("reason") in ("rateLimitExceeded", "backendError") for error in (exc.errors or []))
+    return False
+
+
+## Field-masked PATCH of one table. Only the given fields are sent, labels hold just the changed keys,
+## and no etag is sent so the patch does not conflict with unrelated concurrent changes.
+def patch_table(client, table_id, patch, on_retry=None):
+
+    table = bigquery.Table(table_id)
+    for field, value in patch.items():
+        setattr(table, field, value)
+
+    backoff = retry.Retry(predicate=is_retryable, initial=RETRY_INITIAL, maximum=RETRY_MAXIMUM,
+                          multiplier=2.0, timeout=RETRY_TIMEOUT, on_error=on_retry)
+    table = client.update_table(table, list(patch), retry=backoff)  # API request
+
+    print("{}.{}.{} Table's {} have been updated. \n".format(table.project, table.dataset_id, table.table_id, ", ".join(patch)))
+    return table
+
+
+## Bulk metadata update stage.
+## Metadata-only operations of every table are queued while the tables are reconciled and then sent
+## together on their own pool, each as one field-masked request with rate-limit aware backoff.
+class MetadataBatch:
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.retries = 0
+        self._queue = []
+        self._lock = threading.Lock()
+
+    def count_retry(self, exc):
+        with self._lock:
+            self.retries += 1
+        record_retry(exc)
+
+    # on_done(table) is called with the updated table after a successful update
+    def add(self, operation, on_done=None):
+        with self._lock:
+            self._queue.append((operation, on_done))
+
+    def _run(self, operation, on_done):
+        try:
+            with span(operation.table_id, operation.kind):
+                table = operation.apply(on_retry=self.count_retry)
+        except Exception as e:
+            print(f"WARNING: [{operation.kind}] failed for {operation.table_id}\n", e)
+            return "failed"
+        if on_done is not None:
+            on_done(table)
+        return "applied"
+
+    # Sending every queued update, returns [(table_id, status)] in the order they were queued
+    def flush(self):
+        with self._lock:
+            queue, self._queue = self._queue, []
+        if not queue:
+            return []
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            futures = [executor.submit(self._run, operation, on_done) for operation, on_done in queue]
+            results = [(operation.table_id, future.result()) for (operation, _), future in zip(queue, futures)]
+
+        failed = sum(1 for _, status in results if status == "failed")
+        print(f"Metadata updates:- {len(results) - failed} table/s updated, {failed} failed, "
+              f"{self.retries} rate-limit retry/ies, in {time.perf_counter() - start:.2f}s\n")
+        return results
@@ -0,0 +1,312 @@
+# [START imports]
+import json
+
+from google.cloud import bigquery
+
+from schema_diff import normalize_mode, normalize_type
+
+
+def quote_table(table_id):
+    return f"`{table_id}`"
+
+
+def quote_column(name):
+    return f"`{name}`"
+
+
+def format_bytes(num_bytes):
+    size = float(num_bytes or 0)
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} PB"
+
+
+# Bytes a query would scan, from a dry-run job which is free and does not run anything
+def estimate_bytes(client, sql):
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = client.query(sql, job_config=job_config)  # Make an API request.
+    return query_job.total_bytes_processed
+
+
+## Metadata-only removal of top-level columns, all the columns go in one ALTER TABLE statement.
+## No data is read or rewritten, partitioning, clustering and labels stay as they are.
+def drop_columns_sql(table_id, column_names):
+    drops = ", ".join(f"DROP COLUMN IF EXISTS {quote_column(name)}" for name in column_names)
+    return f"ALTER TABLE {quote_table(table_id)} {drops}"
+
+
+# Columns which ALTER TABLE DROP COLUMN refuses, the table has to be rewritten to remove them
+def layout_columns(table):
+    columns = set(table.clustering_fields or [])
+    if table.time_partitioning is not None and table.time_partitioning.field:
+        columns.add(table.time_partitioning.field)
+    if table.range_partitioning is not None and table.range_partitioning.field:
+        columns.add(table.range_partitioning.field)
+    return {name.lower() for name in columns}
+
+
+def _partition_by(table, column_types, dropped):
+    time_partitioning = table.time_partitioning
+    range_partitioning = table.range_partitioning
+
+    if range_partitioning is not None and range_partitioning.field:
+        field = range_partitioning.field
+        if field.lower() in dropped:
+            return None
+        range_ = range_partitioning.range_
+        return (f"PARTITION BY RANGE_BUCKET({quote_column(field)}, "
+                f"GENERATE_ARRAY({range_.start}, {range_.end}, {range_.interval}))")
+
+    if time_partitioning is None:
+        return None
+
+    # Ingestion-time partitioning keeps _PARTITIONTIME which a CREATE ... AS SELECT cannot carry over
+    if not time_partitioning.field:
+        raise ValueError(f"{table.table_id} is ingestion-time partitioned, it cannot be rewritten without losing its partitions")
+    if time_partitioning.field.lower() in dropped:
+        return None
+
+    field = quote_column(time_partitioning.field)
+    granularity = time_partitioning.type_ or "DAY"
+    field_type = column_types.get(time_partitioning.field.lower(), "TIMESTAMP")
+    if field_type == "DATE":
+        return f"PARTITION BY {field}" if granularity == "DAY" else f"PARTITION BY DATE_TRUNC({field}, {granularity})"
+    if field_type == "DATETIME":
+        return f"PARTITION BY DATETIME_TRUNC({field}, {granularity})"
+    return f"PARTITION BY TIMESTAMP_TRUNC({field}, {granularity})"
+
+
+def _options(table, partitioned):
+    options = []
+    if table.labels:
+        labels = ", ".join(f"({json.dumps(key)}, {json.dumps(value)})" for key, value in sorted(table.labels.items()))
+        options.append(f"labels=[{labels}]")
+    if table.description:
+        options.append(f"description={json.dumps(table.description)}")
+    if partitioned and table.time_partitioning is not None and table.time_partitioning.expiration_ms:
+        options.append(f"partition_expiration_days={table.time_partitioning.expiration_ms / 86400000}")
+    if partitioned and table.require_partition_filter:
+        options.append("require_partition_filter=true")
+    if table.expires:
+        options.append(f'expiration_timestamp=TIMESTAMP "{table.expires.isoformat()}"')
+    return f"OPTIONS({', '.join(options)})" if options else None
+
+
+## PARTITION BY / CLUSTER BY / OPTIONS of an existing table, so a CREATE OR REPLACE rewrite keeps
+## its physical layout, labels, description and expiration. Layout on a dropped column is left out.
+## column_types are the types of the rewritten columns by lowercase name, the current ones by default.
+def layout_clause(table, dropped=(), column_types=None):
+    dropped = {name.lower() for name in dropped}
+    if column_types is None:
+        column_types = {field.name.lower(): normalize_type(field.field_type) for field in table.schema}
+
+    partition_by = _partition_by(table, column_types, dropped)
+    clauses = [partition_by]
+
+    clustering = [name for name in (table.clustering_fields or []) if name.lower() not in dropped]
+    if clustering:
+        clauses.append("CLUSTER BY " + ", ".join(quote_column(name) for name in clustering))
+
+    clauses.append(_options(table, partition_by is not None))
+    return " ".join(clause for clause in clauses if clause)
+
+
+## WHERE clause reading every partition of a table which requires a partition filter, BigQuery refuses any query
+## of it (dry runs included) without a filter on its partitioning column. The predicate is always true, rows with
+## a NULL partitioning value are kept as well. None when the table does not require a partition filter.
+def partition_filter(table):
+    if not table.require_partition_filter:
+        return None
+    if table.range_partitioning is not None and table.range_partitioning.field:
+        field = quote_column(table.range_partitioning.field)
+    elif table.time_partitioning is not None:
+        field = quote_column(table.time_partitioning.field) if table.time_partitioning.field else "_PARTITIONTIME"
+    else:
+        return None
+    return f"WHERE {field} IS NULL OR {field} IS NOT NULL"
+
+
+# Paths of the columns with policy tags (column-level access control), a CREATE OR REPLACE rewrite cannot carry them over
+def policy_tagged_columns(fields, prefix=""):
+    tagged = []
+    for field in fields:
+        if field.policy_tags is not None and field.policy_tags.names:
+            tagged.append(prefix + field.name)
+        tagged += policy_tagged_columns(field.fields, f"{prefix}{field.name}.")
+    return tagged
+
+
+# Columns of the updated schema with the descriptions of the current columns (SchemaFields) they replace
+def with_descriptions(columns, cur_fields):
+    cur_index = {field.name.lower(): field for field in cur_fields}
+    described = []
+    for col in columns:
+        col, cur_field = dict(col), cur_index.get(col["name"].lower())
+        if cur_field is not None:
+            if cur_field.description and not col.get("description"):
+                col["description"] = cur_field.description
+            if col.get("fields"):
+                col["fields"] = with_descriptions(col["fields"], cur_field.fields)
+        described.append(col)
+    return described
+
+
+## Rewrite of the table without the given columns, only for columns DROP COLUMN cannot remove.
+## The column definition list keeps the descriptions of the other columns.
+## This scans the whole table, callers show estimate_bytes() of it before running it.
+def rewrite_without_columns_sql(table, table_id, column_names):
+    dropped = {name.lower() for name in column_names}
+    definitions = ", ".join(column_definition(field.to_api_repr()) for field in table.schema if field.name.lower() not in dropped)
+    excepted = ", ".join(quote_column(name) for name in column_names)
+    parts = [f"CREATE OR REPLACE TABLE {quote_table(table_id)} ({definitions})", layout_clause(table, dropped=column_names),
+             f"AS SELECT * EXCEPT ({excepted}) FROM {quote_table(table_id)}", partition_filter(table)]
+    return " ".join(part for part in parts if part)
+
+
+# Standard SQL names of the legacy type names used in schemas
+SQL_TYPES = {"INTEGER": "INT64", "FLOAT": "FLOAT64", "BOOLEAN": "BOOL", "RECORD": "STRUCT"}
+
+# Type changes ALTER COLUMN SET DATA TYPE applies as metadata only, every value is kept exactly
+SAFE_WIDENINGS = {("INTEGER", "NUMERIC"), ("INTEGER", "BIGNUMERIC"), ("NUMERIC", "BIGNUMERIC")}
+
+# Casts which succeed but can round, truncate or lose precision, they need an explicit confirmation.
+# Every other failing cast (e.g. a STRING which is not a number) aborts the whole rewrite job instead.
+LOSSY_CASTS = {
+    ("FLOAT", "INTEGER"), ("FLOAT", "NUMERIC"), ("FLOAT", "BIGNUMERIC"),
+    ("NUMERIC", "INTEGER"), ("BIGNUMERIC", "INTEGER"), ("BIGNUMERIC", "NUMERIC"),
+    ("INTEGER", "FLOAT"), ("NUMERIC", "FLOAT"), ("BIGNUMERIC", "FLOAT"),
+    ("TIMESTAMP", "DATE"), ("TIMESTAMP", "TIME"), ("TIMESTAMP", "DATETIME"),
+    ("DATETIME", "DATE"), ("DATETIME", "TIME"),
+}
+
+
+def sql_type(field_type):
+    field_type = normalize_type(field_type)
+    return SQL_TYPES.get(field_type, field_type)
+
+
+# Type of a column for a column definition list, e.g. ARRAY<STRUCT<`a` INT64, `b` STRING>>
+def column_type_sql(col):
+    if normalize_type(col["type"]) == "RECORD":
+        fields = ", ".join(column_definition(sub_col) for sub_col in col.get("fields", []))
+        type_sql = f"STRUCT<{fields}>"
+    else:
+        type_sql = sql_type(col["type"])
+    return f"ARRAY<{type_sql}>" if normalize_mode(col.get("mode")) == "REPEATED" else type_sql
+
+
+def column_definition(col):
+    not_null = " NOT NULL" if normalize_mode(col.get("mode")) == "REQUIRED" else ""
+    options = f" OPTIONS(description={json.dumps(col['description'])})" if col.get("description") else ""
+    return f"{quote_column(col['name'])} {column_type_sql(col)}{not_null}{options}"
+
+
+## Changes of a diff which can lose data without the job failing, as readable strings
+def lossy_changes(diff):
+    lossy = [f"{path} {old}->{new}" for path, old, new in diff.type_changed if (old, new) in LOSSY_CASTS]
+    lossy += [f"{path} {old}->{new}" for path, old, new in diff.mode_changed if old == "REPEATED"]
+    return lossy
+
+
+## Metadata-only ALTER COLUMN statement for safe widenings and REQUIRED -> NULLABLE relaxations,
+## both are lists of (column, current, updated) for top-level columns.
+def alter_columns_sql(table_id, widenings, relaxations):
+    clauses = [f"ALTER COLUMN {quote_column(path)} SET DATA TYPE {sql_type(new)}" for path, _, new in widenings]
+    clauses += [f"ALTER COLUMN {quote_column(path)} DROP NOT NULL" for path, _, _ in relaxations]
+    return f"ALTER TABLE {quote_table(table_id)} {', '.join(clauses)}"
+
+
+# Expression turning the current value `ref` of a column into the updated column
+def _value_expression(ref, cur_col, updated_col):
+
+    if cur_col is None:
+        return f"CAST(NULL AS {column_type_sql(updated_col)})"
+
+    cur_mode, updated_mode = normalize_mode(cur_col.get("mode")), normalize_mode(updated_col.get("mode"))
+    if cur_mode == "REPEATED" and updated_mode != "REPEATED":
+        # Only the first element is kept, listed by lossy_changes()
+        return _value_expression(f"{ref}[SAFE_OFFSET(0)]", dict(cur_col, mode="NULLABLE"), updated_col)
+    if cur_mode != "REPEATED" and updated_mode == "REPEATED":
+        element = _value_expression(ref, cur_col, dict(updated_col, mode="NULLABLE"))
+        return f"IF({ref} IS NULL, [], [{element}])"
+
+    if normalize_type(updated_col["type"]) == "RECORD" and normalize_type(cur_col["type"]) == "RECORD":
+        if cur_mode == "REPEATED":
+            fields = _struct_fields("e", cur_col, updated_col)
+            return f"ARRAY(SELECT AS STRUCT {fields} FROM UNNEST({ref}) AS e WITH OFFSET AS o ORDER BY o)"
+        return f"IF({ref} IS NULL, NULL, STRUCT({_struct_fields(ref, cur_col, updated_col)}))"
+
+    if normalize_type(cur_col["type"]) == normalize_type(updated_col["type"]):
+        return ref
+    if cur_mode == "REPEATED":
+        return f"ARRAY(SELECT CAST(e AS {sql_type(updated_col['type'])}) FROM UNNEST({ref}) AS e WITH OFFSET AS o ORDER BY o)"
+    return f"CAST({ref} AS {sql_type(updated_col['type'])})"
+
+
+def _struct_fields(ref, cur_col, updated_col):
+    cur_fields = {sub_col["name"].lower(): sub_col for sub_col in cur_col.get("fields", [])}
+    expressions = []
+    for sub_col in updated_col.get("fields", []):
+        cur_sub_col = cur_fields.get(sub_col["name"].lower())
+        sub_ref = f"{ref}.{quote_column(cur_sub_col['name'])}" if cur_sub_col else None
+        expressions.append(f"{_value_expression(sub_ref, cur_sub_col, sub_col)} AS {quote_column(sub_col['name'])}")
+    return ", ".join(expressions)
+
+
+## Rewrite of the table into the updated schema in one CREATE OR REPLACE ... AS SELECT pass.
+## Every column is CAST (recursively for RECORD and REPEATED columns) from its current value, new
+## columns are NULL, and the column definition list keeps the exact types, NOT NULL modes and column descriptions.
+## Partitioning, clustering, labels, description, expiration and partition filter requirement of the table are kept.
+def rewrite_with_casts_sql(table, table_id, cur_schema, updated_schema):
+
+    cur_columns = {col["name"].lower(): col for col in cur_schema}
+    definitions = ", ".join(column_definition(col) for col in with_descriptions(updated_schema, table.schema))
+
+    selects = []
+    for col in updated_schema:
+        cur_col = cur_columns.get(col["name"].lower())
+        ref = quote_column(cur_col["name"]) if cur_col else None
+        selects.append(f"{_value_expression(ref, cur_col, col)} AS {quote_column(col['name'])}")
+
+    # The partitioning expression follows the updated type of its column (e.g. TIMESTAMP -> DATE)
+    column_types = {col["name"].lower(): normalize_type(col["type"]) for col in updated_schema}
+    dropped = [name for name in cur_columns if name not in column_types]
+    parts = [f"CREATE OR REPLACE TABLE {quote_table(table_id)} ({definitions})",
+             layout_clause(table, dropped=dropped, column_types=column_types),
+             f"AS SELECT {', '.join(selects)} FROM {quote_table(table_id)}", partition_filter(table)]
+    return " ".join(part for part in parts if part)
+
+
+def _sql_literal(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_sql_literal(item) for item in value) + "]"
+    return json.dumps(value)
+
+
+## Atomic replacement of an external table, the table keeps existing until the new definition
+## replaces it so queries never see it missing. Only used when an in-place update is refused.
+## `external_options` are the hive partitioning and format OPTIONS and `partition_columns` the
+## WITH PARTITION COLUMNS clause of a hive partitioned table (external.ddl_options / ddl_partition_columns).
+def create_or_replace_external_sql(table_id, updated_schema, source_format, source_uris, labels=None, description=None,
+                                   external_options=None, partition_columns=""):
+
+    definitions = ", ".join(column_definition(col) for col in updated_schema)
+
+    options = {"format": source_format, "uris": list(source_uris)}
+    options.update(external_options or {})
+    if description:
+        options["description"] = description
+
+    option_list = [f"{key} = {_sql_literal(value)}" for key, value in options.items()]
+    if labels:
+        option_list.append("labels = [" + ", ".join(f"({json.dumps(key)}, {json.dumps(value)})" for key, value in sorted(labels.items())) + "]")
+
+    partition_clause = f" {partition_columns}" if partition_columns else ""
+    return (f"CREATE OR REPLACE EXTERNAL TABLE {quote_table(table_id)} ({definitions}){partition_clause} "
+            f"OPTIONS ({', '.join(option_list)})")
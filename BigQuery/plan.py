@@ -0,0 +1,63 @@
+# [START imports]
+from collections import namedtuple
+
+from telemetry import span
+
+
+# One change to a BigQuery object. `apply` makes the API request/s when called without arguments,
+# planning only reads from BigQuery so a plan can be printed without changing anything.
+Operation = namedtuple("Operation", ["table_id", "kind", "description", "apply"])
+
+# Kind of a change the plan refuses to make (e.g. a REQUIRED column added to an existing table), it has no apply
+REFUSED = "refused"
+
+
+def refusal(table_id, description):
+    return Operation(table_id, REFUSED, description, None)
+
+
+# Raised by an operation when what its plan was based on turned out to be stale (e.g. a table created outside of
+# this tool since the inventory was cached), execute_plan lets it through so the table can be planned again
+class Replan(Exception):
+    pass
+
+
+def print_plan(table_id, operations):
+    if not operations:
+        print(f"Plan for {table_id}:- no operations\n")
+        return
+    print(f"Plan for {table_id}:-")
+    for number, operation in enumerate(operations, start=1):
+        print(f"  {number}. [{operation.kind}] {operation.description}")
+    print()
+
+
+## Printing the operations of a table and, unless dry_run, applying them in order.
+## The first failing operation stops the remaining ones of the same table, and a refused change stops all of them.
+## Returns (status, result) with the status of the table: "planned", "applied", "no changes", "refused" or "failed",
+## and what the last operation returned when applied (e.g. the updated Table, or the finished job of a DDL statement).
+def execute_plan(table_id, operations, dry_run=False):
+
+    print_plan(table_id, operations)
+
+    if not operations:
+        return "no changes", None
+    if any(operation.kind == REFUSED for operation in operations):
+        return "refused", None
+    if dry_run:
+        return "planned", None
+
+    for operation in operations:
+        try:
+            # Every operation is timed on its own, with the API calls and jobs it makes
+            with span(table_id, operation.kind):
+                result = operation.apply()
+                # The creation helpers return the exception instead of raising it
+                if isinstance(result, Exception):
+                    raise result
+        except Replan:
+            raise
+        except Exception as e:
+            print(f"WARNING: [{operation.kind}] failed for {table_id}\n", e)
+            return "failed", None
+    return "applied", result
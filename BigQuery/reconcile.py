@@ -0,0 +1,203 @@
+# [START imports]
+import queue
+import sys
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+DEFAULT_WORKERS = 8
+# Tasks submitted ahead of the oldest unfinished one, per worker
+PENDING_PER_WORKER = 4
+# Tasks routed to a group (project and location) ahead of the ones it is running
+GROUP_QUEUE_SIZE = 1000
+_END_OF_GROUP = object()
+
+# One unit of work of the reconciliation, `run` is called without arguments and returns a short status
+ReconcileTask = namedtuple("ReconcileTask", ["name", "dataset_name", "dataset_location", "run"])
+
+
+## sys.stdout replacement which keeps everything a worker thread prints in its own buffer,
+## so the output of concurrent tables is never interleaved and can be replayed in manifest order.
+class _ThreadLocalOutput:
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self._stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    # Running func in the current thread and returning (captured output, status)
+    def capture(self, func, *args):
+        self._local.buffer = []
+        try:
+            status = func(*args)
+        except Exception as e:
+            print(f"WARNING: {e}")
+            status = "failed"
+        finally:
+            output = "".join(self._local.buffer)
+            self._local.buffer = None
+        return output, status
+
+
+## Running the tasks with a pool of `workers` threads while they are still being produced (tasks can be
+## a generator over a streamed manifest). Each dataset is prepared once, before its first table:
+## load_dataset(dataset_name), when given, looks it up into the inventory, and a missing dataset is created.
+## The output of the tasks is printed in their order, followed by per-table results and the total wall time
+## unless `report` is False (the results of every group are reported together by print_report).
+def run_reconciliation(tasks, inventory, create_dataset, workers=DEFAULT_WORKERS, load_dataset=None, report=True):
+
+    start = time.perf_counter()
+    # Concurrent reconciliations (fan_out) share the output installed by the first one
+    shared = isinstance(sys.stdout, _ThreadLocalOutput)
+    output = sys.stdout if shared else _ThreadLocalOutput(sys.stdout)
+    results = []
+    datasets = {}
+    # (task name or None for a dataset, future) in submission order, bounded so a long stream is not all queued at once
+    pending = deque()
+    max_pending = max(1, workers) * PENDING_PER_WORKER
+
+    def prepare_dataset(dataset_name, dataset_location):
+        if load_dataset is not None:
+            load_dataset(dataset_name)
+        if inventory.has_dataset(dataset_name):
+            return "exists"
+        status = create_dataset(dataset_name, dataset_location)
+        if status != "failed":
+            inventory.add_dataset(dataset_name)
+        return status
+
+    # The dataset is submitted before its tables, so the pool always starts it before a table waits on it
+    def run_task(task, dataset_future):
+        _, dataset_status = dataset_future.result()
+        if dataset_status == "failed":
+            print(f"WARNING: Skipping {task.name}, dataset {task.dataset_name} could not be created.\n")
+            return "skipped"
+        return task.run()
+
+    def print_finished(wait):
+        while pending and (wait or pending[0][1].done() or len(pending) > max_pending):
+            name, future = pending.popleft()
+            text, status = future.result()
+            sys.stdout.write(text)
+            if name is not None:
+                results.append((name, status))
+
+    if not shared:
+        sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for task in tasks:
+                dataset_future = datasets.get(task.dataset_name)
+                if dataset_future is None:
+                    dataset_future = executor.submit(output.capture, prepare_dataset, task.dataset_name, task.dataset_location)
+                    datasets[task.dataset_name] = dataset_future
+                    pending.append((None, dataset_future))
+
+                pending.append((task.name, executor.submit(output.capture, run_task, task, dataset_future)))
+                print_finished(wait=False)
+            print_finished(wait=True)
+    finally:
+        if not shared:
+            sys.stdout = output._stream
+
+    wall_time = time.perf_counter() - start
+    if not report:
+        return results
+
+    print("\nReconciliation results:-")
+    for name, status in results:
+        print(f"  {name}: {status}")
+    print(f"\n{len(results)} table/s reconciled with {workers} worker/s in {wall_time:.2f}s\n")
+
+    return results
+
+
+# Tasks of one group, read from its queue until the router closes it
+def _drain(tasks, ended):
+    while not ended.is_set():
+        task = tasks.get()
+        if task is _END_OF_GROUP:
+            ended.set()
+            return
+        yield task
+
+
+## Running every group of tasks (e.g. one per project and location) concurrently, each on a thread of its own.
+## `items` yields (group key, task) and is read once, in order; run_group(key, tasks) gets a generator over the
+## tasks of its group as they are routed to it, so every group works while the manifest is still being read.
+## Returns [(key, result of run_group or its exception, wall time)] in the order the groups were first seen.
+def fan_out(items, run_group, queue_size=GROUP_QUEUE_SIZE):
+
+    groups = {}
+
+    def start_group(key):
+        tasks, ended, future = queue.Queue(queue_size), threading.Event(), Future()
+
+        def run():
+            start = time.perf_counter()
+            try:
+                result = run_group(key, _drain(tasks, ended))
+            except Exception as e:
+                result = e
+            wall_time = time.perf_counter() - start
+            # A group which stopped early still consumes its tasks, so the router never blocks on it
+            for _ in _drain(tasks, ended):
+                pass
+            future.set_result((key, result, wall_time))
+
+        threading.Thread(target=run, name=f"group-{'-'.join(map(str, key))}", daemon=True).start()
+        return tasks, future
+
+    output = _ThreadLocalOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        try:
+            for key, task in items:
+                if key not in groups:
+                    groups[key] = start_group(key)
+                groups[key][0].put(task)
+        finally:
+            for tasks, _ in groups.values():
+                tasks.put(_END_OF_GROUP)
+        return [future.result() for _, future in groups.values()]
+    finally:
+        sys.stdout = output._stream
+
+
+## Printing one report for the groups of a fan_out: the results of every table per group, and a line per group
+def print_report(groups, workers, wall_time):
+
+    print("\nReconciliation results:-")
+    total = 0
+    lines = []
+    for key, results, group_time in groups:
+        name = " ".join(map(str, key))
+        if isinstance(results, Exception):
+            print(f"  {name}: failed ({results})")
+            lines.append(f"  {name}: failed in {group_time:.2f}s")
+            continue
+        print(f"  {name}:-")
+        for table, status in results:
+            print(f"    {table}: {status}")
+        statuses = Counter(status for _, status in results)
+        total += len(results)
+        lines.append(f"  {name}: {len(results)} table/s ({', '.join(f'{status}={count}' for status, count in sorted(statuses.items()))})"
+                     f" in {group_time:.2f}s")
+
+    print("\nProjects and locations:-")
+    print("\n".join(lines))
+    print(f"\n{total} table/s reconciled in {len(groups)} project/location group/s with {workers} worker/s each in {wall_time:.2f}s\n")
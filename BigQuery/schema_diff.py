@@ -0,0 +1,147 @@
+# [START imports]
+from copy import deepcopy
+
+
+# Standard SQL type names mapped to the legacy names the tables API returns
+TYPE_ALIASES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+    "STRUCT": "RECORD",
+    "DECIMAL": "NUMERIC",
+    "BIGDECIMAL": "BIGNUMERIC",
+}
+
+
+def normalize_type(field_type):
+    field_type = field_type.upper()
+    return TYPE_ALIASES.get(field_type, field_type)
+
+
+def normalize_mode(mode):
+    return (mode or "NULLABLE").upper()
+
+
+# Column names are case-insensitive in BigQuery
+def _key(col):
+    return col["name"].lower()
+
+
+# Plain dict copy of a column, a dict or a schema_registry.Column, with its nested fields
+def _api_repr(col):
+    return {key: [_api_repr(sub_col) for sub_col in value] if key == "fields" else deepcopy(value) for key, value in col.items()}
+
+
+## Structured result of diff_schemas, every entry carries the dotted path of the column
+## (e.g. "address.city" for a nested field) so nested changes can be told apart from top-level ones.
+class SchemaDiff:
+
+    def __init__(self):
+        self.added = []          # (path, column)
+        self.dropped = []        # (path, column)
+        self.type_changed = []   # (path, current type, updated type)
+        self.mode_relaxed = []   # (path, current mode, updated mode), REQUIRED -> NULLABLE
+        self.mode_changed = []   # (path, current mode, updated mode), every other mode change
+        self.reordered = []      # paths of columns present in both schemas at a different position
+
+    # Changes which BigQuery accepts as an in-place schema patch
+    def is_additive(self):
+        return not (self.dropped or self.type_changed or self.mode_changed)
+
+    def has_changes(self, include_reorder=False):
+        return bool(self.added or self.dropped or self.type_changed or self.mode_relaxed or self.mode_changed
+                    or (include_reorder and self.reordered))
+
+    def __bool__(self):
+        return self.has_changes()
+
+    def summary(self):
+        parts = []
+        if self.added:
+            parts.append("added: " + ", ".join(path for path, _ in self.added))
+        if self.dropped:
+            parts.append("dropped: " + ", ".join(path for path, _ in self.dropped))
+        if self.type_changed:
+            parts.append("type changed: " + ", ".join(f"{path} {old}->{new}" for path, old, new in self.type_changed))
+        if self.mode_relaxed:
+            parts.append("mode relaxed: " + ", ".join(f"{path} {old}->{new}" for path, old, new in self.mode_relaxed))
+        if self.mode_changed:
+            parts.append("mode changed: " + ", ".join(f"{path} {old}->{new}" for path, old, new in self.mode_changed))
+        if self.reordered:
+            parts.append("reordered: " + ", ".join(self.reordered))
+        return "; ".join(parts) if parts else "no changes"
+
+
+# Comparing one level of columns and recursing into the RECORD columns present in both
+def _diff_level(cur_columns, updated_columns, prefix, diff):
+
+    cur_index = {_key(col): col for col in cur_columns}
+    updated_index = {_key(col): col for col in updated_columns}
+
+    for col in updated_columns:
+        if _key(col) not in cur_index:
+            diff.added.append((prefix + col["name"], col))
+
+    common_cur = []
+    for col in cur_columns:
+        key = _key(col)
+        updated = updated_index.get(key)
+        path = prefix + col["name"]
+        if updated is None:
+            diff.dropped.append((path, col))
+            continue
+        common_cur.append(key)
+
+        cur_type, updated_type = normalize_type(col["type"]), normalize_type(updated["type"])
+        if cur_type != updated_type:
+            diff.type_changed.append((path, cur_type, updated_type))
+        elif cur_type == "RECORD":
+            _diff_level(col.get("fields", []), updated.get("fields", []), path + ".", diff)
+
+        cur_mode, updated_mode = normalize_mode(col.get("mode")), normalize_mode(updated.get("mode"))
+        if cur_mode != updated_mode:
+            if cur_mode == "REQUIRED" and updated_mode == "NULLABLE":
+                diff.mode_relaxed.append((path, cur_mode, updated_mode))
+            else:
+                diff.mode_changed.append((path, cur_mode, updated_mode))
+
+    # Relative order of the columns which are kept, added and dropped columns do not count as a reorder
+    common_updated = [_key(col) for col in updated_columns if _key(col) in cur_index]
+    for cur_key, updated_key in zip(common_cur, common_updated):
+        if cur_key != updated_key:
+            diff.reordered.append(prefix + cur_index[cur_key]["name"])
+
+
+## Diffing the current schema of a table against the updated one from its schema json, in one pass.
+## Both schemas are lists of {"name", "type", "mode", "fields"} dicts as written in schema_files
+## (or the schema_registry.Schema of the file, whose columns read the same way).
+def diff_schemas(cur_schema, updated_schema):
+    diff = SchemaDiff()
+    _diff_level(cur_schema, updated_schema, "", diff)
+    return diff
+
+
+## Applying the additive part of a diff (new columns, relaxed modes) to the current schema.
+## cur_fields are API representations (SchemaField.to_api_repr()), so descriptions, policy tags
+## and the order of the existing columns are kept, and new columns are appended at the end of their level.
+def merge_additive_changes(cur_fields, updated_schema):
+
+    merged = deepcopy(cur_fields)
+    updated_index = {_key(col): col for col in updated_schema}
+    cur_keys = set()
+
+    for field in merged:
+        key = _key(field)
+        cur_keys.add(key)
+        updated = updated_index.get(key)
+        if updated is None:
+            continue
+        if normalize_mode(field.get("mode")) == "REQUIRED" and normalize_mode(updated.get("mode")) == "NULLABLE":
+            field["mode"] = "NULLABLE"
+        if normalize_type(field["type"]) == "RECORD" and normalize_type(updated["type"]) == "RECORD":
+            field["fields"] = merge_additive_changes(field.get("fields", []), updated.get("fields", []))
+
+    for col in updated_schema:
+        if _key(col) not in cur_keys:
+            merged.append(_api_repr(col))
+    return merged
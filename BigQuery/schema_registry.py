@@ -0,0 +1,203 @@
+# [START imports]
+import hashlib
+import json
+import os
+import threading
+import time
+from collections.abc import Mapping, Sequence
+from copy import deepcopy
+
+
+SCHEMA_CACHE_VERSION = 2
+# A file modified this close to the time the cache is saved could change again without its modification time
+# changing, it is not cached (it is read again by the next run)
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+## Immutable column of a schema file. It reads like the {"name", "type", "mode", "fields"} dicts of
+## schema_files (col["name"], col.get("fields", [])), so the diff and DDL helpers take it as is;
+## nested fields are tuples of Columns and only the keys of the file are kept, in __slots__.
+class Column(Mapping):
+
+    __slots__ = ("_items",)
+
+    def __init__(self, items):
+        object.__setattr__(self, "_items", tuple(items))
+
+    @classmethod
+    def from_api_repr(cls, col):
+        if not isinstance(col, dict) or not isinstance(col.get("name"), str) or not isinstance(col.get("type"), str):
+            raise ValueError(f"Invalid column, a name and a type are needed: {col}")
+        return cls((key, tuple(cls.from_api_repr(sub_col) for sub_col in value) if key == "fields" else value)
+                   for key, value in col.items())
+
+    def __getitem__(self, key):
+        for item_key, value in self._items:
+            if item_key == key:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key, _ in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Column is immutable")
+
+    def to_api_repr(self):
+        return {key: [sub_col.to_api_repr() for sub_col in value] if key == "fields" else deepcopy(value)
+                for key, value in self._items}
+
+    def __repr__(self):
+        return repr(self.to_api_repr())
+
+
+## Immutable parsed schema file, a sequence of Columns identified by the sha256 of the file content.
+## The SchemaField list used to create and update tables is built once, the first time it is needed.
+class Schema(Sequence):
+
+    __slots__ = ("digest", "columns", "_schema_fields")
+
+    def __init__(self, digest, columns):
+        object.__setattr__(self, "digest", digest)
+        object.__setattr__(self, "columns", tuple(columns))
+        object.__setattr__(self, "_schema_fields", None)
+
+    def __getitem__(self, index):
+        return self.columns[index]
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Schema is immutable")
+
+    # The cloud SDK is imported the first time a table needs the SchemaFields, not by the offline validation
+    @property
+    def schema_fields(self):
+        if self._schema_fields is None:
+            from google.cloud import bigquery
+            fields = tuple(bigquery.SchemaField.from_api_repr(col.to_api_repr()) for col in self.columns)
+            object.__setattr__(self, "_schema_fields", fields)
+        return list(self._schema_fields)
+
+    def to_api_repr(self):
+        return [col.to_api_repr() for col in self.columns]
+
+    def __repr__(self):
+        return repr(self.to_api_repr())
+
+
+## Registry of the parsed schema files of a run, keyed by content hash.
+## Every file is hashed once per run and every distinct content is parsed once, only when a table needs it,
+## however many tables point at it. With a cache file the digest of every file is persisted with its
+## modification time and size, so on the next run an unchanged file is only stat-ed: it is neither read nor
+## hashed, and it is parsed only if a table needs its schema (i.e. its entry is not skipped by the state file).
+class SchemaRegistry:
+
+    def __init__(self):
+        self.parsed = 0
+        self.read = 0
+        self._by_digest = {}
+        self._by_path = {}
+        self._stats = {}
+        self._cached = {}
+        self._lock = threading.Lock()
+
+    # Reading a saved cache, {path: [mtime_ns, size, digest]}, a missing or unreadable file is ignored
+    def load_cache(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as file:
+                cache = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Ignoring the schema cache {path}.\n", e)
+            return
+        if cache.get("version") == SCHEMA_CACHE_VERSION:
+            with self._lock:
+                self._cached.update((file_path, tuple(value)) for file_path, value in cache.get("files", {}).items())
+
+    # Forgetting the file hashes of the previous run (files may have changed since), parsed schemas are kept
+    # and the files whose modification time and size did not change keep their digest without being read
+    def new_run(self):
+        with self._lock:
+            self._by_path = {}
+            self._cached.update(self._stats)
+            self._stats = {}
+
+    # Schema files hashed in this run, i.e. every schema file the manifest refers to
+    def paths(self):
+        with self._lock:
+            return list(self._by_path)
+
+    # Hashing a file once per run, returns (digest, content or None if the digest was already known).
+    # A file whose modification time and size match the cache keeps its cached digest without being read.
+    def _read(self, path):
+        with self._lock:
+            digest = self._by_path.get(path)
+        if digest is not None:
+            return digest, None
+
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._cached.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            with self._lock:
+                self._by_path[path] = cached[2]
+                self._stats[path] = cached
+            return cached[2], None
+
+        with open(path, "rb") as file:
+            content = file.read()
+            stat = os.fstat(file.fileno())
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            self.read += 1
+            self._by_path[path] = digest
+            self._stats[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest, content
+
+    # Content hash of a schema file without parsing it, None if it cannot be read
+    def digest(self, path):
+        try:
+            return self._read(path)[0]
+        except OSError:
+            return None
+
+    # Parsed schema of a schema file, raises OSError/ValueError if it cannot be read or is not a schema
+    def get(self, path):
+        digest, content = self._read(path)
+        with self._lock:
+            schema = self._by_digest.get(digest)
+        if schema is not None:
+            return schema
+
+        # A file whose digest came from the cache is only read when its schema is needed
+        if content is None:
+            with open(path, "rb") as file:
+                content = file.read()
+        columns = json.loads(content)
+        with self._lock:
+            self.parsed += 1
+        if not isinstance(columns, list):
+            raise ValueError(f"{path} does not hold a list of columns")
+
+        schema = Schema(digest, [Column.from_api_repr(col) for col in columns])
+        with self._lock:
+            return self._by_digest.setdefault(digest, schema)
+
+    # Writing the digest, modification time and size of the files seen in this run, the ones modified within
+    # RACY_WINDOW_NS of now are left out
+    def save(self, path):
+        now = time.time_ns()
+        with self._lock:
+            files = {file_path: list(value) for file_path, value in sorted(self._stats.items())
+                     if value[0] < now - RACY_WINDOW_NS}
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"version": SCHEMA_CACHE_VERSION, "files": files}, file)
+        os.replace(tmp_path, path)
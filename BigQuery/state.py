@@ -0,0 +1,78 @@
+# [START imports]
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+STATE_VERSION = 1
+
+
+# Content hash of a manifest entry, keys are sorted so reformatting objects_details does not change it
+def entry_hash(entry):
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# Content hash of the schema json file, a missing file gets no hash so the entry is never skipped
+def file_hash(path):
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    except OSError:
+        return None
+
+
+# The schema hash comes from the schema registry when given, so the file is read once for both
+def fingerprint(entry, schemas=None):
+    path = entry.get("schema_json", "")
+    return {"entry_hash": entry_hash(entry), "schema_hash": schemas.digest(path) if schemas is not None else file_hash(path)}
+
+
+## Local state of the last successful apply, one record per table id:
+## {"entry_hash", "schema_hash", "etag", "applied_at"}.
+## An entry whose manifest entry and schema file hash the same as in its record was already applied
+## and needs no API call at all.
+class StateFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            try:
+                with open(path) as file:
+                    state = json.load(file)
+                if state.get("version") == STATE_VERSION:
+                    self.tables = state.get("tables", {})
+            except (OSError, ValueError) as e:
+                print(f"WARNING: Ignoring the state file {path}.\n", e)
+
+    def is_unchanged(self, table_id, current):
+        record = self.tables.get(table_id)
+        return (record is not None and current["schema_hash"] is not None
+                and record["entry_hash"] == current["entry_hash"] and record["schema_hash"] == current["schema_hash"])
+
+    def etag(self, table_id):
+        return self.tables.get(table_id, {}).get("etag")
+
+    def record(self, table_id, current, etag):
+        with self._lock:
+            self.tables[table_id] = dict(current, etag=etag, applied_at=time.time())
+
+    def forget(self, table_id):
+        with self._lock:
+            self.tables.pop(table_id, None)
+
+    # A state without a path (watch mode with --no-state) is only kept in memory
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {"version": STATE_VERSION, "tables": dict(sorted(self.tables.items()))}
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,321 @@
+# [START imports]
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from migrations import format_bytes
+
+
+LEVELS = {"info": 20, "debug": 10}
+DEFAULT_LEVEL = "info"
+# Number of tables and operations listed in the summary at the end of a run
+DEFAULT_TOP = 10
+
+# Totals of a job shared by several tables (a merged DDL script) which are split between them,
+# the others (e.g. its wait time) count in full for each table
+SPLIT_TOTALS = ["bytes_processed", "slot_ms"]
+
+# Client methods which make an API request, the rest of the client is used as is
+INSTRUMENTED_METHODS = ["get_dataset", "create_dataset", "list_datasets", "list_tables",
+                        "get_table", "create_table", "update_table", "delete_table", "query"]
+
+
+## One timed unit of work: a table ("reconcile"), one of its operations, or a metadata update.
+## Every API call and job made while it is open (in the same thread) is added to it and to its parents.
+class Span:
+
+    def __init__(self, table_id, kind, parent):
+        self.id = uuid.uuid4().hex[:16]
+        self.table_id = table_id
+        self.kind = kind
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.duration = None
+        self.status = None
+        self.totals = Counter()
+
+    def add(self, **totals):
+        self.totals.update(totals)
+        if self.parent is not None:
+            self.parent.add(**totals)
+
+    def event(self):
+        return {"event": "span", "span_id": self.id, "parent_id": self.parent.id if self.parent else None,
+                "table_id": self.table_id, "kind": self.kind, "status": self.status,
+                "duration_ms": round(self.duration * 1000, 3), **self.totals}
+
+
+## Recorder of one run. Events are written as JSON lines to `events_path` when given, and spans are
+## kept for the summary of the slowest tables and operations printed at the end of the run (of each watch pass).
+class Telemetry:
+
+    def __init__(self, events_path=None, level=DEFAULT_LEVEL):
+        self.run_id = uuid.uuid4().hex[:16]
+        self.level = LEVELS[level]
+        self.spans = []
+        self.calls = Counter()
+        self.retries = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._events = open(events_path, "a") if events_path else None
+
+    def current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    # Spans the API calls of the calling thread are added to: the ones of attributed_to(), else the current one
+    def _spans(self):
+        attributed = getattr(self._local, "attributed", None)
+        if attributed:
+            return attributed
+        span = self.current()
+        return [span] if span is not None else []
+
+    ## Adding the API calls and jobs made by the calling thread to spans opened by other threads, e.g. the
+    ## DDL scheduler thread submitting and polling the statements of the tables. A span which has already
+    ## ended still gets the totals, its later job events carry its span_id.
+    @contextmanager
+    def attributed_to(self, spans):
+        previous = getattr(self._local, "attributed", None)
+        self._local.attributed = [span for span in spans if span is not None]
+        try:
+            yield
+        finally:
+            self._local.attributed = previous
+
+    def emit(self, event):
+        if self._events is None:
+            return
+        event = dict(event, run_id=self.run_id, ts=time.time(), thread=threading.current_thread().name)
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._events.write(line + "\n")
+
+    def start_span(self, table_id, kind):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        span = Span(table_id, kind, self.current())
+        self._local.stack.append(span)
+        return span
+
+    def end_span(self, span, status):
+        span.duration = time.perf_counter() - span.start
+        span.status = status
+        self._local.stack.pop()
+        # Its totals may still grow from another thread (attributed_to)
+        with self._lock:
+            self.spans.append(span)
+            event = span.event()
+        self.emit(event)
+
+    ## An API request or a finished job, added to the open spans of the calling thread (or the attributed ones).
+    ## A request or job of several tables is added to each of them, with its SPLIT_TOTALS split evenly.
+    def record(self, method, target, latency, error=None, **totals):
+        spans = self._spans()
+        with self._lock:
+            self.calls[method] += 1
+        event = {"event": "api_call", "method": method, "latency_ms": round(latency * 1000, 3),
+                 "error": repr(error) if error else None}
+        if not spans:
+            self.emit(dict(event, target=target, span_id=None, **totals))
+            return
+
+        if len(spans) > 1:
+            totals = {key: value / len(spans) if key in SPLIT_TOTALS else value for key, value in totals.items()}
+            event["shared_by"] = len(spans)
+        # A finished job is not a request of its own, its wait time is kept apart from the API latency
+        if method == "job":
+            span_totals = dict(job_ms=round(latency * 1000, 3), **totals)
+        else:
+            span_totals = dict(api_calls=1, api_ms=round(latency * 1000, 3), **totals)
+        for span in spans:
+            with self._lock:
+                span.add(**span_totals)
+            self.emit(dict(event, target=target or span.table_id, span_id=span.id, **totals))
+
+    def record_retry(self, exc):
+        spans = self._spans()
+        with self._lock:
+            self.retries += 1
+            for span in spans:
+                span.add(retries=1)
+        self.emit({"event": "retry", "span_id": spans[0].id if spans else None, "error": repr(exc)})
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+
+_telemetry = Telemetry()
+
+
+## Starting the telemetry of a run, events_path receives one JSON event per line
+def configure(events_path=None, level=DEFAULT_LEVEL):
+    global _telemetry
+    _telemetry.close()
+    _telemetry = Telemetry(events_path, level)
+    return _telemetry
+
+
+def get_telemetry():
+    return _telemetry
+
+
+# Verbose output (e.g. whole schemas) is only printed at the debug level
+def debug(*args):
+    if _telemetry.level <= LEVELS["debug"]:
+        print(*args)
+
+
+def record_retry(exc):
+    _telemetry.record_retry(exc)
+
+
+## Timing a span of work, the status is "failed" if the block raises, else the status set on the
+## yielded Span (or "ok").
+@contextmanager
+def span(table_id, kind):
+    telemetry = _telemetry
+    current = telemetry.start_span(table_id, kind)
+    try:
+        yield current
+    except Exception:
+        telemetry.end_span(current, "failed")
+        raise
+    telemetry.end_span(current, current.status or "ok")
+
+
+# Running func() in a span whose status is the status func returns
+def traced(table_id, kind, func, *args):
+    with span(table_id, kind) as current:
+        current.status = func(*args)
+        return current.status
+
+
+# The table (or dataset) an API call is about, from its first argument
+def _target(args, kwargs):
+    value = args[0] if args else next(iter(kwargs.values()), None)
+    if isinstance(value, str):
+        return value if not value.lstrip().upper().startswith(("ALTER", "CREATE", "DROP", "SELECT")) else None
+    for attributes in (("project", "dataset_id", "table_id"), ("project", "dataset_id")):
+        if all(getattr(value, name, None) for name in attributes):
+            return ".".join(str(getattr(value, name)) for name in attributes)
+    return None
+
+
+## Query job wrapper recording the job once it is finished: its bytes processed, slot-ms and wait time
+class _InstrumentedJob:
+
+    def __init__(self, job, telemetry, target):
+        self._job = job
+        self._telemetry = telemetry
+        self._target = target
+        self._start = time.perf_counter()
+        self._recorded = False
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def _record(self, error=None):
+        if self._recorded:
+            return
+        self._recorded = True
+        self._telemetry.record("job", self._target, time.perf_counter() - self._start, error=error,
+                               jobs=1, bytes_processed=self._job.total_bytes_processed or 0,
+                               slot_ms=getattr(self._job, "slot_millis", None) or 0)
+
+    def done(self, *args, **kwargs):
+        done = self._job.done(*args, **kwargs)
+        if done:
+            self._record(self._job.exception() if hasattr(self._job, "exception") else None)
+        return done
+
+    def result(self, *args, **kwargs):
+        try:
+            result = self._job.result(*args, **kwargs)
+        except Exception as e:
+            self._record(e)
+            raise
+        self._record()
+        return result
+
+
+## BigQuery client wrapper timing every API request, and every query job until it finishes.
+## Dry runs are recorded with the bytes they would scan as estimated_bytes.
+class InstrumentedClient:
+
+    def __init__(self, client, telemetry=None):
+        self._client = client
+        self._telemetry = telemetry
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name not in INSTRUMENTED_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            telemetry = self._telemetry or _telemetry
+            target = _target(args, kwargs)
+            start = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as e:
+                telemetry.record(name, target, time.perf_counter() - start, error=e)
+                raise
+            if name != "query":
+                telemetry.record(name, target, time.perf_counter() - start)
+                return result
+            if getattr(result, "dry_run", False):
+                telemetry.record("query", target, time.perf_counter() - start,
+                                 estimated_bytes=result.total_bytes_processed or 0)
+                return result
+            telemetry.record("query", target, time.perf_counter() - start)
+            return _InstrumentedJob(result, telemetry, target or (telemetry.current().table_id if telemetry.current() else None))
+        return call
+
+
+# The job wait is listed apart, a DDL statement submitted without waiting finishes after its span ended
+def _span_line(table_id, kind, duration, totals):
+    return (f"  {duration:8.2f}s  {table_id} [{kind}]  api_calls={totals.get('api_calls', 0)}"
+            f" retries={totals.get('retries', 0)} jobs={totals.get('jobs', 0)} job_wait={totals.get('job_ms', 0) / 1000:.2f}s"
+            f" bytes={format_bytes(totals.get('bytes_processed', 0))} slot_ms={round(totals.get('slot_ms', 0))}")
+
+
+## Printing the slowest tables (all the spans of a table added up) and the slowest single operations.
+## With clear the spans and counters are forgotten once printed, so a long running watch starts over after each pass.
+def print_summary(top=DEFAULT_TOP, clear=False):
+
+    telemetry = _telemetry
+    with telemetry._lock:
+        spans = list(telemetry.spans)
+        calls = dict(telemetry.calls)
+        retries = telemetry.retries
+        if clear:
+            telemetry.spans, telemetry.calls, telemetry.retries = [], Counter(), 0
+    if not spans and not calls:
+        return
+
+    tables = {}
+    for span in spans:
+        if span.parent is None:
+            duration, totals = tables.get(span.table_id, (0.0, Counter()))
+            tables[span.table_id] = (duration + span.duration, totals + span.totals)
+    slowest_tables = sorted(tables.items(), key=lambda item: item[1][0], reverse=True)[:top]
+    slowest_operations = sorted((span for span in spans if span.parent is not None),
+                                key=lambda span: span.duration, reverse=True)[:top]
+
+    print("Telemetry:-")
+    print(f"  API calls and jobs: {', '.join(f'{method}={count}' for method, count in sorted(calls.items()))}, retries={retries}")
+    if slowest_tables:
+        print("Slowest tables:-")
+        for table_id, (duration, totals) in slowest_tables:
+            print(_span_line(table_id, "table", duration, totals))
+    if slowest_operations:
+        print("Slowest operations:-")
+        for span in slowest_operations:
+            print(_span_line(span.table_id, span.kind, span.duration, span.totals))
+    print()
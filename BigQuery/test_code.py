@@ -1,39 +1,57 @@
 # [START imports]
-import json
-from collections import OrderedDict
-from copy import deepcopy
+import argparse
+import time
+from functools import partial
+from itertools import chain
+from google.api_core.exceptions import BadRequest, Conflict, NotFound
 from google.cloud import bigquery
 
-
+from bq_client import DEFAULT_POOL_SIZE, ClientManager
+from external import apply_external_options, ddl_options, ddl_partition_columns, external_option_changes, without_partition_keys
+from inventory import DEFAULT_MAX_AGE, DatasetLoader, project_cache_path
+from jobs import DEFAULT_LINGER, DdlScheduler
+from layout import apply_layout, layout_changes
+from manifest import DEFAULT_MANIFEST, entry_location, iter_manifest, shard_paths, source_name
+from metadata import MetadataBatch, label_delta, patch_table
+from migrations import (SAFE_WIDENINGS, alter_columns_sql, create_or_replace_external_sql, drop_columns_sql, estimate_bytes,
+                        format_bytes, layout_columns, lossy_changes, policy_tagged_columns, rewrite_with_casts_sql,
+                        rewrite_without_columns_sql)
+from plan import Operation, Replan, execute_plan, print_plan, refusal
+from reconcile import DEFAULT_WORKERS, ReconcileTask, fan_out, print_report, run_reconciliation
+from schema_diff import diff_schemas, merge_additive_changes
+from schema_registry import SchemaRegistry
+from state import StateFile, fingerprint
+import telemetry
+from telemetry import InstrumentedClient, debug
+from watch import DEFAULT_DEBOUNCE, DEFAULT_DRIFT_INTERVAL, DEFAULT_POLL_INTERVAL, watch
+
+
+# Project of the manifest entries without a "project" of their own (--project)
 project_id = "gcp-project-314410"
-objects_details = "BigQuery/objects_details.json"
+objects_details = DEFAULT_MANIFEST
+# State of the last apply, entries unchanged since then are skipped without any API call
+DEFAULT_STATE = "BigQuery/bq_state.json"
+# Parsed schema files of the run, shared by the create and diff paths (each file is parsed once)
+schemas = SchemaRegistry()
+# DDL jobs of the run, submitted without waiting and polled together by one thread
+ddl_jobs = DdlScheduler()
 
 ## Creating a native table in BigQuery and creating schema from a json file.
-def native_table_creation(project_id, dataset_name, table_name, json_schema_uri, labels):
-    try:
-        # Construct a BigQuery client object.
-        client = bigquery.Client(project = project_id)
-    except:
-        return f"WARNING: Unable to access the project {project_id}."
+def native_table_creation(client, project_id, dataset_name, table_name, json_schema_uri, labels, layout=None):
 
     #Definig SchemaField for table creation
-    bigquerySchema = []
-    with open(json_schema_uri) as f:
-        bigqueryColumns = json.load(f)
-        for col in bigqueryColumns:
-            bigquerySchema.append(bigquery.SchemaField(col['name'], col['type'], col['mode']))
+    bigquerySchema = schemas.get(json_schema_uri).schema_fields
 
     #Definig table structure for table creation
     tableRef = f"{project_id}.{dataset_name}.{table_name}"
     table = bigquery.Table(tableRef, schema=bigquerySchema)
 
     try:
-        # Raises:- google.cloud.exceptions.Conflict – If the table already exists.
-        table = client.create_table(table)
+        # Labels, partitioning, clustering, expiration and description are sent with the table itself
+        apply_layout(table, layout or {"table_name": table_name}, labels)
 
-        # Adding labels to the table
-        table.labels = labels
-        table = client.update_table(table, ["labels"])  # API request
+        # Raises:- google.cloud.exceptions.Conflict – If the table already exists.
+        table = client.create_table(table)  # API request
 
         return table
     except Exception as e:
@@ -41,43 +59,39 @@ def native_table_creation(project_id, dataset_name, table_name, json_schema_uri,
         return e
 
 
-## Creating and external_table with schema from json file
-def external_table_creation(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels):
+## External data configuration of an external table, with the hive partitioning and format options of its entry
+def external_data_configuration(source_format, source_uris, bigquerySchema, entry=None):
 
-    try:
-        # Construct a BigQuery client object.
-        client = bigquery.Client(project = project_id)
-    except:
-        return f"WARNING: Unable to access the project {project_id}."
-
-    #Definig SchemaField for table creation
-    bigquerySchema = []
-    with open(json_schema_uri) as f:
-        bigqueryColumns = json.load(f)
-        for col in bigqueryColumns:
-            bigquerySchema.append(bigquery.SchemaField(col['name'], col['type'], col['mode']))
-
-    #Definig table structure for table creation
-    tableRef = f"{project_id}.{dataset_name}.{ext_table_name}"
-    table = bigquery.Table(tableRef, schema=bigquerySchema)
-
-    # Definig external table
     external_config = bigquery.ExternalConfig(source_format)
     external_config.autodetect = False
     external_config.schema = bigquerySchema
     external_config.source_uris = source_uris
-    table.external_data_configuration = external_config
+    apply_external_options(external_config, entry or {})
 
     # For more details on parameters and attributes visit on the link
     # https://googleapis.dev/python/bigquery/latest/generated/google.cloud.bigquery.external_config.ExternalConfig.html#google.cloud.bigquery.external_config.ExternalConfig
+    return external_config
+
+
+## Creating and external_table with schema from json file
+def external_table_creation(client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, layout=None):
+
+    #Definig SchemaField for table creation, the hive partition keys are added by BigQuery
+    bigquerySchema = without_partition_keys(schemas.get(json_schema_uri).schema_fields, layout or {})
+
+    #Definig table structure for table creation
+    tableRef = f"{project_id}.{dataset_name}.{ext_table_name}"
+    table = bigquery.Table(tableRef, schema=bigquerySchema)
+
+    # Definig external table
+    table.external_data_configuration = external_data_configuration(source_format, source_uris, bigquerySchema, layout)
 
     try:
-        # Raises:- google.cloud.exceptions.Conflict – If the table already exists.
-        table = client.create_table(table)
+        # Labels, expiration and description are sent with the table itself
+        apply_layout(table, layout or {"table_name": ext_table_name}, labels, external=True)
 
-        # Adding labels to the table
-        table.labels = labels
-        table = client.update_table(table, ["labels"])  # API request
+        # Raises:- google.cloud.exceptions.Conflict – If the table already exists.
+        table = client.create_table(table)  # API request
 
         return table
     except Exception as e:
@@ -86,7 +100,7 @@ def external_table_creation(project_id, dataset_name, ext_table_name, json_schem
 
 
 #Create dataset in Project at default dataset location
-def create_dataset(project_id, dataset_name, dataset_location):
+def create_dataset(client, project_id, dataset_name, dataset_location):
     # Set dataset_id to the ID of the dataset to create.
     # dataset_id = "{}.your_dataset".format(client.project)
 
@@ -106,418 +120,726 @@ def create_dataset(project_id, dataset_name, dataset_location):
         return e
 
 
-# Getting the table schema from BigQuery
-def get_table_schema(project_id, dataset_name, table_name):
+# Converting a SchemaField to the schema_files format, RECORD columns keep their nested fields
+def schema_field_to_dict(field):
+    col = {"name":field.name,"type":field.field_type,"mode":field.mode}
+    if field.fields:
+        col["fields"] = [schema_field_to_dict(sub_field) for sub_field in field.fields]
+    return col
+
 
-    bq_table_schema = []
+# Getting the table schema from BigQuery
+def get_table_schema(client, project_id, dataset_name, table_name):
 
-    client = bigquery.Client()
     table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")  # Make an API request.
 
     # View table properties
     print("Got table schema for '{}.{}.{}'.".format(table.project, table.dataset_id, table.table_id))
 
-    for schema in table.schema:
-        bq_table_schema.append({"name":schema.name,"type":schema.field_type,"mode":schema.mode})
+    return [schema_field_to_dict(field) for field in table.schema]
 
-    return bq_table_schema
 
+# Running a DDL statement through the shared job scheduler, metadata-only statements of the same dataset
+# are merged with the ones other tables submit at the same time into one script job.
+# Waits for the job, or with wait=False returns the future of the statement right away.
+def run_ddl(client, table_id, sql, message=None, mergeable=True, wait=True):
+    if not wait:
+        return ddl_jobs.submit(client, table_id, sql, mergeable)
+    query_job = ddl_jobs.run(client, table_id, sql, mergeable)  # Make an API request.
+    if message:
+        print(message)
+    return query_job
 
-# Returning the changed_columns in the current schema of the table
-def changed_columns(cur_schema,updated_schema):
 
-    #Comparing both schemas and removing the same Columns
-    #At last only the extra column will be left which will removed or added based on condition
-    temp1 = deepcopy(cur_schema)
-    temp2 = deepcopy(updated_schema)
+# Running a full-table rewrite as a job of its own, showing the bytes its dry run reported first
+def run_rewrite(client, table_id, sql, estimated_bytes, message=None):
+    print(f"Rewriting the table, the dry run estimated {format_bytes(estimated_bytes)} to be scanned . . .")
+    return run_ddl(client, table_id, sql, message, mergeable=False)
 
-    if len(updated_schema)>len(cur_schema):
-        for col1 in cur_schema:
-            for col2 in updated_schema:
-                if col1['name']==col2['name']:
-                    if col1['type']==col2['type']:
-                        temp1.remove(col1)
-                        temp2.remove(col2)
-        return temp2
 
-    else:
-        for col1 in updated_schema:
-            for col2 in cur_schema:
-                if col1['name']==col2['name']:
-                    if col1['type']==col2['type']:
-                        temp1.remove(col2)
-                        temp2.remove(col1)
-        return temp1
+# Patching the new columns and REQUIRED -> NULLABLE relaxations into the current schema of the table
+def add_columns(client, table_id, updated_schema):
 
+    table = client.get_table(table_id)
 
-# Checking if the labels for the object have been changed
-def changed_lables(cur_lables, updated_lables):
+    # Existing columns keep their descriptions and policy tags, new ones are appended
+    new_schema = merge_additive_changes([field.to_api_repr() for field in table.schema], updated_schema)
 
-    dict1 = OrderedDict(sorted(cur_lables.items()))
-    dict2 = OrderedDict(sorted(updated_lables.items()))
+    table.schema = [bigquery.SchemaField.from_api_repr(field) for field in new_schema]
+    table = client.update_table(table, ["schema"])  # Make an API request.
+
+    print("A new column/s have been added to table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
+    return table
+
+
+## Planning one field-masked update of the labels, description, clustering and partition filter of a table.
+## Only the changed label keys are sent, and everything goes in a single request.
+## labels is None when another operation of the plan already patches them (external table updates).
+def plan_metadata_changes(client, table_id, table, labels, layout):
+
+    patch = {}
+    if labels is not None:
+        updated_lables = labels
+        cur_lables = table.labels
+
+        debug(f"\nLabels:- \nNew - {sorted(updated_lables.items())}\nCurrent - {sorted(cur_lables.items())}\n")
+
+        delta = label_delta(cur_lables, updated_lables)
+        if delta:
+            patch["labels"] = delta
+        else:
+            print("No changes have been made to lables.\n")
+
+    # Partitioning changes are only reported, they cannot be applied in place
+    fields, warnings = layout_changes(table, layout)
+    for warning in warnings:
+        print(f"WARNING: {table_id} {warning}.\n")
+    for field in fields:
+        patch[field] = getattr(table, field)
+
+    if not patch:
+        return []
+    description = ", ".join(f"{field}={value}" for field, value in patch.items())
+    return [Operation(table_id, "update_metadata", f"Patch {description}", partial(patch_table, client, table_id, patch))]
+
+
+# Refusing a rewrite of a table with policy tags on the columns it keeps, CREATE OR REPLACE would silently remove
+# their column-level access control. None when no kept column has policy tags.
+def untagging_refusal(table, table_id, dropped=()):
+    dropped = {name.lower() for name in dropped}
+    tagged = [path for path in policy_tagged_columns(table.schema) if path.split(".")[0].lower() not in dropped]
+    if not tagged:
+        return None
+    print(f"WARNING: Refusing to rewrite {table_id}, it would remove the policy tags of {', '.join(tagged)}.\n"
+          f"Remove the policy tags or migrate the table by hand.\n")
+    return refusal(table_id, f"Rewrite removing the policy tags of {', '.join(tagged)}")
+
+
+# Planning the changes for the native table, only reading from BigQuery (one get_table call)
+def plan_native_table_changes(client, project_id, dataset_name, table_name, json_schema_uri, labels, allow_lossy=(), layout=None):
+    updated_schema = schemas.get(json_schema_uri)
+
+    table_id = f"{project_id}.{dataset_name}.{table_name}"
+    table = client.get_table(table_id)  # Make an API request.
+    cur_schema = [schema_field_to_dict(field) for field in table.schema]
+
+    ## One pass over both schemas gives the added, dropped and changed columns (nested ones included)
+    ## Only a change of column order is not applied, a native table keeps its column order
+    diff = diff_schemas(cur_schema, updated_schema)
+
+    if diff.has_changes():
+        debug(f"\n{updated_schema}\n{cur_schema}\n")
+        print(f"Schema changes:- {diff.summary()}\n")
+
+    operations = []
+
+    # A refused table is not recorded in the state file, so it is checked again on every run until it is fixed
+    required = [path for path, col in diff.added if col.get('mode', "NULLABLE").upper() == "REQUIRED"]
+    if required:
+        print(f"Cannot add mode='REQUIRED' for fields to an existing schema.\n{', '.join(required)}")
+        return table, [refusal(table_id, f"Add REQUIRED column/s {', '.join(required)} to an existing table")]
+
+    # Safe widenings and relaxations of top-level columns are metadata-only ALTER COLUMN changes
+    widenings = [change for change in diff.type_changed if "." not in change[0] and change[1:] in SAFE_WIDENINGS]
+    relaxations = [change for change in diff.mode_relaxed if "." not in change[0]]
+
+    # Every other type change, tightened modes and nested drops need the data to be rewritten
+    rewrite = ([change for change in diff.type_changed if change not in widenings] or diff.mode_changed
+               or any("." in path for path, _ in diff.dropped))
+
+    if rewrite:
+        lossy = lossy_changes(diff)
+        # allow_lossy holds full table ids (lossy_confirmations), a table name alone never confirms anything
+        if lossy and table_id not in allow_lossy:
+            print(f"WARNING: Refusing to migrate {table_id}, these changes can lose data: {', '.join(lossy)}\n"
+                  f"Run again with --allow-lossy {table_id} to confirm them.\n")
+            return table, [refusal(table_id, f"Migrate {', '.join(lossy)} without --allow-lossy {table_id}")]
+
+        refused = untagging_refusal(table, table_id, [path for path, _ in diff.dropped if "." not in path])
+        if refused is not None:
+            return table, [refused]
+
+        # One CAST pass over the data which keeps partitioning, clustering and labels
+        sql = rewrite_with_casts_sql(table, table_id, cur_schema, updated_schema)
+        estimated = estimate_bytes(client, sql)
+        message = "{} Table schema have been updated. \n".format(table_id)
+        operations.append(Operation(table_id, "rewrite", f"{sql} (dry run: scans {format_bytes(estimated)})",
+                                    partial(run_rewrite, client, table_id, sql, estimated, message)))
+
+    elif diff.has_changes():
+
+        if diff.dropped:
+            #Getting the list of column names to be removed
+            col_names = [path for path, _ in diff.dropped]
+            message = f"A column/s have been deleted from table {table_id}\n"
+
+            # Partitioning and clustering columns cannot be dropped in place, only then the table is rewritten
+            if any(name.lower() in layout_columns(table) for name in col_names):
+                refused = untagging_refusal(table, table_id, col_names)
+                if refused is not None:
+                    return table, [refused]
+                sql = rewrite_without_columns_sql(table, table_id, col_names)
+                estimated = estimate_bytes(client, sql)
+                operations.append(Operation(table_id, "rewrite", f"{sql} (dry run: scans {format_bytes(estimated)})",
+                                            partial(run_rewrite, client, table_id, sql, estimated, message)))
+            else:
+                # Metadata-only, every dropped column in one statement
+                sql = drop_columns_sql(table_id, col_names)
+                operations.append(Operation(table_id, "ddl", sql, partial(run_ddl, client, table_id, sql, message)))
+
+        if widenings or relaxations:
+            sql = alter_columns_sql(table_id, widenings, relaxations)
+            message = f"The column/s of table {table_id} have been altered\n"
+            operations.append(Operation(table_id, "ddl", sql, partial(run_ddl, client, table_id, sql, message)))
+
+        #Additional Columns and nested REQUIRED -> NULLABLE relaxations are patched into the current schema
+        nested_relaxations = [change for change in diff.mode_relaxed if change not in relaxations]
+        if diff.added or nested_relaxations:
+            changes = [path for path, _ in diff.added] + [path for path, _, _ in nested_relaxations]
+            operations.append(Operation(table_id, "update_schema", f"Add/relax column/s {', '.join(changes)}",
+                                        partial(add_columns, client, table_id, updated_schema)))
 
-    if dict1 == dict2:
-        return
     else:
-        return updated_lables
+        print("No changes have been made to schema.\n")
 
+    ## After Checking for the schmea checking for changes in lables for the bq_table_schema,
+    ## patched after the schema operations so one edit of both converges in a single apply
+    operations.extend(plan_metadata_changes(client, table_id, table, labels, layout or {}))
 
-# Checking and applying the changes for the native table
-def native_table_changes(project_id, dataset_name, table_name, json_schema_uri, labels):
-    with open(json_schema_uri) as file:
-        updated_schema = json.load(file)
-    cur_schema = get_table_schema(project_id, dataset_name, table_name)
+    return table, operations
 
-    # Construct a BigQuery client object.
-    client = bigquery.Client()
 
-    ## Check If the columns have been added or removed or the number of columns are same
-    if len(updated_schema)!=len(cur_schema):
+## Updating an external table in place: one field-masked patch of its schema, external data configuration
+## and changed label keys. Only when BigQuery refuses the patch the table is replaced atomically with
+## CREATE OR REPLACE EXTERNAL TABLE, so the table is never missing for the queries using it.
+def update_external_table(client, table_id, updated_schema, source_format, source_uris, labels, layout=None, label_patch=None):
 
-        #Additional Columns
-        if len(updated_schema)>len(cur_schema):
-            print(f"\n{updated_schema}\n{cur_schema}\n")
-            print("\nAdding new column/s . . .\n")
+    bigquerySchema = without_partition_keys(updated_schema.schema_fields, layout or {})
 
-            #to find the Additional Columns
-            Columns = changed_columns(cur_schema,updated_schema)
+    table = bigquery.Table(table_id, schema=bigquerySchema)
+    table.external_data_configuration = external_data_configuration(source_format, source_uris, bigquerySchema, layout)
+    fields = ["schema", "external_data_configuration"]
+    if label_patch:
+        table.labels = label_patch
+        fields.append("labels")
 
-            table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")
+    try:
+        table = client.update_table(table, fields)  # API request
+        print("{}.{}.{} External table have been updated in place. \n".format(table.project, table.dataset_id, table.table_id))
+        return table
 
-            original_schema = table.schema
-            try:
-                new_schema = original_schema[:]  # Creates a copy of the schema.
+    except BadRequest as e:
+        print(f"External table {table_id} cannot be updated in place, replacing it atomically . . .\n", e)
 
-                # Adding the Additional Columns
-                for col in Columns:
-                    if col['mode'].lower() == "required":
-                        raise Exception(f"Cannot add mode='REQUIRED' for fields to an existing schema.\n{col['name']} {col['type']} {col['mode']}")
-                    new_schema.append(bigquery.SchemaField(col['name'], col['type'], col['mode']))
+    sql = create_or_replace_external_sql(table_id, without_partition_keys(updated_schema, layout or {}), source_format, source_uris,
+                                         labels=labels, description=(layout or {}).get("description"),
+                                         external_options=ddl_options(layout or {}), partition_columns=ddl_partition_columns(layout or {}))
+    run_ddl(client, table_id, sql, "{} External table have been replaced. \n".format(table_id))
+    return client.get_table(table_id)  # Make an API request.
 
-                table.schema = new_schema
-                table = client.update_table(table, ["schema"])  # Make an API request.
 
-                if len(table.schema) >= len(original_schema):
-                    print("A new column/s have been added to table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-                else:
-                    print("The column/s have not been added table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
+# Planning the changes for the external table, only reading from BigQuery (one get_table call)
+def plan_external_table_changes(client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, layout=None):
 
-            except Exception as e:
-                print(e)
+    updated_schema = schemas.get(json_schema_uri)
 
-        elif len(updated_schema)<len(cur_schema):
-            print(f"\n{updated_schema}\n{cur_schema}\n")
-            print("\nRemoving a column/s . . .\n")
+    table_id = f"{project_id}.{dataset_name}.{ext_table_name}"
+    table = client.get_table(table_id)  # Make an API request.
+    # The hive partition key columns come from the paths, they are compared as part of the data configuration
+    cur_schema = [schema_field_to_dict(field) for field in without_partition_keys(table.schema, layout or {})]
 
-            #to find the Columns to be deleted
-            Columns = changed_columns(cur_schema,updated_schema)
+    # Only the changed label keys are patched together with the new definition, the description after it
+    update = partial(update_external_table, client, table_id, updated_schema, source_format, source_uris, labels, layout,
+                     label_delta(table.labels, labels))
+    metadata = partial(plan_metadata_changes, client, table_id, table, None, layout or {})
 
-            #Getting the list of column names to be removed
-            col_names = []
-            for col in Columns:
-                col_names.append(col["name"])
-            col_names = ", ".join(col_names)
+    # In case of external table the schema and data configuration are updated in place
+    debug(f"\n{updated_schema}\n{cur_schema}\n")
 
-            table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")
+    # The column order matters for external data (e.g. CSV), so a reorder is a change as well
+    diff = diff_schemas(cur_schema, without_partition_keys(updated_schema, layout or {}))
+    if diff.has_changes(include_reorder=True):
+        print(f"Schema changes:- {diff.summary()}\n")
+        return table, [Operation(table_id, "update_external", f"Update schema in place ({diff.summary()})", update)] + metadata()
 
-            # keeping the copy of original schema to compare the changes after update
-            original_schema = table.schema
+    print("No changes have been made to schema.\n")
 
-            sql = f"""CREATE OR REPLACE TABLE {project_id}.{dataset_name}.{table_name} AS SELECT * EXCEPT ({col_names}) FROM {project_id}.{dataset_name}.{table_name}"""
+    ## After Checking for the schmea checking for changes in lables or Source details for the external table
+    # Getting the external table data configuration
+    external_config = table.external_data_configuration
 
-            query_job = client.query(sql)  # Make an API request.
-            query_job.result()  # Wait for the job to complete.
+    updated_source_format = source_format
+    current_source_format = external_config.source_format
 
-            table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")
+    # To sort the uris to compare
+    updated_source_uris = sorted(source_uris)
+    current_source_uris = sorted(external_config.source_uris)
 
-            if len(table.schema)<len(original_schema):
-                print("A column/s have been deleted from table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-            else:
-                print("The column/s have not been deleted from table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
+    # Printing the Ordered labels
+    debug(f"Source Format:- \nNew - {updated_source_format}\nCurrent - {current_source_format}\n")
+    debug(f"Source uris:- \nNew - {updated_source_uris}\nCurrent - {current_source_uris}\n")
 
-    else:
-        # Case where number of columns are same but have changes in schema.
-        print(f"\n{updated_schema}\n{cur_schema}\n")
+    # Hive partitioning and format options (e.g. skip_leading_rows) set in the manifest
+    option_changes = external_option_changes(external_config, external_data_configuration(source_format, source_uris, [], layout))
+    debug(f"External options:- \nChanges - {option_changes}\n")
 
-        if changed_columns(cur_schema,updated_schema):
-            try:
+    # A change in the external configuration is patched in place as well
+    if current_source_format!=updated_source_format or current_source_uris!=updated_source_uris:
+        return table, [Operation(table_id, "update_external", f"Update data configuration in place ({updated_source_format} {updated_source_uris})", update)] + metadata()
+    if option_changes:
+        return table, [Operation(table_id, "update_external", f"Update external options in place ({'; '.join(option_changes)})", update)] + metadata()
 
-                # Creting a new_schema to replace the previous table.
-                col_details = []
-                for col in updated_schema:
-                    col_details.append(f"""{col['name']} {col['type']} {"NOT NULL" if col['mode']=="REQUIRED" else ""}""")
-                col_details = ", ".join(col_details)
+    print("No changes have been made to data configuration for external table.\n")
 
-                sql = f"""CREATE OR REPLACE TABLE {project_id}.{dataset_name}.{table_name} ({col_details})"""
+    return table, plan_metadata_changes(client, table_id, table, labels, layout or {})
 
-                query_job = client.query(sql)  # Make an API request.
-                query_job.result()  # Wait for the job to complete.
 
-                table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")
+# Checking and applying the changes for the native table
+def native_table_changes(client, project_id, dataset_name, table_name, json_schema_uri, labels, layout=None):
+    _, operations = plan_native_table_changes(client, project_id, dataset_name, table_name, json_schema_uri, labels, layout=layout)
+    status, _ = execute_plan(f"{project_id}.{dataset_name}.{table_name}", operations)
+    return status
 
-                print("{}.{}.{} Table schema have been updated. \n".format(table.project, table.dataset_id, table.table_id))
 
-            except Exception as e:
-                print(e)
-                return
-        else:
-            print("No changes have been made to schema.\n")
+# Checking and applying the changes for the external table
+def external_table_changes(client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, layout=None):
+    _, operations = plan_external_table_changes(client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, layout)
+    status, _ = execute_plan(f"{project_id}.{dataset_name}.{ext_table_name}", operations)
+    return status
 
-            ## After Checking for the schmea checking for changes in lables for the bq_table_schema
-            ## If there is change updating the external_table_list
-            table = client.get_table(f"{project_id}.{dataset_name}.{table_name}")
 
-            updated_lables = labels
-            cur_lables = table.labels
+# Creating a table with one of the creation helpers and adding it to the inventory
+def create_table(inventory, creation, dataset_name, table_name, *args):
 
-            print(f"\nLabels:- \nNew - {sorted(updated_lables.items())}\nCurrent - {sorted(cur_lables.items())}\n")
-            if changed_lables(cur_lables, updated_lables):
+    table = creation(*args)
+    # The table was created outside of this tool since the inventory of its dataset was listed
+    if isinstance(table, Conflict):
+        raise Replan(f"{dataset_name}.{table_name} already exists") from table
+    if isinstance(table, Exception):
+        raise table
 
-                table.labels = updated_lables
-                table = client.update_table(table, ["labels"])  # API request
+    print("Created table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
+    inventory.add_table(dataset_name, table_name)
+    return table
 
-                print("{}.{}.{} Table's labels have been updated. \n".format(table.project, table.dataset_id, table.table_id))
 
-            else:
-                print("No changes have been made to lables.\n")
-            return
+# Recording an applied table in the state file with the etag it has now
+def record_state(state, table_id, current, table):
+    if state is not None:
+        state.record(table_id, current, table.etag)
 
 
-# Checking and applying the changes for the external table
-def external_table_changes(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels):
+# Recording a DDL statement finished after the reconciliation in the state file
+def ddl_finished(client, state, table_id, current, status):
+    if state is None:
+        return
+    if status == "applied":
+        state.record(table_id, current, client.get_table(table_id).etag)  # Make an API request.
+    else:
+        state.forget(table_id)
+
+
+# Printing/applying the operations of one table and recording the result in the state file
+def finish_table(client, table_id, table, operations, dry_run, state, current, batch=None):
+
+    # Metadata-only changes are queued for the bulk metadata update stage
+    if batch is not None and operations and not dry_run and all(op.kind == "update_metadata" for op in operations):
+        print_plan(table_id, operations)
+        for operation in operations:
+            batch.add(operation, partial(record_state, state, table_id, current))
+        return "queued"
+
+    # A lone DDL statement is submitted without waiting, its job is finished with the others after the reconciliation
+    if operations and not dry_run and len(operations) == 1 and operations[0].kind == "ddl":
+        print_plan(table_id, operations)
+        ddl_jobs.track(table_id, operations[0].apply(wait=False), partial(ddl_finished, client, state, table_id, current))
+        return "submitted"
+
+    status, result = execute_plan(table_id, operations, dry_run=dry_run)
+
+    if state is not None and status in ("applied", "no changes"):
+        # The etag of the applied table, it tells on a --refresh run if the table was changed outside of this tool.
+        # The last operation returns the table with its new etag (create, schema, external and metadata updates),
+        # only a DDL job costs one more request for it.
+        if status == "applied":
+            table = result if isinstance(result, bigquery.Table) else client.get_table(table_id)  # Make an API request.
+        state.record(table_id, current, table.etag)
+    elif state is not None and status in ("failed", "refused"):
+        state.forget(table_id)
+    return status
+
+
+# Reconciling one native table of objects_details, its dataset already exists at this point
+def reconcile_native_table(client, project_id, inventory, entry, dry_run=False, state=None, current=None, allow_lossy=(), batch=None):
+
+    # Table details
+    dataset_name = entry['dataset_name']
+    table_name = entry['table_name']
+    json_schema_uri = entry['schema_json']
+    labels = entry['labels']
+    table_id = f"{project_id}.{dataset_name}.{table_name}"
+
+    # To check table is not already present in BigQuery dataset
+    if not inventory.has_table(dataset_name, table_name):
+        table = None
+        operations = [Operation(table_id, "create_table", f"Create table from {json_schema_uri}",
+                                partial(create_table, inventory, native_table_creation, dataset_name, table_name,
+                                        client, project_id, dataset_name, table_name, json_schema_uri, labels, entry))]
+    else:
+        print(f"\nWARNING: Table {table_name} Already EXISTS in dataset {dataset_name} ! ! !\n\n Looking for changes . . . \n\n")
+        table, operations = plan_native_table_changes(client, project_id, dataset_name, table_name, json_schema_uri, labels, allow_lossy, entry)
+
+    return finish_table(client, table_id, table, operations, dry_run, state, current, batch)
+
+
+# Reconciling one external table of objects_details, its dataset already exists at this point
+def reconcile_external_table(client, project_id, inventory, entry, dry_run=False, state=None, current=None, allow_lossy=(), batch=None):
+
+    # External table details
+    dataset_name = entry['dataset_name']
+    ext_table_name = entry['table_name']
+    json_schema_uri = entry['schema_json']
+    source_format = entry['source_format']
+    source_uris = entry['source_uris']
+    labels = entry['labels']
+    table_id = f"{project_id}.{dataset_name}.{ext_table_name}"
+
+    # To check if external table is not already present in BigQuery dataset
+    if not inventory.has_table(dataset_name, ext_table_name):
+        table = None
+        operations = [Operation(table_id, "create_table", f"Create external table from {json_schema_uri} over {source_uris}",
+                                partial(create_table, inventory, external_table_creation, dataset_name, ext_table_name,
+                                        client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, entry))]
+    else:
+        print(f"\nWARNING: External table {ext_table_name} Already EXISTS in dataset {dataset_name} ! ! !\n\n Looking for changes . . . \n\n")
+        table, operations = plan_external_table_changes(client, project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels, entry)
 
-    with open(json_schema_uri) as file:
-        updated_schema = json.load(file)
-    cur_schema = get_table_schema(project_id, dataset_name, ext_table_name)
+    return finish_table(client, table_id, table, operations, dry_run, state, current, batch)
 
-    # Construct a BigQuery client object.
-    client = bigquery.Client()
 
-    # In case of external table we are dropping the table and creating a new one wit the new schema
-    print(f"\n{updated_schema}\n{cur_schema}\n")
+## Reconciling one entry, the inventory it is planned from is a hint: a table created (Conflict) or deleted (NotFound)
+## outside of this tool does not change the dataset etag the cached inventory is revalidated with. Then the dataset
+## is listed again with relist(dataset_name) and the entry is reconciled once more.
+def reconcile_entry(reconciler, relist, client, project_id, inventory, entry, *args):
+    try:
+        return reconciler(client, project_id, inventory, entry, *args)
+    except (Replan, NotFound) as e:
+        if relist is None:
+            raise
+        print(f"WARNING: The inventory of {project_id}.{entry['dataset_name']} is out of date, listing it again.\n", e)
+        relist(entry['dataset_name'])
+        return reconciler(client, project_id, inventory, entry, *args)
 
-    if changed_columns(cur_schema,updated_schema):
-        try:
 
-            # Dropping the original external_table
-            table_id = f"{project_id}.{dataset_name}.{ext_table_name}"
+# Checking on a --refresh run whether an unchanged entry was modified in BigQuery since it was applied
+def table_drifted(client, table_id, state):
+    try:
+        return client.get_table(table_id).etag != state.etag(table_id)  # Make an API request.
+    except NotFound:
+        return True
 
-            # If the table does not exist, delete_table raises
-            # google.api_core.exceptions.NotFound unless not_found_ok is True.
-            client.delete_table(table_id, not_found_ok=True)  # Make an API request.
-            print("Deleted old external table '{}'.".format(table_id))
 
-            table = external_table_creation(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels)
+## Reconciling an entry unchanged since the last apply on a --refresh run. Its etag is checked on the worker pool
+## like any other table, and it is only reconciled when it was changed outside of this tool since then.
+def reconcile_if_drifted(reconciler, client, project_id, inventory, entry, dry_run=False, state=None, current=None, *args):
+    table_id = f"{project_id}.{entry['dataset_name']}.{entry['table_name']}"
+    if not table_drifted(client, table_id, state):
+        return "unchanged"
+    print(f"WARNING: {table_id} was changed outside of this tool since the last apply.")
+    return reconciler(client, project_id, inventory, entry, dry_run, state, current, *args)
 
-            print("{}.{}.{} Table schema have been updated. \n".format(table.project, table.dataset_id, table.table_id))
 
-        except Exception as e:
-            print(e)
-            return
+# Full table ids of the --allow-lossy values, DATASET.TABLE is a table of the default project.
+# Raises ValueError for any other value, e.g. a bare table name which would confirm the table of every dataset.
+def lossy_confirmations(values, default_project):
+    table_ids = set()
+    for value in values:
+        parts = value.split(".")
+        if len(parts) not in (2, 3) or not all(parts):
+            raise ValueError(f"--allow-lossy takes DATASET.TABLE or PROJECT.DATASET.TABLE, not {value!r}")
+        table_ids.add(value if len(parts) == 3 else f"{default_project}.{value}")
+    return table_ids
 
-    else:
-        print("No changes have been made to schema.\n")
 
-        ## After Checking for the schmea checking for changes in lables or Source details for the external table
-        ## If there is change updating the external table details
-        table_id = f"{project_id}.{dataset_name}.{ext_table_name}"
-        table = client.get_table(table_id)
+# Creating a missing dataset for the reconciliation, raising if it could not be created
+def ensure_dataset(client, project_id, dataset_name, dataset_location, dry_run=False):
 
-        # Getting the external table data configuration
-        external_config = table.external_data_configuration
+    # Creating a new dataset if not present in the project
+    print(f"\nDataset {dataset_name} does not EXISTS ! ! !\n\nCreating new Dataset {dataset_name} in project {project_id}. . .")
 
-        updated_source_format = source_format
-        current_source_format = external_config.source_format
+    if dry_run:
+        print(f"Plan for {project_id}.{dataset_name}:-\n  1. [create_dataset] Create dataset in {dataset_location}\n")
+        return "planned"
 
-        updated_source_uris = source_uris
-        current_source_uris = external_config.source_uris
+    dataset = create_dataset(client, project_id, dataset_name, dataset_location)
+    if isinstance(dataset, Exception):
+        print(f"WARNING: Unable to create a new dataset {dataset_name} in the project {project_id}.\n",dataset)
+        return "failed"
 
-        # To sort the uris to compare
-        updated_source_uris.sort()
-        current_source_uris.sort()
+    print("Created dataset {}.{}\n".format(client.project, dataset.dataset_id))
+    return "created"
 
-        # Printing the Ordered labels
-        print(f"Source Format:- \nNew - {updated_source_format}\nCurrent - {current_source_format}\n")
-        print(f"Source uris:- \nNew - {updated_source_uris}\nCurrent - {current_source_uris}\n")
 
-        if current_source_format!=updated_source_format or current_source_uris!=updated_source_uris:
-            try:
+# Streaming the objects of the manifest (files, directories or globs of shards) in order, yielding (reconciler, entry)
+def manifest_entries(source):
 
-                # Dropping the original external_table
-                # If there is any change in external configuration we have to create the table again
-                client.delete_table(table_id, not_found_ok=True)  # Make an API request.
-                print("Deleted old external table '{}'.".format(table_id))
+    reconcilers = {'na_tables_list': reconcile_native_table, 'ex_tables_list': reconcile_external_table}
 
-                table = external_table_creation(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels)
+    for obj, entry, _ in iter_manifest(source):
+        yield reconcilers[obj], entry
 
-                print("{}.{}.{} Table data configuration have been updated. \n".format(table.project, table.dataset_id, table.table_id))
 
-            except Exception as e:
-                print(e)
-                return
+## Yielding (reconciler, entry, fingerprint) of the entries to check, entries whose manifest entry and schema
+## file did not change since the last apply cost no API call. With refresh (--refresh) unchanged entries are
+## yielded as well, to be checked by etag by reconcile_if_drifted. counts holds the number of "entries" read
+## and of "unchanged" ones skipped.
+def entries_to_check(source, project_id, state, counts, refresh=False):
 
-        else:
-            print("No changes have been made to data configuration for external table.\n")
+    for reconciler, entry in manifest_entries(source):
+        counts["entries"] += 1
+        current = fingerprint(entry, schemas)
+        table_id = f"{entry.get('project', project_id)}.{entry['dataset_name']}.{entry['table_name']}"
 
-            updated_lables = labels
-            cur_lables = table.labels
+        if state is not None and state.is_unchanged(table_id, current):
+            if not refresh:
+                counts["unchanged"] += 1
+                continue
+            reconciler = partial(reconcile_if_drifted, reconciler)
 
-            print(f"\nLabels:- \nNew - {sorted(updated_lables.items())}\nCurrent - {sorted(cur_lables.items())}\n")
-            if changed_lables(cur_lables, updated_lables):
+        yield reconciler, entry, current
 
-                table.labels = updated_lables
-                table = client.update_table(table, ["labels"])  # API request
 
-                print("{}.{}.{} Table's labels have been updated. \n".format(table.project, table.dataset_id, table.table_id))
-            else:
-                print("No changes have been made to lables.\n")
+# Yielding one reconciliation task per object of objects_details, in the order of the manifest
+def build_tasks(client, project_id, entries, inventory, dry_run=False, state=None, allow_lossy=(), batch=None, relist=None):
 
-        return
+    for reconciler, entry, current in entries:
+        table_id = f"{project_id}.{entry['dataset_name']}.{entry['table_name']}"
+        yield ReconcileTask(
+            name=f"{entry['dataset_name']}.{entry['table_name']}",
+            dataset_name=entry['dataset_name'],
+            dataset_location=entry_location(entry),
+            # Each table is one telemetry span, holding the spans of its operations
+            run=partial(telemetry.traced, table_id, "reconcile",
+                        partial(reconcile_entry, reconciler, relist, client, project_id, inventory, entry, dry_run, state,
+                                current, allow_lossy, batch)),
+        )
+
+
+# Constructing the BigQuery client object of a project, None if the project cannot be accessed.
+# Every API call and job of the client is recorded by the telemetry.
+def connect(manager, project_id=None):
+    try:
+        return InstrumentedClient(manager.get_client(project_id))
+    except Exception as e:
+        print(f"WARNING: Unable to access the project {project_id or manager.project_id}.\n", e)
+        return None
+
+
+## Clients and dataset inventories of the projects of the manifest, each created with the first entry of its project.
+## Watch mode keeps them from one pass to the next, so the clients stay warm and the inventories stay in memory.
+class Projects:
+
+    def __init__(self, manager, default_project, inventory_cache=None, inventory_max_age=DEFAULT_MAX_AGE):
+        self.manager = manager
+        self.default_project = default_project
+        self.inventory_cache = inventory_cache
+        self.inventory_max_age = inventory_max_age
+        self.clients = {}
+        self.loaders = {}
+
+    def client(self, project):
+        if project not in self.clients:
+            self.clients[project] = connect(self.manager, project)
+        return self.clients[project]
+
+    def loader(self, project):
+        if project not in self.loaders:
+            self.loaders[project] = DatasetLoader(self.client(project), project, max_age=self.inventory_max_age,
+                                                  cache_path=self.cache_path(project))
+        return self.loaders[project]
+
+    def cache_path(self, project):
+        return project_cache_path(self.inventory_cache, project, self.default_project)
+
+    # Forgetting the inventories, every dataset is looked up again by the next pass
+    def reset_inventories(self):
+        self.loaders = {}
+
+    def save_inventories(self):
+        for project, loader in self.loaders.items():
+            loader.inventory.save(self.cache_path(project))
+
+
+## Yielding ((project, location), (reconciler, entry, fingerprint)) for fan_out. A dataset has one location, so the
+## tables of a dataset always go to the group it was first seen in. Entries of a project which cannot be accessed
+## are skipped, and the dataset loader of each project is created with its first entry.
+def route_entries(entries, default_project, client_for, loader_for):
+
+    dataset_groups = {}
+    for reconciler, entry, current in entries:
+        project = entry.get("project", default_project)
+        if client_for(project) is None:
+            print(f"WARNING: Skipping {project}.{entry['dataset_name']}.{entry['table_name']}, the project cannot be accessed.")
+            continue
+        loader_for(project)
+
+        location = entry_location(entry)
+        key = dataset_groups.setdefault((project, entry["dataset_name"]), (project, location))
+        if key[1] != location:
+            print(f"WARNING: {project}.{entry['dataset_name']}.{entry['table_name']} is in location {location}, "
+                  f"its dataset was already placed in {key[1]}.")
+        yield key, (reconciler, entry, current)
+
+
+# Results of the fan_out groups with the final status of the tables whose metadata update ("queued") or DDL
+# statement ("submitted") finished after the reconciliation, `finished` maps their table ids to it
+def final_statuses(groups, finished):
+    return [(key, results if isinstance(results, Exception)
+             else [(name, finished.get(f"{key[0]}.{name}", status)) for name, status in results], group_time)
+            for key, results, group_time in groups]
+
+
+## One pass over the whole manifest: going through all the objects as they are read, independent tables are
+## reconciled concurrently. Returns False when there was no entry to check.
+def reconcile_manifest(args, projects, state, refresh=False):
+
+    dry_run = args.command == "plan"
+    counts = {"entries": 0, "unchanged": 0}
+    schemas.new_run()
+
+    entries = entries_to_check(args.manifest, args.project, state, counts, refresh)
+    first = next(entries, None)
+    if first is None:
+        if not counts["entries"]:
+            print("WARNING: No Objects founds.")
+        else:
+            print(f"{counts['unchanged']} table/s unchanged since the last apply, nothing to check.\n")
+        if args.schema_cache:
+            schemas.save(args.schema_cache)
+        return False
+
+    # Label/description/clustering updates of all the tables are sent together after the reconciliation
+    batch = MetadataBatch(args.workers)
+
+    # Every project and location is reconciled at the same time by a pool of --workers threads of its own
+    def run_group(key, group_entries):
+        project, _ = key
+        client, loader = projects.client(project), projects.loader(project)
+        tasks = build_tasks(client, project, group_entries, loader.inventory, dry_run=dry_run, state=state,
+                            allow_lossy=args.allow_lossy, batch=batch, relist=loader.relist)
+        return run_reconciliation(tasks, loader.inventory, partial(ensure_dataset, client, project, dry_run=dry_run),
+                                  workers=args.workers, load_dataset=loader.load, report=False)
+
+    start = time.perf_counter()
+    groups = fan_out(route_entries(chain([first], entries), args.project, projects.client, projects.loader), run_group)
+    # The queued metadata updates and submitted DDL statements are finished first, so the report has their final status
+    finished = dict(batch.flush() + ddl_jobs.finish(args.workers))
+    ddl_jobs.close()
+    groups = final_statuses(groups, finished)
+    print_report(groups, args.workers, time.perf_counter() - start)
+    for project, loader in projects.loaders.items():
+        print(f"{project} {loader.summary().rstrip()}")
+    print()
+    # The tables found unchanged by their etag (--refresh) count as unchanged as well
+    unchanged = counts["unchanged"] + sum(status == "unchanged" for _, results, _ in groups if not isinstance(results, Exception)
+                                          for _, status in results)
+    print(f"{unchanged} table/s unchanged since the last apply, {counts['entries'] - unchanged} table/s checked.\n")
+
+    if args.inventory_cache:
+        projects.save_inventories()
+    if state is not None and not dry_run:
+        state.save()
+    if args.schema_cache:
+        schemas.save(args.schema_cache)
+    return True
 
 
 ## ================================================================================================================================
 #Start of execution
-try:
-    # Construct a BigQuery client object.
-    client = bigquery.Client(project=project_id)
-except:
-    print(f"WARNING: Unable to access the project {project_id}.")
-
-#Lists all datasets.
-datasets = client.list_datasets()  # Make an API request.
-
-# To use it to perform check for if required dataset and table is present or not
-bq_datasets = []
-bq_tables = {}
-if datasets:
-    for dataset in datasets:
-        bq_datasets.append(str(dataset.dataset_id))
-        # In-case the dataset is empty set a empty list for it
-        bq_tables.setdefault(str(dataset.dataset_id), [])
-
-        tables = client.list_tables(f"{project_id}.{dataset.dataset_id}")
-        if tables:
-            for table in tables:
-                bq_tables.setdefault(str(dataset.dataset_id), []).append(str(table.table_id))
-
-
-## Going through all the objects one-by-one in objects_details
-with open(objects_details) as file:
-    details = json.load(file)
-
-    if details:
-        for obj in details:
-            if obj =='na_tables_list':
-                # len return number of tables in native_table_list
-                objects = len(details['na_tables_list'])
-                if objects:
-                    # This loop iterate over all the native_table in the list
-                    for i in range(objects):
-
-                        # Table details
-                        dataset_name = details['na_tables_list'][i]['dataset_name']
-                        table_name = details['na_tables_list'][i]['table_name']
-                        json_schema_uri = details['na_tables_list'][i]['schema_json']
-                        labels = details['na_tables_list'][i]['labels']
-
-                        # To check if dataset is present in BigQuery
-                        if dataset_name in bq_datasets:
-                            # To check table is not already present in BigQuery dataset
-                            if table_name not in bq_tables[dataset_name]:
-                                try:
-                                    table = native_table_creation(project_id, dataset_name, table_name, json_schema_uri, labels)
-                                    print("Created table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-
-                                except Exception as e:
-                                    print(f"WARNING: Unable to create Table {table_name} in dataset {dataset_name}\n",e)
-                            else:
-                                # TODO:
-                                print(f"\nWARNING: Table {table_name} Already EXISTS in dataset {dataset_name} ! ! !\n\n Looking for changes . . . \n\n")
-                                native_table_changes(project_id, dataset_name, table_name, json_schema_uri, labels)
-                        else:
-                            # Creating a new dataset if not present in the project
-                            print(f"\nDataset {dataset_name} does not EXISTS ! ! !\n\nCreating new Dataset {dataset_name} in project {project_id}. . .")
-
-                            try:
-                                # Create dataset and update the list of datasets in BigQuery
-                                dataset = create_dataset(project_id, dataset_name, labels["location"])
-                                print("Created dataset {}.{}\n".format(client.project, dataset.dataset_id))
-
-                                bq_datasets.append(str(dataset.dataset_id))
-
-                                try:
-                                    # Create dataset and update the list of table in dataset BigQuery
-                                    table = native_table_creation(project_id, dataset_name, table_name, json_schema_uri, labels)
-                                    print("Created table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-
-                                    bq_tables.setdefault(str(dataset.dataset_id), []).append(str(table.table_id))
-
-                                except Exception as e:
-                                    print(f"WARNING: Unable to create Table {table_name} in dataset {dataset_name}\n",e)
-
-                            except Exception as e:
-                                print(f"WARNING: Unable to create a new dataset {dataset_name} in the project {project_id}.\n",e)
-                else:
-                    print("WARNING: No details for Native table/s is available.")
-
-            elif obj =='ex_tables_list':
-                # len return number of tables in external_table_list
-                objects = len(details['ex_tables_list'])
-                if objects:
-                    # This loop iterate over all the external_table in the list
-                    for i in range(objects):
-
-                        # External table details
-                        dataset_name = details['ex_tables_list'][i]['dataset_name']
-                        ext_table_name = details['ex_tables_list'][i]['table_name']
-                        json_schema_uri = details['ex_tables_list'][i]['schema_json']
-                        source_format = details['ex_tables_list'][i]['source_format']
-                        source_uris = details['ex_tables_list'][i]['source_uris']
-                        labels = details['ex_tables_list'][i]['labels']
-
-
-                        # To check if dataset is present in BigQuery
-                        if dataset_name in bq_datasets:
-                            # To check if external table is not already present in BigQuery dataset
-                            if ext_table_name not in bq_tables[dataset_name]:
-                                try:
-
-                                    table = external_table_creation(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels)
-                                    print("Created external table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-
-                                except Exception as e:
-                                    print(f"WARNING: Unable to create external Table {ext_table_name} in dataset {dataset_name}\n",e)
-                            else:
-                                # TODO:
-                                print(f"\nWARNING: External table {ext_table_name} Already EXISTS in dataset {dataset_name} ! ! !\n\n Looking for changes . . . \n\n")
-                                external_table_changes(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels)
-                        else:
-                            # Creating a new dataset if not present in the project
-                            print(f"\nDataset {dataset_name} does not EXISTS ! ! !\n\nCreating new Dataset {dataset_name} in project {project_id}. . .")
-
-                            try:
-                                # Create dataset and update the list of datasets in BigQuery
-                                dataset = create_dataset(project_id, dataset_name, labels["location"])
-                                print("Created dataset {}.{}\n".format(client.project, dataset.dataset_id))
-
-                                bq_datasets.append(str(dataset.dataset_id))
-
-                                try:
-                                    # Create dataset and update the list of table in dataset BigQuery
-                                    table = external_table_creation(project_id, dataset_name, ext_table_name, json_schema_uri, source_format, source_uris, labels)
-                                    print("Created External table {}.{}.{}\n".format(table.project, table.dataset_id, table.table_id))
-
-                                    bq_tables.setdefault(str(dataset.dataset_id), []).append(str(table.table_id))
-
-                                except Exception as e:
-                                    print(f"WARNING: Unable to create external table {ext_table_name} in dataset {dataset_name}\n",e)
-
-                            except Exception as e:
-                                print(f"WARNING: Unable to create a new dataset {dataset_name} in the project {project_id}.\n",e)
-                else:
-                    print("WARNING: No details for External table/s is available.")
-            else:
-                print("WARNING: Found an invalid object in objects_details")
-
+## manager, when given, is used instead of a ClientManager of the live project (see benchmarks/)
+def main(argv=None, manager=None):
+
+    parser = argparse.ArgumentParser(description="Create and update the BigQuery objects listed in objects_details.json")
+    parser.add_argument("command", nargs="?", choices=["plan", "apply", "watch"], default="apply",
+                        help="plan prints the operations without running them, apply runs them (default apply), "
+                             "watch keeps running and applies the entries of the manifest and schema files as they change")
+    parser.add_argument("--manifest", metavar="PATH", nargs="+", default=objects_details,
+                        help=f"objects details file/s, directories or globs of manifest shards to reconcile (default {objects_details})")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"number of tables reconciled concurrently, 1 runs them one by one (default {DEFAULT_WORKERS})")
+    parser.add_argument("--inventory-cache", metavar="PATH",
+                        help="local file to save the dataset/table snapshot to and revalidate it from on the next run")
+    parser.add_argument("--inventory-max-age", type=int, default=DEFAULT_MAX_AGE,
+                        help=f"seconds after which a cached table list is listed again (default {DEFAULT_MAX_AGE})")
+    parser.add_argument("--state", metavar="PATH", default=DEFAULT_STATE,
+                        help=f"state file of the last apply, entries unchanged since then are skipped (default {DEFAULT_STATE})")
+    parser.add_argument("--no-state", action="store_true", help="ignore the state file and check every entry against BigQuery")
+    parser.add_argument("--allow-lossy", metavar="[PROJECT.]DATASET.TABLE", action="append", default=[],
+                        help="confirm type/mode migrations of this table which can lose data, DATASET.TABLE is a table of "
+                             "--project (can be given more than once)")
+    parser.add_argument("--schema-cache", metavar="PATH",
+                        help="local file to persist the digests of the schema files to, unchanged files are not read on the next run")
+    parser.add_argument("--ddl-linger", type=float, default=DEFAULT_LINGER,
+                        help=f"seconds a DDL statement waits for others of its dataset to share a script job (default {DEFAULT_LINGER})")
+    parser.add_argument("--no-ddl-scripts", action="store_true", help="submit every DDL statement as a job of its own")
+    parser.add_argument("--events", metavar="PATH",
+                        help="file to append the JSON telemetry events of every API call, job and span to (one per line)")
+    parser.add_argument("--log-level", choices=sorted(telemetry.LEVELS), default=telemetry.DEFAULT_LEVEL,
+                        help="debug also prints the whole schemas, labels and source details being compared")
+    parser.add_argument("--refresh", action="store_true",
+                        help="also check unchanged entries, by etag, for changes made outside of this tool")
+    parser.add_argument("--project", default=project_id,
+                        help=f"project of the manifest entries without a \"project\" of their own (default {project_id})")
+    parser.add_argument("--max-qps", type=float,
+                        help="API requests per second allowed for each project, shared by all its locations (default unlimited)")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help=f"watch: seconds between two scans of the manifest and schema files (default {DEFAULT_POLL_INTERVAL})")
+    parser.add_argument("--debounce", type=float, default=DEFAULT_DEBOUNCE,
+                        help=f"watch: seconds without further changes before they are applied (default {DEFAULT_DEBOUNCE})")
+    parser.add_argument("--drift-interval", type=float, default=DEFAULT_DRIFT_INTERVAL,
+                        help=f"watch: seconds between two drift checks of the unchanged tables (default {DEFAULT_DRIFT_INTERVAL})")
+    args = parser.parse_args(argv)
+    try:
+        args.allow_lossy = lossy_confirmations(args.allow_lossy, args.project)
+    except ValueError as e:
+        parser.error(str(e))
+    telemetry.configure(args.events, args.log_level)
+    ddl_jobs.configure(args.ddl_linger, merge=not args.no_ddl_scripts)
+
+    # Watch mode keeps the state of the passes in memory even with --no-state
+    state = StateFile(args.state) if not args.no_state else StateFile(None) if args.command == "watch" else None
+    if args.schema_cache:
+        schemas.load_cache(args.schema_cache)
+
+    # The client of each project keeps its HTTP connection pool for the whole run, sized for its workers
+    if manager is None:
+        manager = ClientManager(args.project, pool_size=max(args.workers, DEFAULT_POOL_SIZE), max_qps=args.max_qps)
+    projects = Projects(manager, args.project, args.inventory_cache, args.inventory_max_age)
+
+    if args.command != "watch":
+        if not reconcile_manifest(args, projects, state, refresh=args.refresh):
+            return
     else:
-        print("WARNING: No Objects founds.")
+        # Every pass checks the whole manifest, the entries unchanged since the last pass cost no API call.
+        # A drift check looks every dataset up again and compares the unchanged tables by etag on the worker pool.
+        # The telemetry of each pass is printed and forgotten, so it does not grow for the life of the watch.
+        def run_pass(refresh):
+            if refresh:
+                projects.reset_inventories()
+            try:
+                reconcile_manifest(args, projects, state, refresh=refresh)
+            finally:
+                telemetry.print_summary(clear=True)
+
+        print(f"Watching {source_name(args.manifest)} and its schema files, Ctrl-C to stop . . .\n")
+        watch(lambda: shard_paths(args.manifest) + schemas.paths(), run_pass, poll_interval=args.poll_interval,
+              debounce=args.debounce, drift_interval=args.drift_interval)
+
+    print(f"\nBigQuery client usage:- {manager.summary()}\nDDL jobs:- {ddl_jobs.summary()}\n")
+    telemetry.print_summary()
+    telemetry.get_telemetry().close()
+    manager.close()
+
+
+if __name__ == "__main__":
+    main()
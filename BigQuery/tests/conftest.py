@@ -0,0 +1,9 @@
+## Unit tests of the schema diff and migration SQL helpers, nothing here calls BigQuery.
+##   python -m pytest -q BigQuery/tests
+
+# [START imports]
+import os
+import sys
+
+# The modules of BigQuery/ import each other by name, like test_code.py run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
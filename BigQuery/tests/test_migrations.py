@@ -0,0 +1,146 @@
+# [START imports]
+import datetime
+
+import pytest
+from google.cloud import bigquery
+
+from migrations import (_value_expression, alter_columns_sql, column_definition, lossy_changes, policy_tagged_columns,
+                        rewrite_with_casts_sql, rewrite_without_columns_sql)
+from schema_diff import diff_schemas
+
+
+TABLE_ID = "p.d.t"
+SCHEMA = [
+    {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+    {"name": "ts", "type": "TIMESTAMP", "mode": "NULLABLE"},
+    {"name": "market", "type": "STRING", "mode": "NULLABLE"},
+]
+
+
+def col(name, field_type, mode="NULLABLE", fields=None, **extra):
+    column = {"name": name, "type": field_type, "mode": mode, **extra}
+    if fields is not None:
+        column["fields"] = fields
+    return column
+
+
+# Existing table with the given schema (schema_files dicts) and table attributes
+def table(schema=SCHEMA, **attributes):
+    result = bigquery.Table(TABLE_ID, schema=[bigquery.SchemaField.from_api_repr(column) for column in schema])
+    for name, value in attributes.items():
+        setattr(result, name, value)
+    return result
+
+
+## Value expressions of the CAST rewrite
+
+def test_repeated_record_casts_every_element_and_adds_nested_fields():
+    cur = col("r", "RECORD", "REPEATED", [col("a", "INTEGER")])
+    updated = col("r", "RECORD", "REPEATED", [col("a", "STRING"), col("b", "INTEGER")])
+    assert _value_expression("`r`", cur, updated) == (
+        "ARRAY(SELECT AS STRUCT CAST(e.`a` AS STRING) AS `a`, CAST(NULL AS INT64) AS `b` "
+        "FROM UNNEST(`r`) AS e WITH OFFSET AS o ORDER BY o)")
+
+
+def test_repeated_scalar_cast_keeps_the_element_order():
+    assert _value_expression("`x`", col("x", "INTEGER", "REPEATED"), col("x", "STRING", "REPEATED")) == (
+        "ARRAY(SELECT CAST(e AS STRING) FROM UNNEST(`x`) AS e WITH OFFSET AS o ORDER BY o)")
+
+
+def test_nullable_to_repeated_wraps_the_value():
+    assert _value_expression("`x`", col("x", "INTEGER"), col("x", "INTEGER", "REPEATED")) == "IF(`x` IS NULL, [], [`x`])"
+    assert _value_expression("`x`", col("x", "INTEGER"), col("x", "STRING", "REPEATED")) == (
+        "IF(`x` IS NULL, [], [CAST(`x` AS STRING)])")
+
+
+def test_repeated_to_nullable_keeps_the_first_element():
+    assert _value_expression("`x`", col("x", "INTEGER", "REPEATED"), col("x", "INTEGER")) == "`x`[SAFE_OFFSET(0)]"
+    assert _value_expression("`x`", col("x", "INTEGER", "REPEATED"), col("x", "STRING")) == (
+        "CAST(`x`[SAFE_OFFSET(0)] AS STRING)")
+
+
+def test_nested_record_add_is_null_of_its_struct_type():
+    cur = col("r", "RECORD", fields=[col("a", "INTEGER")])
+    updated = col("r", "RECORD", fields=[col("a", "INTEGER"), col("b", "RECORD", fields=[col("c", "DATE")])])
+    assert _value_expression("`r`", cur, updated) == (
+        "IF(`r` IS NULL, NULL, STRUCT(`r`.`a` AS `a`, CAST(NULL AS STRUCT<`c` DATE>) AS `b`))")
+
+
+def test_column_definition_of_nested_columns():
+    column = col("r", "RECORD", "REPEATED", [col("a", "INTEGER", "REQUIRED"), col("b", "STRING", "REPEATED", description="b \"x\"")])
+    assert column_definition(column) == '`r` ARRAY<STRUCT<`a` INT64 NOT NULL, `b` ARRAY<STRING> OPTIONS(description="b \\"x\\"")>>'
+
+
+## Rewrites keeping the layout of the table
+
+def test_cast_rewrite_keeps_partitioning_clustering_and_options():
+    existing = table(time_partitioning=bigquery.TimePartitioning(type_="HOUR", field="ts", expiration_ms=7 * 86400000),
+                     clustering_fields=["market", "id"], labels={"env": "dev"}, description="d",
+                     expires=datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc))
+    updated = [col("id", "STRING", "REQUIRED"), col("ts", "TIMESTAMP")]
+    assert rewrite_with_casts_sql(existing, TABLE_ID, SCHEMA, updated) == (
+        "CREATE OR REPLACE TABLE `p.d.t` (`id` STRING NOT NULL, `ts` TIMESTAMP) "
+        "PARTITION BY TIMESTAMP_TRUNC(`ts`, HOUR) CLUSTER BY `id` "
+        "OPTIONS(labels=[(\"env\", \"dev\")], description=\"d\", partition_expiration_days=7.0, "
+        "expiration_timestamp=TIMESTAMP \"2030-01-01T00:00:00+00:00\") "
+        "AS SELECT CAST(`id` AS STRING) AS `id`, `ts` AS `ts` FROM `p.d.t`")
+
+
+def test_cast_rewrite_partitions_by_the_updated_column_type():
+    existing = table(time_partitioning=bigquery.TimePartitioning(type_="MONTH", field="ts"))
+    updated = [col("id", "INTEGER", "REQUIRED"), col("ts", "DATE"), col("market", "STRING")]
+    assert "PARTITION BY DATE_TRUNC(`ts`, MONTH)" in rewrite_with_casts_sql(existing, TABLE_ID, SCHEMA, updated)
+
+
+def test_cast_rewrite_reads_every_partition_of_a_table_requiring_a_filter():
+    existing = table(time_partitioning=bigquery.TimePartitioning(field="ts"), require_partition_filter=True)
+    sql = rewrite_with_casts_sql(existing, TABLE_ID, SCHEMA, [col("id", "STRING", "REQUIRED"), col("ts", "TIMESTAMP"), col("market", "STRING")])
+    assert "OPTIONS(require_partition_filter=true)" in sql
+    assert sql.endswith("FROM `p.d.t` WHERE `ts` IS NULL OR `ts` IS NOT NULL")
+
+
+def test_cast_rewrite_keeps_the_column_descriptions():
+    existing = table([dict(SCHEMA[0], description="key")] + SCHEMA[1:])
+    sql = rewrite_with_casts_sql(existing, TABLE_ID, SCHEMA, [col("id", "STRING", "REQUIRED")] + SCHEMA[1:])
+    assert '(`id` STRING NOT NULL OPTIONS(description="key"), `ts` TIMESTAMP, `market` STRING)' in sql
+
+
+def test_cast_rewrite_refuses_ingestion_time_partitioning():
+    with pytest.raises(ValueError):
+        rewrite_with_casts_sql(table(time_partitioning=bigquery.TimePartitioning()), TABLE_ID, SCHEMA, SCHEMA)
+
+
+def test_drop_of_a_range_partitioning_column_keeps_the_partition_filter():
+    existing = table(range_partitioning=bigquery.RangePartitioning(field="id", range_=bigquery.PartitionRange(0, 100, 10)),
+                     require_partition_filter=True)
+    assert rewrite_without_columns_sql(existing, TABLE_ID, ["id"]) == (
+        "CREATE OR REPLACE TABLE `p.d.t` (`ts` TIMESTAMP, `market` STRING) "
+        "AS SELECT * EXCEPT (`id`) FROM `p.d.t` WHERE `id` IS NULL OR `id` IS NOT NULL")
+
+
+def test_drop_of_a_clustering_column_keeps_the_partitioning():
+    existing = table(time_partitioning=bigquery.TimePartitioning(field="ts"), clustering_fields=["market"],
+                     require_partition_filter=True)
+    assert rewrite_without_columns_sql(existing, TABLE_ID, ["market"]) == (
+        "CREATE OR REPLACE TABLE `p.d.t` (`id` INT64 NOT NULL, `ts` TIMESTAMP) "
+        "PARTITION BY TIMESTAMP_TRUNC(`ts`, DAY) OPTIONS(require_partition_filter=true) "
+        "AS SELECT * EXCEPT (`market`) FROM `p.d.t` WHERE `ts` IS NULL OR `ts` IS NOT NULL")
+
+
+## Metadata-only changes and the changes which need a confirmation
+
+def test_alter_columns_in_one_statement():
+    assert alter_columns_sql(TABLE_ID, [("id", "INTEGER", "NUMERIC")], [("market", "REQUIRED", "NULLABLE")]) == (
+        "ALTER TABLE `p.d.t` ALTER COLUMN `id` SET DATA TYPE NUMERIC, ALTER COLUMN `market` DROP NOT NULL")
+
+
+def test_lossy_changes():
+    cur = [col("f", "FLOAT"), col("s", "INTEGER"), col("tags", "STRING", "REPEATED"), col("r", "RECORD", fields=[col("d", "TIMESTAMP")])]
+    updated = [col("f", "INTEGER"), col("s", "STRING"), col("tags", "STRING"), col("r", "RECORD", fields=[col("d", "DATE")])]
+    assert lossy_changes(diff_schemas(cur, updated)) == ["f FLOAT->INTEGER", "r.d TIMESTAMP->DATE", "tags REPEATED->NULLABLE"]
+
+
+def test_policy_tagged_columns_are_found_at_every_level():
+    tagged = {"policyTags": {"names": ["projects/p/locations/us/taxonomies/1/policyTags/2"]}}
+    existing = table([col("id", "INTEGER", **tagged), col("r", "RECORD", fields=[col("a", "STRING"), col("b", "STRING", **tagged)])])
+    assert policy_tagged_columns(existing.schema) == ["id", "r.b"]
@@ -0,0 +1,105 @@
+# [START imports]
+from schema_diff import diff_schemas, merge_additive_changes
+from schema_registry import Column
+
+
+def col(name, field_type, mode="NULLABLE", fields=None, **extra):
+    column = {"name": name, "type": field_type, "mode": mode, **extra}
+    if fields is not None:
+        column["fields"] = fields
+    return column
+
+
+CURRENT = [
+    col("id", "INTEGER", "REQUIRED"),
+    col("address", "RECORD", fields=[col("city", "STRING"), col("zip", "INTEGER"), col("street", "STRING")]),
+    col("amount", "NUMERIC"),
+]
+
+
+## diff_schemas
+
+def test_no_changes_with_type_aliases_and_case():
+    updated = [col("ID", "INT64", "REQUIRED"), col("address", "STRUCT", fields=[col("City", "STRING"), col("zip", "INTEGER"),
+                                                                                   col("street", "STRING")]),
+               col("amount", "DECIMAL", None)]
+    diff = diff_schemas(CURRENT, updated)
+    assert not diff.has_changes(include_reorder=True)
+    assert diff.summary() == "no changes"
+
+
+def test_nested_add_and_drop():
+    updated = [CURRENT[0], col("address", "RECORD", fields=[col("city", "STRING"), col("zip", "INTEGER"), col("country", "STRING")]),
+               CURRENT[2], col("tags", "STRING", "REPEATED")]
+    diff = diff_schemas(CURRENT, updated)
+    assert sorted(path for path, _ in diff.added) == ["address.country", "tags"]
+    assert [path for path, _ in diff.dropped] == ["address.street"]
+    assert not diff.type_changed and not diff.reordered
+    assert not diff.is_additive()
+
+
+def test_retype_and_mode_changes():
+    updated = [col("id", "INTEGER", "NULLABLE"), col("address", "RECORD", "REPEATED", fields=[col("city", "STRING"),
+                                                                                              col("zip", "STRING"),
+                                                                                              col("street", "STRING")]),
+               col("amount", "BIGNUMERIC")]
+    diff = diff_schemas(CURRENT, updated)
+    assert diff.type_changed == [("address.zip", "INTEGER", "STRING"), ("amount", "NUMERIC", "BIGNUMERIC")]
+    assert diff.mode_relaxed == [("id", "REQUIRED", "NULLABLE")]
+    assert diff.mode_changed == [("address", "NULLABLE", "REPEATED")]
+
+
+def test_record_retyped_to_a_scalar_is_not_diffed_below():
+    updated = [CURRENT[0], col("address", "STRING"), CURRENT[2]]
+    diff = diff_schemas(CURRENT, updated)
+    assert diff.type_changed == [("address", "RECORD", "STRING")]
+    assert not diff.added and not diff.dropped
+
+
+def test_reorder_at_every_level_counts_only_with_include_reorder():
+    updated = [CURRENT[2], CURRENT[0], col("address", "RECORD", fields=[col("zip", "INTEGER"), col("city", "STRING"),
+                                                                       col("street", "STRING")])]
+    diff = diff_schemas(CURRENT, updated)
+    assert sorted(diff.reordered) == ["address", "address.city", "address.zip", "amount", "id"]
+    assert not diff.has_changes()
+    assert diff.has_changes(include_reorder=True)
+
+
+def test_added_and_dropped_columns_are_not_a_reorder():
+    updated = [col("new", "STRING"), CURRENT[0], CURRENT[1]]
+    diff = diff_schemas(CURRENT, updated)
+    assert not diff.reordered
+    assert diff.summary() == "added: new; dropped: amount"
+
+
+def test_schema_file_columns_are_diffed_as_dicts():
+    updated = [Column.from_api_repr(column) for column in CURRENT] + [Column.from_api_repr(col("extra", "DATE"))]
+    diff = diff_schemas(CURRENT, updated)
+    assert [path for path, _ in diff.added] == ["extra"]
+    assert diff.is_additive()
+
+
+## merge_additive_changes
+
+def test_merge_keeps_descriptions_policy_tags_and_order():
+    tags = {"names": ["projects/p/locations/us/taxonomies/1/policyTags/2"]}
+    cur_fields = [col("id", "INTEGER", "REQUIRED", description="key", policyTags=tags),
+                  col("address", "RECORD", fields=[col("city", "STRING", description="city")]),
+                  col("amount", "NUMERIC")]
+    updated = [col("amount", "NUMERIC"), col("id", "INTEGER", "NULLABLE"),
+               col("address", "RECORD", fields=[col("zip", "INTEGER"), col("city", "STRING")]), col("tags", "STRING", "REPEATED")]
+    assert merge_additive_changes(cur_fields, updated) == [
+        col("id", "INTEGER", "NULLABLE", description="key", policyTags=tags),
+        col("address", "RECORD", fields=[col("city", "STRING", description="city"), col("zip", "INTEGER")]),
+        col("amount", "NUMERIC"),
+        col("tags", "STRING", "REPEATED"),
+    ]
+
+
+def test_merge_copies_the_new_columns_of_a_schema_file():
+    cur_fields = [col("id", "INTEGER")]
+    new = Column.from_api_repr(col("r", "RECORD", fields=[col("a", "STRING")]))
+    merged = merge_additive_changes(cur_fields, [Column.from_api_repr(cur_fields[0]), new])
+    assert merged[1] == col("r", "RECORD", fields=[col("a", "STRING")])
+    assert type(merged[1]) is dict and type(merged[1]["fields"]) is list
+    assert cur_fields == [col("id", "INTEGER")]
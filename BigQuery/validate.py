@@ -0,0 +1,176 @@
+# [START imports]
+import argparse
+import json
+import os
+import re
+import subprocess
+
+from layout import EXTERNAL_LAYOUT_KEYS, LAYOUT_KEYS
+from manifest import DEFAULT_MANIFEST, iter_manifest, source_name
+from schema_diff import diff_schemas, normalize_mode, normalize_type
+
+
+## Offline validation of the manifest and its schema files: no cloud SDK import, no credentials, no API call.
+## python BigQuery/cli.py validate [--manifest PATH ...] [--base REF]
+
+# Column types and modes of a schema file, after normalize_type (INT64 -> INTEGER, STRUCT -> RECORD, ...)
+SCHEMA_TYPES = ["STRING", "BYTES", "INTEGER", "FLOAT", "NUMERIC", "BIGNUMERIC", "BOOLEAN", "TIMESTAMP", "DATE", "TIME",
+                "DATETIME", "GEOGRAPHY", "JSON", "INTERVAL", "RECORD"]
+SCHEMA_MODES = ["NULLABLE", "REQUIRED", "REPEATED"]
+# Deepest nesting of RECORD columns BigQuery accepts
+MAX_NESTING = 15
+MAX_CLUSTERING_FIELDS = 4
+COLUMN_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,299}$")
+
+# Label keys start with a lowercase letter, keys and values hold lowercase letters, digits, '_' and '-' only
+MAX_LABELS = 64
+LABEL_KEY = re.compile(r"^[a-z][a-z0-9_-]{0,62}$")
+LABEL_VALUE = re.compile(r"^[a-z0-9_-]{0,63}$")
+
+
+# Problems of one level of columns and of the nested fields of its RECORD columns
+def column_problems(columns, prefix="", depth=1):
+
+    if not isinstance(columns, list):
+        return [f"{prefix or 'schema'}: expected a list of columns"]
+
+    problems, names = [], set()
+    for index, col in enumerate(columns):
+        if not isinstance(col, dict) or not isinstance(col.get("name"), str):
+            problems.append(f"{prefix}[{index}]: a column needs a name")
+            continue
+        path = f"{prefix}{col['name']}"
+        if not COLUMN_NAME.match(col["name"]):
+            problems.append(f"{path}: invalid column name")
+        if col["name"].lower() in names:
+            problems.append(f"{path}: duplicated column name")
+        names.add(col["name"].lower())
+
+        field_type = normalize_type(col["type"]) if isinstance(col.get("type"), str) else None
+        if field_type not in SCHEMA_TYPES:
+            problems.append(f"{path}: unknown type {col.get('type')!r}")
+        if not isinstance(col.get("mode", "NULLABLE"), str) or normalize_mode(col.get("mode")) not in SCHEMA_MODES:
+            problems.append(f"{path}: unknown mode {col.get('mode')!r}")
+
+        if field_type == "RECORD":
+            if not col.get("fields"):
+                problems.append(f"{path}: a RECORD column needs fields")
+            elif depth >= MAX_NESTING:
+                problems.append(f"{path}: RECORD columns are nested more than {MAX_NESTING} levels deep")
+            else:
+                problems.extend(column_problems(col["fields"], f"{path}.", depth + 1))
+        elif "fields" in col:
+            problems.append(f"{path}: only RECORD columns have fields")
+    return problems
+
+
+# Problems of the labels of an entry
+def label_problems(labels):
+    problems = []
+    if len(labels) > MAX_LABELS:
+        problems.append(f"more than {MAX_LABELS} labels")
+    for key, value in labels.items():
+        if not LABEL_KEY.match(key):
+            problems.append(f"label key {key!r} must start with a lowercase letter and hold up to 63 lowercase letters, digits, '_' or '-'")
+        if not isinstance(value, str) or not LABEL_VALUE.match(value):
+            problems.append(f"label {key!r} value {value!r} must hold up to 63 lowercase letters, digits, '_' or '-'")
+    return problems
+
+
+# Problems of the layout options of an entry against its schema
+def layout_problems(list_name, entry, columns):
+    problems = []
+    if list_name == "ex_tables_list":
+        problems.extend(f"'{key}' is not supported for an external table" for key in entry
+                        if key in LAYOUT_KEYS and key not in EXTERNAL_LAYOUT_KEYS)
+        return problems
+
+    top_level = {col["name"].lower() for col in columns or [] if isinstance(col, dict) and isinstance(col.get("name"), str)}
+    fields = list(entry.get("clustering_fields") or [])
+    if len(fields) > MAX_CLUSTERING_FIELDS:
+        problems.append(f"at most {MAX_CLUSTERING_FIELDS} clustering fields")
+    for key in ("time_partitioning", "range_partitioning"):
+        if (entry.get(key) or {}).get("field"):
+            fields.append(entry[key]["field"])
+    if columns is not None:
+        problems.extend(f"partitioning/clustering field {field!r} is not a column of the schema"
+                        for field in fields if str(field).lower() not in top_level)
+    return problems
+
+
+# Schema file content at a git revision, None when it is not in git there (e.g. a new file)
+def base_columns(path, base):
+    try:
+        result = subprocess.run(["git", "show", f"{base}:./{os.path.relpath(path)}"], capture_output=True, check=True)
+        return json.loads(result.stdout)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+# Changes against the schema of the base revision which BigQuery refuses on an existing table,
+# schemas too broken to be compared are only reported by column_problems
+def migration_problems(base, columns):
+    try:
+        diff = diff_schemas(base, columns)
+    except (AttributeError, KeyError, TypeError):
+        return []
+    problems = [f"{path}: a REQUIRED column cannot be added to an existing table"
+                for path, col in diff.added if normalize_mode(col.get("mode")) == "REQUIRED"]
+    problems.extend(f"{path}: {old} -> {new} cannot be applied to an existing table"
+                    for path, old, new in diff.mode_changed if new == "REQUIRED")
+    return problems
+
+
+## Validating every entry of the manifest and every schema file it refers to, each schema file once.
+## With `base` (a git revision) the schema files are compared with their version there as well.
+## Returns the list of problems, each printed as an ERROR.
+def validate(source, base=None):
+
+    problems = []
+
+    def error(message):
+        print(f"ERROR: {message}")
+        problems.append(message)
+
+    schemas = {}
+    entries = 0
+    for list_name, entry, location in iter_manifest(source, warn=error):
+        entries += 1
+        for problem in label_problems(entry["labels"]):
+            error(f"{location}: {problem}")
+
+        path = entry["schema_json"]
+        if path not in schemas:
+            try:
+                with open(path) as file:
+                    columns = json.load(file)
+            except (OSError, ValueError) as e:
+                error(f"{location}: unable to read the schema file {path}\n{e}")
+                columns = None
+            else:
+                for problem in column_problems(columns):
+                    error(f"{path}: {problem}")
+                previous = base_columns(path, base) if base else None
+                if previous is not None:
+                    for problem in migration_problems(previous, columns):
+                        error(f"{path}: {problem} (compared with {base})")
+            schemas[path] = columns
+
+        for problem in layout_problems(list_name, entry, schemas[path]):
+            error(f"{location}: {problem}")
+
+    print(f"\nValidated {entries} entry/ies and {len(schemas)} schema file/s of {source_name(source)}: {len(problems)} problem/s found.\n")
+    return problems
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Validate the manifest and its schema files offline, without the cloud SDK")
+    parser.add_argument("--manifest", metavar="PATH", nargs="+", default=DEFAULT_MANIFEST,
+                        help=f"objects details file/s, directories or globs of manifest shards (default {DEFAULT_MANIFEST})")
+    parser.add_argument("--base", metavar="REF",
+                        help="git revision the schema files are compared with, e.g. HEAD or origin/main, "
+                             "to refuse changes BigQuery cannot apply to existing tables (REQUIRED columns)")
+    args = parser.parse_args(argv)
+
+    return 1 if validate(args.manifest, args.base) else 0
@@ -0,0 +1,80 @@
+# [START imports]
+import os
+import threading
+import time
+
+
+# Seconds between two scans of the watched files
+DEFAULT_POLL_INTERVAL = 1.0
+# Seconds without any further change before the changed entries are applied, an editor saving a file
+# several times or a git checkout touching many files ends up as a single pass
+DEFAULT_DEBOUNCE = 2.0
+# Seconds between two drift checks of the unchanged tables against BigQuery
+DEFAULT_DRIFT_INTERVAL = 900
+
+
+# (modification time, size) of every existing file, a missing file is left out so it shows as changed
+def snapshot(paths):
+    files = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        files[path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def changed_files(before, after):
+    return {path for path in before.keys() | after.keys() if before.get(path) != after.get(path)}
+
+
+## Watching files until stop is set (or Ctrl-C): run_pass(refresh) is called once at the start, again once the
+## files returned by paths() stopped changing for `debounce` seconds, and with refresh=True every `drift_interval`
+## seconds to check the unchanged tables against BigQuery. paths() is called on every scan, so files a pass
+## starts referring to (e.g. a new schema file) are watched from then on. A failed pass is reported and the
+## watch goes on.
+def watch(paths, run_pass, poll_interval=DEFAULT_POLL_INTERVAL, debounce=DEFAULT_DEBOUNCE,
+          drift_interval=DEFAULT_DRIFT_INTERVAL, stop=None):
+
+    stop = stop or threading.Event()
+
+    def safe_pass(refresh):
+        try:
+            run_pass(refresh)
+        except Exception as e:
+            print("WARNING: The pass failed, watching for the next change.\n", e)
+
+    # Files a pass starts referring to are added to the snapshot, the changes made during a pass to the
+    # ones already watched are still picked up by the next scan
+    def watch_new_files(files):
+        files.update((path, value) for path, value in snapshot(paths()).items() if path not in files)
+
+    files = snapshot(paths())
+    changed, last_change = set(), None
+    try:
+        safe_pass(False)
+        watch_new_files(files)
+        next_drift = time.monotonic() + drift_interval
+
+        while not stop.wait(poll_interval):
+            current = snapshot(paths())
+            new_changes = changed_files(files, current)
+            files = current
+            now = time.monotonic()
+            if new_changes:
+                changed |= new_changes
+                last_change = now
+
+            if changed and now - last_change >= debounce:
+                print(f"\nChange/s detected in {len(changed)} file/s: {', '.join(sorted(changed))}\n")
+                changed = set()
+                safe_pass(False)
+                watch_new_files(files)
+            elif not changed and now >= next_drift:
+                print("\nChecking the unchanged tables for drift against BigQuery . . .\n")
+                safe_pass(True)
+                watch_new_files(files)
+                next_drift = time.monotonic() + drift_interval
+    except KeyboardInterrupt:
+        print("\nStopped watching.\n")